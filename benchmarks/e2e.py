@@ -0,0 +1,303 @@
+"""
+End-to-end benchmark of `act()` without network access.
+
+Each scenario runs the agent on a fixture site served from localhost (benchmarks/fixtures and generated product
+listings of several DOM sizes), in headless Chromium, with a `ScriptedBackend` replaying recorded responses
+instead of the LLM. The last response of each scenario checks the page, so a scenario only succeeds if every
+action had its effect.
+
+Reports steps/sec per scenario, marking time and marked elements per DOM size, peak memory, and the p50/p95
+latency of every traced phase. Save the results to compare a later run against them:
+
+    python benchmarks/e2e.py --save baseline.json
+    python benchmarks/e2e.py --baseline baseline.json  # exits with 1 if something regressed
+"""
+import argparse
+import functools
+import json
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List, Optional
+from pywebagent import act, tracing
+from pywebagent.env.pool import BrowserPool
+from pywebagent.llm import LLMClient, RateLimiter, ScriptedBackend, set_client
+from pywebagent.tracing import PhaseStats, TraceHook, Tracer, format_report, summarize
+
+FIXTURES_DIRECTORY = Path(__file__).parent / "fixtures"
+REGRESSION_THRESHOLD = 0.2
+
+
+def by_label(label: str) -> str:
+    """Code resolving a marked element id by its label, recorded responses can't rely on ids of a changed page."""
+    return f"[i for i, e in actions.marked_elements.items() if e['label'] == {label!r}][0]"
+
+
+def response(code: str) -> str:
+    return f"Reasoning:\nThe next action follows the task.\n\nCode:\n```python\n{code}\n```"
+
+
+def finish_if(expression: str, expected: str) -> str:
+    """The last response, succeeds only if the page shows the expected outcome."""
+    return response(f"result = actions.page.evaluate({expression!r})\n"
+                    f"actions.finish(result == {expected!r}, {{'result': result}}, 'Checked the page')")
+
+
+RESULT_JS = "() => document.getElementById('result').textContent"
+
+
+@dataclass
+class Scenario:
+    name: str
+    path: str  # on the fixtures server
+    task: str
+    responses: List[str]
+    args: dict = field(default_factory=dict)
+    dom_size: Optional[int] = None  # products of a generated listing
+
+
+def generate_products_page(num_products: int) -> str:
+    """A product listing with a cart, about 8 elements per product."""
+    parts = ["<!DOCTYPE html><html><head><title>Shop</title><style>",
+             "body{font-family:sans-serif;margin:0}header{position:sticky;top:0;background:#fff;padding:12px}",
+             ".card{display:inline-block;width:180px;margin:6px;vertical-align:top;border:1px solid #ddd}",
+             "</style></head><body><header><a href='#cart' id='cart'>Cart (0)</a> <span id='result'></span></header>"]
+    for i in range(1, num_products + 1):
+        parts.append(
+            f"<div class='card'><div><img width='160' height='90' alt='Product {i} photo'></div>"
+            f"<a href='#p{i}'><span>Product {i}</span></a><div><span>${i % 97 + 3}.99</span></div>"
+            f"<button aria-label='Add Product {i} to cart' data-product='Product {i}'>Add to cart</button></div>")
+    parts.append("""<script>
+        const cart = [];
+        document.body.addEventListener('click', event => {
+            const product = event.target.dataset.product;
+            if (product) {
+                cart.push(product);
+                document.getElementById('cart').textContent = `Cart (${cart.length})`;
+            }
+        });
+        document.getElementById('cart').addEventListener('click', () => {
+            document.getElementById('result').textContent = cart.join(',');
+        });
+    </script></body></html>""")
+    return "".join(parts)
+
+
+def get_scenarios(product_sizes: List[int], upload_path: Path) -> List[Scenario]:
+    scenarios = [
+        Scenario(
+            name="form",
+            path="form.html",
+            task="Sign up to the Pro plan",
+            args={"name": "Ada Lovelace", "email": "ada@example.com"},
+            responses=[
+                response(f'actions.input_text({by_label("Full name")}, "Ada Lovelace", True, "Type the name")\n'
+                         f'actions.input_text({by_label("Email")}, "ada@example.com", True, "Type the email")'),
+                response(f'actions.combobox_select({by_label("Plan")}, "Pro", "Choose the Pro plan")'),
+                response(f'actions.click({by_label("Submit")}, "Submit the form")'),
+                finish_if(RESULT_JS, "Ada Lovelace|ada@example.com|Pro"),
+            ],
+        ),
+        Scenario(
+            name="iframes",
+            path="iframes.html",
+            task="Open a support ticket about a late delivery",
+            responses=[
+                response(f'actions.input_text({by_label("Describe your issue")}, "late delivery", True, "Describe the issue")'),
+                response(f'actions.click({by_label("Search")}, "Search")'),
+                response(f'actions.click({by_label("Open ticket")}, "Open the ticket")'),
+                finish_if(RESULT_JS, "ticket:late delivery"),
+            ],
+        ),
+        Scenario(
+            name="infinite_scroll",
+            path="infinite_scroll.html",
+            task="Open item 26 of the feed",
+            responses=[
+                *[response('actions.scroll("down", "Scroll to load more items")')] * 3,
+                response(f'actions.click({by_label("Item 26")}, "Open item 26")'),
+                finish_if(RESULT_JS, "Item 26"),
+            ],
+        ),
+        Scenario(
+            name="upload",
+            path="upload.html",
+            task="Attach the report",
+            responses=[
+                response(f'actions.upload_files({by_label("Attachment")}, [{str(upload_path)!r}], "Attach the report")'),
+                finish_if(RESULT_JS, upload_path.name),
+            ],
+        ),
+    ]
+    for size in product_sizes:
+        scenarios.append(Scenario(
+            name=f"products_{size}",
+            path=f"products_{size}.html",
+            task="Add product 3 to the cart and open the cart",
+            dom_size=size,
+            responses=[
+                response(f'actions.click({by_label("Add Product 3 to cart")}, "Add product 3")'),
+                response(f'actions.click({by_label("Cart (1)")}, "Open the cart")'),
+                finish_if(RESULT_JS, "Product 3"),
+            ],
+        ))
+    return scenarios
+
+
+class CollectSpans(TraceHook):
+    def __init__(self):
+        self.spans = []
+
+    def on_span_end(self, span):
+        self.spans.append(span)
+
+
+def serve(directory: Path):
+    handler = functools.partial(_QuietHandler, directory=str(directory))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def _phase_p50(spans, name) -> Optional[float]:
+    durations = [span.duration for span in spans if span.name == name]
+    return statistics.median(durations) if durations else None
+
+
+def run_scenario(scenario: Scenario, base_url: str, pool: BrowserPool, repeat: int, trace_memory: bool):
+    runs = []
+    spans = []
+    for _ in range(repeat):
+        hook = CollectSpans()
+        tracing.set_tracer(Tracer([hook]))
+        set_client(LLMClient(ScriptedBackend(scenario.responses), limiter=RateLimiter(), max_retries=0))
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = act(f"{base_url}/{scenario.path}", scenario.task, max_actions=len(scenario.responses) + 2,
+                         pool=pool, **scenario.args)
+            succeeded = result.succeeded
+        except Exception as e:
+            print(f"{scenario.name} failed: {e}", file=sys.stderr)
+            succeeded = False
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+        steps = sum(span.name == "agent.step" for span in hook.spans)
+        runs.append({"succeeded": succeeded, "seconds": elapsed, "steps": steps, "python_peak_bytes": peak})
+        spans.extend(hook.spans)
+
+    mark_spans = [span for span in spans if span.name == "env.mark_elements"]
+    steps, seconds = sum(run["steps"] for run in runs), sum(run["seconds"] for run in runs)
+    peaks = [run["python_peak_bytes"] for run in runs if run["python_peak_bytes"] is not None]
+    result = {
+        "succeeded": all(run["succeeded"] for run in runs),
+        "steps": steps // repeat,
+        "steps_per_sec": steps / seconds if seconds else 0.0,
+        "mark_p50": _phase_p50(spans, "env.mark_elements"),
+        "marked_elements": max((span.attributes.get("elements", 0) for span in mark_spans), default=0),
+        "screenshot_p50": _phase_p50(spans, "env.screenshot"),
+        "python_peak_bytes": max(peaks) if peaks else None,
+        "dom_size": scenario.dom_size,
+    }
+    return result, spans
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if before["succeeded"] and not result["succeeded"]:
+            regressions.append(f"{name} no longer succeeds")
+        if result["steps_per_sec"] < before["steps_per_sec"] * (1 - threshold):
+            regressions.append(f"{name} steps/sec {before['steps_per_sec']:.2f} -> {result['steps_per_sec']:.2f}")
+    return regressions
+
+
+def print_scenarios(results: dict, baseline: dict):
+    print(f"{'scenario':<18} {'ok':>3} {'steps':>6} {'steps/s':>8} {'vs base':>8} {'mark p50 ms':>12} "
+          f"{'marked':>7} {'shot p50 ms':>12} {'py peak MB':>11}")
+    for name, result in results.items():
+        before = baseline.get(name)
+        change = f"{result['steps_per_sec'] / before['steps_per_sec'] - 1:+.0%}" if before and before["steps_per_sec"] else ""
+        peak = f"{result['python_peak_bytes'] / 2**20:.1f}" if result["python_peak_bytes"] is not None else "-"
+        mark = f"{result['mark_p50'] * 1000:.1f}" if result["mark_p50"] is not None else "-"
+        shot = f"{result['screenshot_p50'] * 1000:.1f}" if result["screenshot_p50"] is not None else "-"
+        print(f"{name:<18} {'yes' if result['succeeded'] else 'NO':>3} {result['steps']:>6} "
+              f"{result['steps_per_sec']:>8.2f} {change:>8} {mark:>12} {result['marked_elements']:>7} {shot:>12} {peak:>11}")
+
+
+def main(args) -> int:
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    results, phase_durations, all_spans = {}, {}, []
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        shutil.copytree(FIXTURES_DIRECTORY, directory, dirs_exist_ok=True)
+        for size in args.sizes:
+            (directory / f"products_{size}.html").write_text(generate_products_page(size))
+        upload_path = directory / "report.txt"
+        upload_path.write_text("Quarterly report\n")
+
+        server, base_url = serve(directory)
+        pool = BrowserPool(size=1, headless=True, launch_options={"channel": args.channel})
+        try:
+            scenarios = [s for s in get_scenarios(args.sizes, upload_path) if not args.only or s.name in args.only]
+            for scenario in scenarios:
+                results[scenario.name], spans = run_scenario(scenario, base_url, pool, args.repeat, args.trace_memory)
+                all_spans.extend(spans)
+        finally:
+            pool.close()
+            server.shutdown()
+
+    phases = summarize(all_spans)
+    for name, stats in phases.items():
+        phase_durations[name] = stats.durations
+    baseline_phases = None
+    if baseline is not None:
+        baseline_phases = {name: PhaseStats(count=len(durations), total=sum(durations), durations=durations)
+                           for name, durations in baseline["phases"].items()}
+
+    print_scenarios(results, baseline["scenarios"] if baseline else {})
+    print(f"\nmax RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB (this process)\n")
+    print(format_report(phases, baseline_phases, args.threshold))
+
+    if args.save:
+        Path(args.save).write_text(json.dumps({"scenarios": results, "phases": phase_durations}, indent=2))
+    if baseline is not None:
+        regressions = find_regressions(results, baseline["scenarios"], args.threshold)
+        regressions += [f"{name} p50" for name in tracing.find_regressions(phases, baseline_phases, args.threshold)]
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000], help="Products of the generated listings")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario")
+    parser.add_argument("--only", nargs="+", help="Scenarios to run, e.g. form products_1000")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Measure the peak Python memory of each run, slows the runs down")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Results saved by a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="Relative slowdown counted as a regression")
+    parser.add_argument("--channel", type=str, default=None, help="Browser channel, e.g. chrome")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,205 @@
+"""
+Times the element marking script on synthetic pages of different DOM sizes.
+
+The pages are generated into a temporary directory and loaded from local files, no network is used.
+With --compare-legacy the script is also timed against the previous implementation
+(benchmarks/legacy/mark_borders.js) and both are checked to mark the same elements.
+The "re-mark" column times a second pass after a small change to the page, where the incremental
+script only walks the changed subtree. With --compare-legacy, that pass is also checked to keep the ids of the
+elements marked before the change, and to give the new element an id of its own.
+With --frames, a whole marking of pages embedding that many iframes (half of them hidden) is timed too, as the
+sync environment does it, the hidden frames are skipped. The "every frame" column is the baseline, one marking call
+in each frame one after another without the visibility check.
+
+    python benchmarks/mark_elements.py --sizes 1000 10000 100000 --repeat 3 --compare-legacy --frames 1 10 30
+"""
+import argparse
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+from playwright.sync_api import sync_playwright
+from pywebagent.env.marking import MARK_JS, mark_frames
+from pywebagent.env.scripts import load_js_script
+
+BENCHMARKS_DIRECTORY = Path(__file__).parent
+
+# Returns the marked elements as (marking id, benchmark id) pairs
+MARKED_ELEMENTS_JS = """() => [...document.querySelectorAll('[aria-label*="item_id__"]')]
+    .map(e => [Number(e.getAttribute('aria-label').match(/item_id__(\\d+)__/)[1]), e.dataset.benchId])
+    .sort((a, b) => a[0] - b[0])"""
+
+# A small change, like typing into a field shows a suggestion next to it
+CHANGE_PAGE_JS = """() => {
+    const card = document.querySelector('.section .card');
+    const button = document.createElement('button');
+    button.textContent = 'Suggestion';
+    card.appendChild(button);
+}"""
+
+
+def generate_page(num_nodes: int, seed: int = 0) -> str:
+    """A long product listing with nested cards, hidden sections and overlays, about `num_nodes` elements."""
+    rng = random.Random(seed)
+    parts = ["<!DOCTYPE html><html><head><style>",
+             ".card{display:inline-block;width:180px;margin:6px;vertical-align:top;border:1px solid #ddd}",
+             ".card a,.card button{cursor:pointer}.hidden{display:none}",
+             ".overlay{position:absolute;top:0;left:0;width:100%;height:40px;background:#fff8}",
+             "</style></head><body>"]
+    count = 0
+
+    def bench_id():
+        nonlocal count
+        count += 1
+        return f'data-bench-id="{count}"'
+
+    while count < num_nodes:
+        section_hidden = rng.random() < 0.1
+        parts.append(f'<div {bench_id()} class="{"hidden" if section_hidden else "section"}">')
+        for _ in range(rng.randint(5, 20)):
+            parts.append(f'<div {bench_id()} class="card" style="position:relative">')
+            parts.append(f'<img {bench_id()} width="160" height="{rng.randint(60, 120)}">')
+            parts.append(f'<a {bench_id()} href="#p{count}"><span {bench_id()}>Product {count}</span></a>')
+            depth = rng.randint(0, 4)
+            for _ in range(depth):
+                parts.append(f'<div {bench_id()}>')
+            parts.append(f'<span {bench_id()}>${rng.randint(1, 500)}</span>')
+            parts.append(f'<button {bench_id()}>Add to cart</button>')
+            if rng.random() < 0.3:
+                parts.append(f'<input {bench_id()} type="number" value="1" style="width:40px">')
+            parts.append("</div>" * depth)
+            if rng.random() < 0.1:
+                parts.append(f'<div {bench_id()} class="overlay"></div>')
+            parts.append("</div>")
+        parts.append("</div>")
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def generate_frames_page(num_frames: int) -> str:
+    """A small page embedding `num_frames` iframes with a few buttons each, every other one is hidden."""
+    frame = "<button>Buy</button><a href='#'>Details</a><input placeholder='Quantity'>"
+    parts = ["<!DOCTYPE html><html><body><button>Main</button>"]
+    for index in range(num_frames):
+        style = "display:none" if index % 2 else "width:300px;height:120px"
+        parts.append(f'<iframe style="{style}" srcdoc="{frame}"></iframe>')
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def time_script(page, url: str, script: str, repeat: int, options: dict = None):
+    """
+    Times a legacy script evaluated as a whole, or, with `options`, the marker installed by `script`.
+    Returns the marked elements of the first pass and of the re-mark.
+    """
+    timings = []
+    remark_timings = []
+    marked = remarked = None
+
+    def mark(next_id: int) -> int:
+        if options is None:
+            page.evaluate(script)
+            return 0
+        return page.evaluate(MARK_JS, {**options, "nextId": next_id})["nextId"]
+
+    for _ in range(repeat):
+        page.goto(url)
+        if options is not None:
+            page.evaluate(script)
+        start = time.perf_counter()
+        next_id = mark(0)
+        timings.append(time.perf_counter() - start)
+        marked = page.evaluate(MARKED_ELEMENTS_JS)
+
+        page.evaluate(CHANGE_PAGE_JS)
+        start = time.perf_counter()
+        mark(next_id)  # as the environment does, new elements get ids after the ones already given
+        remark_timings.append(time.perf_counter() - start)
+        remarked = page.evaluate(MARKED_ELEMENTS_JS)
+    return timings, remark_timings, marked, remarked
+
+
+def check_ids_unchanged(marked: list, remarked: list) -> Optional[str]:
+    """What went wrong if the re-mark gave another id to an element marked before, or an old id to a new element."""
+    ids = {bench_id: element_id for element_id, bench_id in marked}
+    for element_id, bench_id in remarked:
+        if bench_id in ids and ids[bench_id] != element_id:
+            return f"element {bench_id} had id {ids[bench_id]} before the change and {element_id} after"
+        if bench_id not in ids and element_id in ids.values():
+            return f"the added element got id {element_id}, already given before the change"
+    if not any(bench_id not in ids for _, bench_id in remarked):
+        return "the added element was not marked"
+    return None
+
+
+def time_frames(page, url: str, script: str, repeat: int):
+    """Times marking all the frames of the page, as the environment does, and marking every frame."""
+    timings = []
+    baseline_timings = []
+    for _ in range(repeat):
+        page.goto(url)
+        start = time.perf_counter()
+        result = mark_frames(page.frames, 0, False, script)
+        timings.append(time.perf_counter() - start)
+
+        page.goto(url)
+        start = time.perf_counter()
+        next_id = 0
+        for frame in page.frames:
+            next_id = frame.evaluate(MARK_JS, {"nextId": next_id, "incremental": False})["nextId"]
+        baseline_timings.append(time.perf_counter() - start)
+    return timings, baseline_timings, result
+
+
+def main(args):
+    script = load_js_script("mark_borders.js")
+    scripts = {
+        "current": (script, {"nextId": 0, "incremental": False}),
+        "incremental": (script, {"nextId": 0, "incremental": True}),
+    }
+    if args.compare_legacy:
+        scripts["legacy"] = ((BENCHMARKS_DIRECTORY / "legacy" / "mark_borders.js").read_text(), None)
+
+    with tempfile.TemporaryDirectory() as directory, sync_playwright() as playwright:
+        browser = playwright.chromium.launch(channel=args.channel, headless=True)
+        page = browser.new_page(viewport={"width": 1600, "height": 900})
+        print(f"{'nodes':>8} {'script':>11} {'median (ms)':>12} {'min (ms)':>10} {'re-mark (ms)':>13} {'marked':>7}")
+        for size in args.sizes:
+            path = Path(directory) / f"page_{size}.html"
+            path.write_text(generate_page(size))
+            results = {}
+            for name, (source, options) in scripts.items():
+                timings, remark_timings, marked, remarked = time_script(
+                    page, path.as_uri(), source, args.repeat, options)
+                results[name] = marked
+                problem = check_ids_unchanged(marked, remarked) if args.compare_legacy and options else None
+                if problem is not None:
+                    raise SystemExit(f"The {name} re-mark of the {size} nodes page changed ids: {problem}")
+                print(f"{size:>8} {name:>11} {statistics.median(timings) * 1000:>12.1f} "
+                      f"{min(timings) * 1000:>10.1f} {statistics.median(remark_timings) * 1000:>13.1f} {len(marked):>7}")
+            if args.compare_legacy and results["current"] != results["legacy"]:
+                raise SystemExit(f"Marked elements differ from the legacy script on the {size} nodes page")
+        if args.frames:
+            page.add_init_script(script)
+            print(f"\n{'frames':>8} {'skipped':>8} {'median (ms)':>12} {'min (ms)':>10} {'every frame (ms)':>17} "
+                  f"{'marked':>7}")
+        for num_frames in args.frames:
+            path = Path(directory) / f"frames_{num_frames}.html"
+            path.write_text(generate_frames_page(num_frames))
+            timings, baseline_timings, result = time_frames(page, path.as_uri(), script, args.repeat)
+            marked = sum(len(elements) for elements in result.elements.values())
+            print(f"{num_frames:>8} {result.skipped_frames:>8} {statistics.median(timings) * 1000:>12.1f} "
+                  f"{min(timings) * 1000:>10.1f} {statistics.median(baseline_timings) * 1000:>17.1f} {marked:>7}")
+        browser.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="DOM sizes to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size")
+    parser.add_argument("--compare-legacy", action="store_true", help="Also run the previous implementation and compare results")
+    parser.add_argument("--frames", type=int, nargs="*", default=[], help="Numbers of iframes to benchmark")
+    parser.add_argument("--channel", type=str, default=None, help="Browser channel, e.g. chrome")
+    main(parser.parse_args())
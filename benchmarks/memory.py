@@ -0,0 +1,146 @@
+"""
+Memory benchmark: the resident memory of a long-lived process running thousands of agent steps.
+
+The agent loop runs with a `ScriptedBackend` on a synthetic environment, which builds each observation like
+`BrowserEnv` does (marker output merged into marked element records, an encoded screenshot of `--screenshot-kb`,
+a fresh `EnvState` per run) without a browser, so only the memory kept by the Python side is measured. The
+environment keeps the observations of the current run, as a caller saving a run's screenshots would, and with a
+`SpillStore` the ones before the last are moved to disk. RSS is sampled after each run, the benchmark fails if it
+grew by more than `--max-growth-mb` after the first runs:
+
+    python benchmarks/memory.py --runs 100 --steps 30
+    python benchmarks/memory.py --runs 100 --steps 30 --no-spill  # screenshots of the current run stay in memory
+"""
+import argparse
+import base64
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from pywebagent.agent import Task, run_agent
+from pywebagent.env.actions import Actions, EnvState, new_log_history
+from pywebagent.env.browser import WebpageObservation
+from pywebagent.env.marking import MarkingResult, merge_frame_elements
+from pywebagent.env.screenshot import Screenshot
+from pywebagent.env.spill import SpillStore
+from pywebagent.llm import LLMClient, RateLimiter, ScriptedBackend, set_client
+from pywebagent.progress import ProgressConfig
+
+WARMUP_FRACTION = 0.1  # of the runs, before RSS is expected to be flat
+MAX_GROWTH_MB = 16.0
+
+
+def rss_bytes() -> int:
+    """The current resident memory of this process, the peak where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SyntheticPage:
+    """The page and main frame of a synthetic site, every scroll shows new elements."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.name = ""
+        self.position = 0
+
+    def evaluate(self, expression, arg=None):
+        self.position += 1 if "-" not in expression else -1
+
+
+class SyntheticEnv:
+    def __init__(self, elements: int, screenshot_kb: int, spill_store: SpillStore = None):
+        self.elements = elements
+        self.screenshot_kb = screenshot_kb
+        self.spill_store = spill_store
+        self.sub_agent_runner = None
+        self.observations = []  # of the current run
+
+    def reset(self, url) -> WebpageObservation:
+        self.page = SyntheticPage(url)
+        self.env_state = EnvState()
+        self.observations = []
+        self._next_element_id = 0
+        return self.get_observation()
+
+    def step(self, code: str, marked_elements: dict) -> WebpageObservation:
+        self.env_state.log_history = new_log_history()
+        exec(code, {"actions": Actions(self.page, marked_elements, self.env_state)})
+        self.env_state.timeframe += 1
+        return self.get_observation()
+
+    def get_observation(self) -> WebpageObservation:
+        metadata = [{"id": self._next_element_id + i, "tag": "BUTTON", "role": "button", "region": "center",
+                     "name": f"Product {self.page.position}-{i}", "label": f"Add product {self.page.position}-{i}",
+                     "bbox": {"x": 10 * i, "y": 20 * i, "width": 80, "height": 20}} for i in range(self.elements)]
+        self._next_element_id += self.elements
+        marked_elements = merge_frame_elements([self.page], MarkingResult(elements={0: metadata}))
+        data = os.urandom(self.screenshot_kb * 1024)
+        image = Screenshot(data, "jpeg", 1600, 900, encoded=base64.b64encode(data).decode())
+        observation = WebpageObservation(url=f"{self.page.url}?page={self.page.position}", error_message=None,
+                                         screenshot=data, image=image, marked_elements=marked_elements,
+                                         env_state=self.env_state)
+        if self.spill_store is not None and self.observations:
+            self.observations[-1].spill(self.spill_store)
+        self.observations.append(observation)
+        return observation
+
+    def close(self):
+        pass
+
+
+def scripted_run(steps: int) -> list:
+    code = "actions.scroll('down', 'Looking for the product')"
+    responses = [f"Reasoning:\nKeep looking.\n\nCode:\n```python\n{code}\n```"] * (steps - 1)
+    responses.append("Reasoning:\nFound it.\n\nCode:\n```python\nactions.finish(True, {}, 'Found the product')\n```")
+    return responses
+
+
+def main(args) -> int:
+    spill_store = None if args.no_spill else SpillStore(tempfile.mkdtemp(prefix="pywebagent-memory-"))
+    env = SyntheticEnv(args.elements, args.screenshot_kb, spill_store)
+    samples = []
+    start = time.perf_counter()
+    for run in range(args.runs):
+        set_client(LLMClient(ScriptedBackend(scripted_run(args.steps)), limiter=RateLimiter(), max_retries=0))
+        result = run_agent(env, "https://shop.example.com/", Task("Find the product", {}), max_actions=args.steps,
+                           progress_config=ProgressConfig(enabled=False))
+        if not result.succeeded:
+            print(f"Run {run} did not succeed: {result.reason}", file=sys.stderr)
+            return 1
+        samples.append(rss_bytes())
+    elapsed = time.perf_counter() - start
+
+    warmup = max(1, int(args.runs * WARMUP_FRACTION))
+    baseline = statistics.median(samples[:warmup]) / 2 ** 20
+    final = statistics.median(samples[-warmup:]) / 2 ** 20
+    steps = args.runs * args.steps
+    print(f"{steps} steps in {elapsed:.1f} s ({steps / elapsed:.0f} steps/s), spill store: {spill_store is not None}")
+    print(f"{'steps':>8} {'RSS MB':>8}")
+    for run in range(0, args.runs, max(1, args.runs // 10)):
+        print(f"{(run + 1) * args.steps:>8} {samples[run] / 2 ** 20:>8.1f}")
+    print(f"\nRSS after warm-up {baseline:.1f} MB, at the end {final:.1f} MB, peak {max(samples) / 2 ** 20:.1f} MB")
+    if spill_store is not None:
+        print(f"spill store: {spill_store.size / 2 ** 20:.1f} MB on disk")
+        spill_store.close()
+    if final - baseline > args.max_growth_mb:
+        print(f"\nRSS grew by {final - baseline:.1f} MB, more than {args.max_growth_mb} MB")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=100, help="Agent runs, each one resets the environment")
+    parser.add_argument("--steps", type=int, default=30, help="Steps per run")
+    parser.add_argument("--elements", type=int, default=200, help="Marked elements per observation")
+    parser.add_argument("--screenshot-kb", type=int, default=150, help="Size of each screenshot")
+    parser.add_argument("--no-spill", action="store_true", help="Keep the screenshots of the current run in memory")
+    parser.add_argument("--max-growth-mb", type=float, default=MAX_GROWTH_MB,
+                        help="RSS growth after the warm-up counted as a leak")
+    sys.exit(main(parser.parse_args()))
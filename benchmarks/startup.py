@@ -0,0 +1,131 @@
+"""
+Cold start benchmark: how long a fresh process takes to import the package and to get its first observation.
+
+Each measurement runs in a new interpreter, like `run.py` or a batch worker would, and excludes the start of the
+interpreter itself. The first observation is measured with a browser launched by the process, and with a browser
+kept warm by `python -m pywebagent.env.server` which the process connects to. Save the results to compare a later
+run against them:
+
+    python benchmarks/startup.py --save baseline.json
+    python benchmarks/startup.py --baseline baseline.json  # exits with 1 if something regressed
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+from typing import Dict, List
+
+REGRESSION_THRESHOLD = 0.2
+IMPORT_CODE = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+FIRST_OBSERVATION_CODE = """
+import time
+start = time.perf_counter()
+from pywebagent.env.browser import BrowserEnv
+env = BrowserEnv(headless=True)
+env.reset("data:text/html,<button>Start</button>")
+print(time.perf_counter() - start)
+env.close()
+"""
+
+
+def time_in_new_process(code: str, env: dict = None) -> float:
+    """Runs `code` in a new interpreter, it prints the seconds it measured."""
+    output = subprocess.run([sys.executable, "-c", code], env={**os.environ, **(env or {})},
+                            check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def import_breakdown(module: str, top: int = 8) -> List[tuple]:
+    """The modules with the largest cumulative import time, from `python -X importtime`."""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+            _, cumulative, name = line.split("|")
+            rows.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(rows, key=lambda row: -row[1])[:top]
+
+
+def start_browser_server(channel: str):
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([sys.executable, "-m", "pywebagent.env.server", "--port", str(port), "--channel", channel],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    endpoint = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"{endpoint}/json/version", timeout=1).read()
+            return process, endpoint
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("The browser server did not start")
+
+
+def measure(repeat: int, channel: str) -> Dict[str, List[float]]:
+    timings = {
+        f"import {module}": [time_in_new_process(IMPORT_CODE.format(module=module)) for _ in range(repeat)]
+        for module in ("pywebagent", "pywebagent.agent")
+    }
+    timings["first observation, launch"] = [time_in_new_process(FIRST_OBSERVATION_CODE) for _ in range(repeat)]
+    server, endpoint = start_browser_server(channel)
+    try:
+        timings["first observation, server"] = [
+            time_in_new_process(FIRST_OBSERVATION_CODE, {"PYWEBAGENT_BROWSER_ENDPOINT": endpoint}) for _ in range(repeat)]
+    finally:
+        server.terminate()
+        server.wait()
+    return timings
+
+
+def main(args) -> int:
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+    timings = measure(args.repeat, args.channel)
+
+    print(f"{'measurement':<28} {'p50 ms':>9} {'min ms':>9} {'vs base':>8}")
+    regressions = []
+    for name, values in timings.items():
+        median = statistics.median(values)
+        change = ""
+        if baseline and name in baseline:
+            before = statistics.median(baseline[name])
+            change = f"{median / before - 1:+.0%}"
+            if median > before * (1 + args.threshold):
+                regressions.append(f"{name} {before * 1000:.0f} ms -> {median * 1000:.0f} ms")
+        print(f"{name:<28} {median * 1000:>9.1f} {min(values) * 1000:>9.1f} {change:>8}")
+
+    print("\nslowest imports of pywebagent.agent:")
+    for name, seconds in import_breakdown("pywebagent.agent"):
+        print(f"  {name:<40} {seconds * 1000:>8.1f} ms")
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(timings, indent=2))
+    if regressions:
+        print("\nRegressions:\n" + "\n".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="Processes per measurement")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Results saved by a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="Relative slowdown counted as a regression")
+    parser.add_argument("--channel", type=str, default="chrome",
+                        help="Browser channel of the server, the one BrowserEnv launches by default")
+    sys.exit(main(parser.parse_args()))
@@ -1 +1,9 @@
-from .agent import act
\ No newline at end of file
+def __getattr__(name):
+    # Imported on first use, so `import pywebagent` (and its light modules, e.g. in worker processes) stays cheap
+    if name == "act":
+        from .agent import act
+        return act
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ["act"]
@@ -1,11 +1,17 @@
-import base64
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from functools import partial
 import json
-import time
 import logging
+import re
+from typing import Any, NamedTuple
 from pywebagent.env.browser import BrowserEnv
-from langchain.schema import HumanMessage, SystemMessage
-from langchain.chat_models import ChatOpenAI
+from pywebagent.env.screenshot import Screenshot
+from pywebagent import tracing
+from pywebagent.llm import get_client
+from pywebagent.progress import SCROLL_CODE, Detection, ProgressConfig, ProgressMonitor
+from pywebagent.text_view import TextView, TextViewConfig, build_text_view
+from pywebagent.trajectory import TrajectoryRecorder
 
 logger = logging.getLogger(__name__)
 
@@ -17,26 +23,99 @@ class Task:
         self.task = task
         self.args = args
 
-def get_llm():
-    return ChatOpenAI(
-        model_name="gpt-4-vision-preview",
-        temperature=1, 
-        request_timeout=120, 
-        max_tokens=2000,
+
+class _AgentResultFields(NamedTuple):
+    status: TASK_STATUS
+    output: Any
+
+
+class AgentResult(_AgentResultFields):
+    """
+    Unpacks as `status, output`, like it always did.
+    `reason` tells why the run ended: the model's reason, a progress diagnostic or the step limit.
+    """
+
+    def __new__(cls, status: TASK_STATUS, output: Any, reason: str = None):
+        result = super().__new__(cls, status, output)
+        result.reason = reason
+        return result
+
+    def __reduce__(self):
+        return AgentResult, (self.status, self.output, self.reason)
+
+    @property
+    def succeeded(self) -> bool:
+        return self.status == TASK_STATUS.SUCCESS
+
+
+def _format_elements(observation, element_ids):
+    return ', '.join([f"({str(i)}) - <{observation.marked_elements[i]['tag'].lower()}>" for i in element_ids])
+
+
+def format_marked_elements(observation):
+    """
+    All marked elements, each request is answered without the previous ones.
+    When the prompt doesn't carry a full screenshot, the elements added and removed by the last action are listed too.
+    """
+    elements = "Marked elements tags:\n" + _format_elements(observation, observation.marked_elements)
+    delta = observation.delta
+    if delta is None or delta.image_mode == "full":
+        return elements
+    return (
+        f"{elements}\n"
+        f"Marked elements added since the last action:\n{_format_elements(observation, observation.added_element_ids)}\n"
+        f"Marked elements removed since the last action: {observation.removed_element_ids}"
     )
 
-def generate_user_message(task, observation):
+
+def _image_content(image):
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": image.data_url,  # base64 encoded once per observation
+            "detail": image.detail, # low, high or auto
+        },
+    }
+
+
+def get_image_contents(observation):
+    """The full screenshot, or with a delta what changed since the last action and a smaller image of the page."""
+    delta = observation.delta
+    if delta is None or delta.image_mode == "full":
+        image = observation.image
+        if image is None:
+            image = Screenshot(observation.screenshot, "png", width=0, height=0)
+        return "", [_image_content(image)]
+    if delta.image_mode == "crop":
+        note = "Only the part of the page that changed since the last action is attached in full detail."
+        images = [delta.crop]
+    else:
+        note = "The page did not visibly change since the last action."
+        images = []
+    if delta.keyframe is not None:
+        note += " A smaller image of the whole page is attached" + (" after it." if images else ".")
+        images.append(delta.keyframe)
+    return note, [_image_content(image) for image in images]
+
+
+def generate_user_message(task, observation, hint=None, text_view: TextView = None):
+    """With a `text_view`, the page is described by its elements list instead of the screenshot."""
     log_history = '\n'.join(observation.env_state.log_history if observation.env_state.log_history else [])
-    marked_elements_tags = ', '.join([f"({str(i)}) - <{elem['tag'].lower()}>" for i, elem in observation.marked_elements.items()])
+    if text_view is not None:
+        marked_elements = "Interactive elements of the page, by region of the screen:\n" + text_view.text
+        screenshot_note, image_contents = "", []
+    else:
+        marked_elements = format_marked_elements(observation)
+        screenshot_note, image_contents = get_image_contents(observation)
+    warning = f"Warning:\n        {hint}\n\n        " if hint else ""  # the run stopped making progress
     text_prompt = f"""
         Execution error: 
         {observation.error_message}
 
-        URL: 
+        {warning}URL: 
         {observation.url}
 
-        Marked elements tags:
-        {marked_elements_tags}
+        {marked_elements}
         
         Task: 
         {task.task}
@@ -47,26 +126,54 @@ def generate_user_message(task, observation):
         Task Arguments:
         {json.dumps(task.args, indent=4)}
         
+        {screenshot_note}
     """
 
-    screenshot_binary = observation.screenshot
-    base64_image = base64.b64encode(screenshot_binary).decode('utf-8')
-    image_content = {
-        "type": "image_url",
-        "image_url": {
-            "url": f"data:image/jpeg;base64,{base64_image}",
-            "detail": "high", # low, high or auto
-        },
-    }
     text_content = {"type": "text", "text": text_prompt}
         
-    return HumanMessage(content=[text_content, image_content])
+    from langchain.schema import HumanMessage  # langchain is slow to import, only load it once a prompt is built
+
+    return HumanMessage(content=[text_content, *image_contents])
 
 
-def generate_system_message():
-    system_prompt = """
+PLAN_MODE_FUNCTIONS = """
+    - actions.click_text(text, log_message) # click the button or link showing this text, for pages reached earlier in the same code block whose elements have no ids yet
+    - actions.input_text_by_label(label, text, clear_before_input, log_message) # type in the field with this label or placeholder, for pages reached earlier in the same code block
+    - actions.expect_url(substring, log_message) # check that the URL contains substring
+    - actions.expect_text(text, log_message) # check that the text is visible on the page
+    - actions.expect_value(element_id, value, log_message) # check that the field has this value"""
+
+SINGLE_ACTION_RULES = """
+    IMPORTANT: ONLY ONE WEBPAGE FUNCTION CALL IS ALLOWED, EXCEPT FOR FORMS WHERE MULTIPLE CALLS ARE ALLOWED TO FILL MULTIPLE FIELDS! NOTHING IS ALLOWED AFTER THE "```" ENDING THE CODE BLOCK"""
+
+PLAN_MODE_RULES = """
+    IMPORTANT: WHEN THE NEXT FEW ACTIONS ARE PREDICTABLE (FOR EXAMPLE SEARCH, OPEN A RESULT, ADD IT TO THE CART), WRITE THEM ALL IN ONE CODE BLOCK AS A PLAN.
+    After every action that should change the page, call an expect function describing what must be true before the plan goes on.
+    The plan runs without you and stops at the first expectation that does not hold, you then see the page again with the error.
+    Element ids are only valid on the current page: after an action that navigates, use click_text and input_text_by_label.
+    End the plan where you can no longer predict the page. NOTHING IS ALLOWED AFTER THE "```" ENDING THE CODE BLOCK"""
+
+
+def generate_system_message(plan_mode=False, text_mode=False):
+    """
+    With `plan_mode`, the model may return several actions checked by expectations, instead of a single one.
+    With `text_mode`, the page is described by a list of its elements instead of a screenshot.
+    """
+    functions = PLAN_MODE_FUNCTIONS if plan_mode else ""
+    page_view = "a list of the interactive elements of the webpage" if text_mode else "a screenshot of the webpage"
+    element_ids = (
+        "element_id is always an integer, the number in brackets before each element of the list."
+        if text_mode else
+        "element_id is always an integer, and is visible as a green label with white number around the TOP-LEFT CORNER "
+        "OF EACH ELEMENT. Make sure to examine all green highlighted elements before choosing one to interact with."
+    )
+    cues = "THE ELEMENTS LIST" if text_mode else "THE SCREENSHOTS"
+    interpreted = "the elements list of the page" if text_mode else "the attached screenshot image"
+    rules = PLAN_MODE_RULES if plan_mode else SINGLE_ACTION_RULES
+    webpage_calls = "webpage function calls, each followed by an expect call" if plan_mode else "a single webpage function call."
+    system_prompt = f"""
     You are an AI agent that controls a webpage using python code, in order to achieve a task.
-    You are provided a screenshot of the webpage at each timeframe, and you decide on the next python line to execute.
+    You are provided {page_view} at each timeframe, and you decide on the next python line to execute.
     You can use the following functions:
     - actions.click(element_id, log_message) # click on an element
     - actions.input_text(element_id, text, clear_before_input, log_message) # Use clear_before_input=True to replace the text instead of appending to it. Never use this method on a combobox.
@@ -76,60 +183,124 @@ def generate_system_message():
     - actions.finish(did_succeed, output: dict, reason) # the task is complete with did_succeed=True or False, and a text reason. output is optional dictionary of output values if the task succeeded.
     - actions.act(url: str, task: str, log_message, **kwargs) # run another agent on a different webpage. The sub-agent will run until it finishes and will output a result which you can use later. Useful for getting auth details from email for example.
                                                               # task argument should be described in natural language. kwargs are additional arguments the sub-agent needs to complete the task. YOU MUST PROVIDE ALL NEEDED ARGUMENTS, OTHERWISE THE SUB-AGENT WILL FAIL.
-    element_id is always an integer, and is visible as a green label with white number around the TOP-LEFT CORNER OF EACH ELEMENT. Make sure to examine all green highlighted elements before choosing one to interact with.
+    - actions.act_many(sub_tasks: list, log_message) # run several sub-agents at once, when more than one side lookup is needed. sub_tasks is a list of dicts with the keys "url", "task" and "args" (a dict of the sub-agent arguments). Returns the list of outputs, in the same order.{functions}
+    {element_ids}
     log_message is a short one sentence explanation of what the action does.
     Do not use keyword arguments, all arguments are positional.
 
-    
-    IMPORTANT: ONLY ONE WEBPAGE FUNCTION CALL IS ALLOWED, EXCEPT FOR FORMS WHERE MULTIPLE CALLS ARE ALLOWED TO FILL MULTIPLE FIELDS! NOTHING IS ALLOWED AFTER THE "```" ENDING THE CODE BLOCK
-    IMPORTANT: LOOK FOR CUES IN THE SCREENSHOTS TO SEE WHAT PARTS OF THE TASK ARE COMPLETED AND WHAT PARTS ARE NOT. FOR EXAMPLE, IF YOU ARE ASKED TO BUY A PRODUCT, LOOK FOR CUES THAT THE PRODUCT IS IN THE CART.
+    {rules}
+    IMPORTANT: LOOK FOR CUES IN {cues} TO SEE WHAT PARTS OF THE TASK ARE COMPLETED AND WHAT PARTS ARE NOT. FOR EXAMPLE, IF YOU ARE ASKED TO BUY A PRODUCT, LOOK FOR CUES THAT THE PRODUCT IS IN THE CART.
     Response format:
 
     Reasoning:
-    Explanation for the next action, particularly focusing on interpreting the attached screenshot image.
+    Explanation for the next action, particularly focusing on interpreting {interpreted}.
 
     Code:
     ```python
     # variable definitions and non-webpage function calls are allowed
     ...
-    # a single webpage function call. 
+    # {webpage_calls}
     actions.func_name(args..)
     ```
     """
+    from langchain.schema import SystemMessage
+
     return SystemMessage(content=system_prompt)
 
 
+class CodeBlockParser:
+    """
+    Finds the code block of a response while it is streamed.
+    `feed` returns True once the closing fence arrived, anything generated after it is not needed.
+    """
+
+    START_PATTERN = re.compile(r"Code:[ \t]*\n```(?:python|py)?[ \t]*\n")
+    START_PATTERN_MAX_LENGTH = 32  # a match may straddle chunks, rescan this much of the previous text
+    FENCE = "```"
+
+    def __init__(self):
+        self.text = ""
+        self.code_start = None
+        self.code = None
+        self._scanned = 0
+
+    def feed(self, chunk: str) -> bool:
+        if self.code is not None:
+            return True
+        self.text += chunk
+        if self.code_start is None:
+            match = self.START_PATTERN.search(self.text, max(0, self._scanned - self.START_PATTERN_MAX_LENGTH))
+            if match is None:
+                self._scanned = len(self.text)
+                return False
+            self.code_start = self._scanned = match.end()
+        # The closing fence starts a line, possibly indented, possibly the first line of the block
+        position = max(self.code_start, self._scanned - len(self.FENCE))
+        while (position := self.text.find(self.FENCE, position)) != -1:
+            line_start = max(self.code_start, self.text.rfind("\n", 0, position) + 1)
+            if not self.text[line_start:position].strip(" \t"):
+                self.code = self.text[self.code_start:line_start]
+                return True
+            position += 1
+        self._scanned = len(self.text)
+        return False
+
+
 def extract_code(text):
     """
-    Extracts all text in a string following the pattern "'\nCode:\n".
+    Extracts the code block following "Code:" in a response.
+    Text after the closing fence is ignored, a block that was cut off before its fence is used as is.
     """
-    pattern = "\nCode:\n```python\n"
-    start_index = text.find(pattern)
-    if start_index == -1:
+    parser = CodeBlockParser()
+    if parser.feed(text):
+        return parser.code
+    if parser.code_start is None:
         raise Exception("Code not found")
-    
-    # Extract the text following the pattern, without the trailing "```"
-    extracted_text = text[start_index + len(pattern):-3] 
+    return text[parser.code_start:]
 
-    return extracted_text
+def prompt_sizes(user_message) -> dict:
+    """Trace attributes of a prompt: its text length, and the number and size of its images."""
+    text = [part["text"] for part in user_message.content if part["type"] == "text"]
+    images = [part["image_url"]["url"] for part in user_message.content if part["type"] == "image_url"]
+    return {"prompt_chars": sum(map(len, text)), "images": len(images), "image_chars": sum(map(len, images))}
 
-def calcualte_next_action(task, observation):
-    llm = get_llm()
+def select_text_view(observation, text_view_config: TextViewConfig = None, hint=None):
+    """
+    The text view of the page when it is enough for the next step, or None to send the screenshot,
+    and the reason why it isn't enough.
+    """
+    if text_view_config is None:
+        return None, None
+    text_view = build_text_view(observation.marked_elements, text_view_config)
+    reason = text_view.ambiguous or ("the run is stuck" if hint else None)
+    if reason:
+        logger.info(f"Sending the screenshot, the text view is not enough: {reason}")
+        return None, reason
+    return text_view, None
 
-    system_message = generate_system_message()
-    user_message = generate_user_message(task, observation)
 
-    try:
-        ai_message = llm([system_message, user_message])
-    except:
-        # This sometimes solves the RPM limit issue
-        logger.warning("Failed to get response from OpenAI, trying again in 30 seconds")
-        time.sleep(30)
-        ai_message = llm([system_message, user_message])
-        
-    logger.info(f"AI message: {ai_message.content}")
+def calcualte_next_action(task, observation, client=None, stream=True, plan_mode=False, hint=None,
+                          text_view_config=None):
+    text_view, fallback_reason = select_text_view(observation, text_view_config, hint)
+    client = client or (get_client(text_view_config.model) if text_view else get_client())
 
-    code_to_execute = extract_code(ai_message.content)
+    system_message = generate_system_message(plan_mode, text_mode=text_view is not None)
+    user_message = generate_user_message(task, observation, hint, text_view)
+
+    with tracing.span("agent.next_action", view="text" if text_view else "image", **prompt_sizes(user_message)) as span:
+        if fallback_reason:
+            span.set(text_view_fallback=fallback_reason)
+        # Rate limits and transient errors are retried by the client.
+        # When streaming, the generation is stopped as soon as the code block is complete.
+        if stream:
+            ai_message = client.stream([system_message, user_message], lambda: CodeBlockParser().feed)
+        else:
+            ai_message = client.complete([system_message, user_message])
+            
+        logger.info(f"AI message: {ai_message.content}")
+
+        code_to_execute = extract_code(ai_message.content)
+        span.set(response_chars=len(ai_message.content), code_chars=len(code_to_execute))
 
     return code_to_execute
      
@@ -141,19 +312,173 @@ def get_task_status(observation):
     else:
         return TASK_STATUS.IN_PROGRESS
 
-def act(url, task, max_actions=40, **kwargs):
-    task = Task(task=task, args=kwargs)
 
-    browser = BrowserEnv(headless=False)
-    observation = browser.reset(url) 
+def get_result(task_status, observation) -> AgentResult:
+    return AgentResult(task_status, observation.env_state.output, observation.env_state.reason)
+
+
+def stuck_result(observation, detection: Detection) -> AgentResult:
+    return AgentResult(TASK_STATUS.FAILED, observation.env_state.output, f"Stopped early: {detection.diagnostic}")
+
+
+def max_actions_result(observation, max_actions) -> AgentResult:
+    return AgentResult(TASK_STATUS.FAILED, observation.env_state.output,
+                       f"Reached {max_actions} actions without completing the task.")
+
+
+def check_progress(env, url, monitor: ProgressMonitor, action, observation):
+    """
+    Feeds a step to the progress monitor. When the run is stuck, scrolls or resets the page if that's the response.
+    Returns the observation to continue from and the detection, if any.
+    """
+    detection = monitor.observe(action, observation)
+    if detection is None:
+        return observation, None
+    with tracing.span("agent.stuck", kind=detection.kind, response=detection.response):
+        if detection.response == "scroll":
+            observation = env.step(SCROLL_CODE, observation.marked_elements)
+        elif detection.response == "reset":
+            observation = env.reset(url)
+    monitor.start(observation)
+    return observation, detection
+
+
+def run_agent(env, url, task, max_actions=40, recorder: TrajectoryRecorder = None, plan_mode=False,
+              progress_config: ProgressConfig = None, text_view_config: TextViewConfig = None) -> AgentResult:
+    """
+    Runs the agent loop on an environment that was not reset yet.
+    With a `recorder`, every step is recorded and recorded steps are replayed instead of calling the LLM.
+    With `plan_mode`, a step may run several actions, checked by their expectations without the LLM.
+    `progress_config` sets how runs that stopped making progress are detected, and steered or failed early.
+    With a `text_view_config`, steps get a text view of the page and a cheaper model unless it is ambiguous.
+    """
+    with tracing.span("agent.run", url=url, task=task.task) as run_span:
+        env.sub_agent_runner = partial(run_sub_agents, env, max_actions=max_actions, plan_mode=plan_mode,
+                                       progress_config=progress_config, text_view_config=text_view_config)
+        observation = env.reset(url) 
+        monitor = ProgressMonitor(progress_config)
+        monitor.start(observation)
+
+        result = None
+        hint = None
+        for i in range(max_actions):
+            with tracing.span("agent.step", step=i) as step_span:
+                action = recorder.recorded_code(observation) if recorder else None
+                replayed = action is not None
+                if not replayed:
+                    action = calcualte_next_action(task, observation, plan_mode=plan_mode, hint=hint,
+                                                   text_view_config=text_view_config)
+                previous_observation = observation
+                observation = env.step(action, observation.marked_elements)
+                if recorder:
+                    recorder.record(previous_observation, action, observation.error_message, replayed)
+                task_status = get_task_status(observation)
+                step_span.set(replayed=replayed, status=task_status.name)
+                if observation.error_message:
+                    step_span.record_error(observation.error_message)
+                detection = None
+                if task_status == TASK_STATUS.IN_PROGRESS:
+                    observation, detection = check_progress(env, url, monitor, action, observation)
+                hint = detection.hint if detection else None
+            if task_status in [TASK_STATUS.SUCCESS, TASK_STATUS.FAILED]:
+                result = get_result(task_status, observation)
+                break
+            if detection and detection.response == "fail":
+                result = stuck_result(observation, detection)
+                break
+        else:
+            logger.warning(f"Reached {i} actions without completing the task.")
+            result = max_actions_result(observation, max_actions)
+
+        if recorder:
+            recorder.finish(result.status)
+        run_span.set(status=result.status.name, steps=i + 1)
+        if result.reason:
+            run_span.set(reason=result.reason)
+    return result
 
-    for i in range(max_actions):
-        action = calcualte_next_action(task, observation) 
-        observation = browser.step(action, observation.marked_elements)
-        task_status = get_task_status(observation)
-        if task_status in [TASK_STATUS.SUCCESS, TASK_STATUS.FAILED]:
-            return task_status, observation.env_state.output
-    
-    logger.warning(f"Reached {i} actions without completing the task.")
-    return TASK_STATUS.FAILED, observation.env_state.output
 
+def run_sub_agents(parent_env, sub_tasks: list, max_actions=40, plan_mode=False, progress_config=None,
+                   text_view_config=None) -> list:
+    """
+    Runs sub-agents inside this process, each one in a new context of the parent's browser.
+    `sub_tasks` is a list of dicts with `url`, `task` and optional `args`.
+    The LLM calls of all sub-agents are made concurrently and their page work is interleaved,
+    so several side lookups take about as long as the slowest one.
+    """
+    tasks = [Task(task=sub_task["task"], args=sub_task.get("args", {})) for sub_task in sub_tasks]
+    envs = []
+    results = [None] * len(sub_tasks)
+    monitors = [ProgressMonitor(progress_config) for _ in sub_tasks]
+    hints = [None] * len(sub_tasks)
+    try:
+        observations = []
+        for sub_task, monitor in zip(sub_tasks, monitors):
+            env = parent_env.spawn()
+            envs.append(env)
+            env.sub_agent_runner = partial(run_sub_agents, env, max_actions=max_actions, plan_mode=plan_mode,
+                                           progress_config=progress_config, text_view_config=text_view_config)
+            observations.append(env.reset(sub_task["url"]))
+            monitor.start(observations[-1])
+
+        with ThreadPoolExecutor(max_workers=len(sub_tasks)) as executor:
+            for _ in range(max_actions):
+                running = [i for i, result in enumerate(results) if result is None]
+                if not running:
+                    break
+                actions = executor.map(tracing.bind(lambda i: calcualte_next_action(
+                    tasks[i], observations[i], plan_mode=plan_mode, hint=hints[i], text_view_config=text_view_config)), running)
+                for i, action in zip(running, actions):
+                    observations[i] = envs[i].step(action, observations[i].marked_elements)
+                    task_status = get_task_status(observations[i])
+                    if task_status in [TASK_STATUS.SUCCESS, TASK_STATUS.FAILED]:
+                        results[i] = get_result(task_status, observations[i])
+                        continue
+                    observations[i], detection = check_progress(
+                        envs[i], sub_tasks[i]["url"], monitors[i], action, observations[i])
+                    hints[i] = detection.hint if detection else None
+                    if detection and detection.response == "fail":
+                        results[i] = stuck_result(observations[i], detection)
+
+        for i, result in enumerate(results):
+            if result is None:
+                logger.warning(f"Sub agent reached {max_actions} actions without completing the task: {tasks[i].task}")
+                results[i] = max_actions_result(observations[i], max_actions)
+        return results
+    finally:
+        for env in envs:
+            env.close()
+
+
+def act(url, task, max_actions=40, pool=None, screenshot_config=None, delta_config=None, trajectory_store=None,
+        trajectory_mode="replay", network_policy=None, asset_cache=None, session_store=None, session_account="default",
+        plan_mode=False, progress_config=None, text_view_config=None, spill_store=None, **kwargs) -> AgentResult:
+    """
+    Runs the agent on `url` until the task is done or `max_actions` steps were taken.
+    Pass a `BrowserPool` as `pool` to run on a warm browser context instead of launching a new browser.
+    `screenshot_config` (a `ScreenshotConfig`) controls the encoding and size of the screenshots sent to the LLM.
+    With a `DeltaConfig` as `delta_config`, steps that barely changed the page send a cropped or no screenshot.
+    With a `TrajectoryStore` as `trajectory_store` the run is recorded, and in "replay" `trajectory_mode`
+    the steps of a previous successful run of the same task are reused while the pages match.
+    A `NetworkPolicy` as `network_policy` blocks ads, trackers and heavy resources, and an `AssetCache` as
+    `asset_cache` serves static assets from a cache on disk shared by all runs.
+    With a `SessionStore` as `session_store`, the run starts logged in as `session_account` when a previous
+    successful run saved its session for the site.
+    With `plan_mode`, the model may answer with several actions and expectations checked locally, so predictable
+    flows take fewer LLM calls.
+    A `ProgressConfig` as `progress_config` sets how a run that repeats itself or stalls is detected, and whether it
+    gets a hint, a scroll, a reset or fails early. The reason of the result tells why the run ended.
+    With a `TextViewConfig` as `text_view_config`, the model gets a text list of the page's elements and a cheaper
+    text model answers, the screenshot and the vision model are only used when the list is ambiguous.
+    A `SpillStore` as `spill_store` keeps the screenshots of past observations on disk instead of in memory.
+    """
+    task = Task(task=task, args=kwargs)
+    recorder = TrajectoryRecorder(trajectory_store, url, task, trajectory_mode) if trajectory_store else None
+    browser = BrowserEnv(headless=False, pool=pool, screenshot_config=screenshot_config, delta_config=delta_config,
+                         network_policy=network_policy, asset_cache=asset_cache, session_store=session_store,
+                         session_account=session_account, spill_store=spill_store)
+    try:
+        return run_agent(browser, url, task, max_actions, recorder=recorder, plan_mode=plan_mode,
+                         progress_config=progress_config, text_view_config=text_view_config)
+    finally:
+        browser.close()
@@ -0,0 +1,248 @@
+import asyncio
+from functools import partial
+import logging
+from pywebagent.agent import (
+    TASK_STATUS,
+    AgentResult,
+    CodeBlockParser,
+    Task,
+    extract_code,
+    generate_system_message,
+    generate_user_message,
+    get_result,
+    get_task_status,
+    max_actions_result,
+    prompt_sizes,
+    select_text_view,
+    stuck_result,
+)
+from pywebagent import tracing
+from pywebagent.env.async_browser import AsyncBrowserEnv
+from pywebagent.env.server import connect_browser, get_browser_endpoint
+from pywebagent.llm import get_client
+from pywebagent.progress import SCROLL_CODE, ProgressMonitor
+from pywebagent.trajectory import TrajectoryRecorder
+
+logger = logging.getLogger(__name__)
+
+SYNC_ONLY_OPTIONS = ("pool",)  # a BrowserPool drives the sync playwright API
+
+
+def reject_sync_only_options(options: dict) -> None:
+    """Options of the sync `act` the async agent can't honor would otherwise be taken for task arguments."""
+    for name in SYNC_ONLY_OPTIONS:
+        if name in options:
+            raise TypeError(f"The async agent does not support `{name}`, it only works with the sync API. "
+                            "AsyncAgentRunner runs its tasks in contexts of a single shared browser instead.")
+
+
+async def calcualte_next_action(task, observation, client=None, stream=True, plan_mode=False, hint=None,
+                                text_view_config=None):
+    text_view, fallback_reason = select_text_view(observation, text_view_config, hint)
+    client = client or (get_client(text_view_config.model) if text_view else get_client())
+
+    system_message = generate_system_message(plan_mode, text_mode=text_view is not None)
+    user_message = generate_user_message(task, observation, hint, text_view)
+
+    with tracing.span("agent.next_action", view="text" if text_view else "image", **prompt_sizes(user_message)) as span:
+        if fallback_reason:
+            span.set(text_view_fallback=fallback_reason)
+        # Rate limits and transient errors are retried by the client, waiting doesn't block other tasks.
+        # When streaming, the generation is stopped as soon as the code block is complete.
+        if stream:
+            ai_message = await client.astream([system_message, user_message], lambda: CodeBlockParser().feed)
+        else:
+            ai_message = await client.acomplete([system_message, user_message])
+
+        logger.info(f"AI message: {ai_message.content}")
+
+        code_to_execute = extract_code(ai_message.content)
+        span.set(response_chars=len(ai_message.content), code_chars=len(code_to_execute))
+
+    return code_to_execute
+
+
+class AsyncAgentRunner:
+    """
+    Runs many `act` tasks concurrently on a single browser process.
+    Each task gets its own browser context, LLM calls of one task overlap with page work of the others.
+    The options are those of the sync `act`, applied to every task, except `pool`.
+
+    Usage:
+        async with AsyncAgentRunner(max_concurrency=8) as runner:
+            results = await runner.act_many([
+                {"url": "https://example.com", "task": "...", "kwargs": {...}},
+                ...
+            ])
+    """
+
+    def __init__(self, max_concurrency: int = 8, headless: bool = True, network_policy=None, asset_cache=None,
+                 session_store=None, plan_mode=False, browser_endpoint=None, progress_config=None,
+                 text_view_config=None, spill_store=None, screenshot_config=None, delta_config=None,
+                 trajectory_store=None, trajectory_mode="replay"):
+        self.max_concurrency = max_concurrency
+        self.headless = headless
+        self.screenshot_config = screenshot_config
+        self.delta_config = delta_config
+        self.trajectory_store = trajectory_store  # records every task, and replays them in "replay" trajectory_mode
+        self.trajectory_mode = trajectory_mode
+        self.network_policy = network_policy
+        self.asset_cache = asset_cache  # shared by all the tasks
+        self.session_store = session_store
+        self.plan_mode = plan_mode
+        self.progress_config = progress_config  # how stuck runs are detected and handled
+        self.text_view_config = text_view_config  # describe pages as text to a cheaper model when possible
+        self.spill_store = spill_store  # shared by all the tasks, holds the screenshots of past observations
+        self.browser_endpoint = browser_endpoint  # connect to a running browser instead of launching one
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._playwright_context_manager = None
+        self.browser = None
+
+    async def start(self):
+        if self.browser is None:
+            from playwright.async_api import async_playwright
+
+            self._playwright_context_manager = async_playwright()
+            playwright = await self._playwright_context_manager.__aenter__()
+            endpoint = get_browser_endpoint(self.browser_endpoint)
+            if endpoint:
+                self.browser = await connect_browser(playwright.chromium, endpoint)
+            else:
+                self.browser = await playwright.chromium.launch(
+                    channel="chrome",
+                    headless=self.headless,
+                )
+        return self
+
+    async def close(self):
+        if self.browser is not None:
+            await self.browser.close()
+            self.browser = None
+            await self._playwright_context_manager.__aexit__(None, None, None)
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def act(self, url, task, max_actions=40, session_account="default", **kwargs):
+        reject_sync_only_options(kwargs)
+        await self.start()
+        task = Task(task=task, args=kwargs)
+        async with self._semaphore:
+            env = AsyncBrowserEnv(browser=self.browser, network_policy=self.network_policy, asset_cache=self.asset_cache,
+                                  session_store=self.session_store, session_account=session_account,
+                                  spill_store=self.spill_store, screenshot_config=self.screenshot_config,
+                                  delta_config=self.delta_config)
+            recorder = (TrajectoryRecorder(self.trajectory_store, url, task, self.trajectory_mode)
+                        if self.trajectory_store else None)
+            try:
+                return await _run_task(env, url, task, max_actions, self.plan_mode,
+                                       self.progress_config, self.text_view_config, recorder)
+            finally:
+                await env.close()
+
+    async def act_many(self, tasks: list, return_exceptions: bool = True):
+        """
+        Runs the given tasks concurrently, at most `max_concurrency` at a time.
+        Each task is a dict with `url`, `task` and optionally `max_actions`, `session_account` and `kwargs`.
+        """
+        coroutines = [
+            self.act(t["url"], t["task"], t.get("max_actions", 40), t.get("session_account", "default"), **t.get("kwargs", {}))
+            for t in tasks
+        ]
+        return await asyncio.gather(*coroutines, return_exceptions=return_exceptions)
+
+
+async def check_progress(env, url, monitor: ProgressMonitor, action, observation):
+    """Async version of `pywebagent.agent.check_progress`."""
+    detection = monitor.observe(action, observation)
+    if detection is None:
+        return observation, None
+    with tracing.span("agent.stuck", kind=detection.kind, response=detection.response):
+        if detection.response == "scroll":
+            observation = await env.step(SCROLL_CODE, observation.marked_elements)
+        elif detection.response == "reset":
+            observation = await env.reset(url)
+    monitor.start(observation)
+    return observation, detection
+
+
+async def _run_task(env, url, task, max_actions, plan_mode=False, progress_config=None,
+                    text_view_config=None, recorder: TrajectoryRecorder = None) -> AgentResult:
+    with tracing.span("agent.run", url=url, task=task.task) as run_span:
+        env.sub_agent_runner = partial(run_sub_agents, env, max_actions=max_actions, plan_mode=plan_mode,
+                                       progress_config=progress_config, text_view_config=text_view_config)
+        observation = await env.reset(url)
+        monitor = ProgressMonitor(progress_config)
+        monitor.start(observation)
+
+        result = None
+        hint = None
+        for i in range(max_actions):
+            with tracing.span("agent.step", step=i) as step_span:
+                action = recorder.recorded_code(observation) if recorder else None
+                replayed = action is not None
+                if not replayed:
+                    action = await calcualte_next_action(task, observation, plan_mode=plan_mode, hint=hint,
+                                                         text_view_config=text_view_config)
+                previous_observation = observation
+                observation = await env.step(action, observation.marked_elements)
+                if recorder:
+                    recorder.record(previous_observation, action, observation.error_message, replayed)
+                task_status = get_task_status(observation)
+                step_span.set(replayed=replayed, status=task_status.name)
+                if observation.error_message:
+                    step_span.record_error(observation.error_message)
+                detection = None
+                if task_status == TASK_STATUS.IN_PROGRESS:
+                    observation, detection = await check_progress(env, url, monitor, action, observation)
+                hint = detection.hint if detection else None
+            if task_status in [TASK_STATUS.SUCCESS, TASK_STATUS.FAILED]:
+                result = get_result(task_status, observation)
+                break
+            if detection and detection.response == "fail":
+                result = stuck_result(observation, detection)
+                break
+        else:
+            logger.warning(f"Reached {i} actions without completing the task.")
+            result = max_actions_result(observation, max_actions)
+
+        if recorder:
+            recorder.finish(result.status)
+        run_span.set(status=result.status.name, steps=i + 1)
+        if result.reason:
+            run_span.set(reason=result.reason)
+    return result
+
+
+async def run_sub_agents(parent_env, sub_tasks: list, max_actions=40, plan_mode=False, progress_config=None,
+                         text_view_config=None) -> list:
+    """Runs sub-agents concurrently, each one in a new context of the parent's browser."""
+    async def run_sub_agent(sub_task):
+        env = parent_env.spawn()
+        try:
+            return await _run_task(env, sub_task["url"], Task(task=sub_task["task"], args=sub_task.get("args", {})), max_actions, plan_mode,
+                                   progress_config, text_view_config)
+        finally:
+            await env.close()
+
+    return list(await asyncio.gather(*[run_sub_agent(sub_task) for sub_task in sub_tasks]))
+
+
+async def act(url, task, max_actions=40, headless=False, screenshot_config=None, delta_config=None,
+              trajectory_store=None, trajectory_mode="replay", network_policy=None, asset_cache=None, session_store=None,
+              session_account="default", plan_mode=False, progress_config=None, text_view_config=None, spill_store=None,
+              **kwargs):
+    """
+    Async version of `pywebagent.act`, runs a single task on a private browser, with the same options.
+    A `pool` is rejected, BrowserPool only works with the sync API.
+    """
+    reject_sync_only_options(kwargs)
+    async with AsyncAgentRunner(max_concurrency=1, headless=headless, network_policy=network_policy,
+                                asset_cache=asset_cache, session_store=session_store, plan_mode=plan_mode,
+                                progress_config=progress_config, text_view_config=text_view_config,
+                                spill_store=spill_store, screenshot_config=screenshot_config, delta_config=delta_config,
+                                trajectory_store=trajectory_store, trajectory_mode=trajectory_mode) as runner:
+        return await runner.act(url, task, max_actions, session_account, **kwargs)
@@ -0,0 +1,527 @@
+"""
+Runs many tasks over a pool of worker processes, each one holding a warm browser.
+
+Tasks are queued in a SQLite database, which also keeps their status, attempts and outputs, so a batch survives
+crashes: running it again resumes where it stopped. A task that fails, raises or exceeds its timeout is retried
+until `max_attempts`, and queued or running tasks can be cancelled from another process.
+
+    python -m pywebagent.batch add tasks.jsonl --timeout 600
+    python -m pywebagent.batch run --workers 8
+    python -m pywebagent.batch status
+    python -m pywebagent.batch results --status succeeded > results.jsonl
+
+A task file holds a JSON object per line (or a JSON list) with `url`, `task` and optionally `kwargs`,
+`max_actions`, `timeout` and `max_attempts`. The `kwargs` are the task's arguments, they can't have the name of an
+option of `act`.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from multiprocessing.connection import wait
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_PATH = Path(os.environ.get("PYWEBAGENT_CACHE_DIR", Path.home() / ".cache" / "pywebagent")) / "batch.sqlite"
+DEFAULT_TIMEOUT = 600.0
+DEFAULT_MAX_ATTEMPTS = 2
+MAX_STARTUP_FAILURES = 3  # workers in a row that died before being ready, the browser can't be launched
+
+# The parameters of `act`, a task argument with one of these names would be taken as the option
+TASK_FIELDS = ("url", "task", "max_actions")
+ACT_OPTIONS = TASK_FIELDS + (
+    "pool", "screenshot_config", "delta_config", "trajectory_store", "trajectory_mode", "network_policy", "asset_cache",
+    "session_store", "session_account", "plan_mode", "progress_config", "text_view_config", "spill_store",
+)
+
+PENDING, RUNNING, SUCCEEDED, FAILED, CANCELLED = "pending", "running", "succeeded", "failed", "cancelled"
+STATUSES = (PENDING, RUNNING, SUCCEEDED, FAILED, CANCELLED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    task TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    max_actions INTEGER NOT NULL,
+    timeout REAL NOT NULL,
+    max_attempts INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    runner INTEGER,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    duration REAL,
+    output TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, id);
+"""
+
+
+@dataclass
+class QueuedTask:
+    id: int
+    url: str
+    task: str
+    kwargs: dict
+    max_actions: int = 40
+    timeout: float = DEFAULT_TIMEOUT
+    max_attempts: int = DEFAULT_MAX_ATTEMPTS
+    status: str = PENDING
+    attempts: int = 0
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    duration: Optional[float] = None  # of the last attempt
+    output: Any = None
+    error: Optional[str] = None
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "QueuedTask":
+        return cls(
+            id=row["id"], url=row["url"], task=row["task"], kwargs=json.loads(row["kwargs"]),
+            max_actions=row["max_actions"], timeout=row["timeout"], max_attempts=row["max_attempts"],
+            status=row["status"], attempts=row["attempts"], started=row["started"], finished=row["finished"],
+            duration=row["duration"], output=json.loads(row["output"]) if row["output"] else None, error=row["error"],
+        )
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__dataclass_fields__}
+
+
+def check_task_kwargs(kwargs: dict) -> None:
+    """Raises a ValueError if task arguments have the names of `act` options."""
+    reserved = sorted(set(kwargs or {}) & set(ACT_OPTIONS))
+    if reserved:
+        raise ValueError(f"Task arguments {reserved} have the names of act options, rename them "
+                         f"(options are set on the runner, e.g. AgentTaskRunner(delta_config=...))")
+
+
+def _is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # alive, owned by another user
+    return True
+
+
+class TaskQueue:
+    """SQLite queue of tasks, shared by the runner and the processes that add or cancel tasks."""
+
+    def __init__(self, path=DEFAULT_QUEUE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+
+    def add(self, url: str, task: str, kwargs: dict = None, max_actions: int = 40, timeout: float = DEFAULT_TIMEOUT,
+            max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> int:
+        return self.add_many([{"url": url, "task": task, "kwargs": kwargs or {}, "max_actions": max_actions,
+                               "timeout": timeout, "max_attempts": max_attempts}])[0]
+
+    def add_many(self, tasks: List[dict]) -> List[int]:
+        """Queues dicts with `url`, `task` and optionally `kwargs`, `max_actions`, `timeout` and `max_attempts`."""
+        for t in tasks:  # before inserting any, a file is queued whole or not at all
+            check_task_kwargs(t.get("kwargs"))
+        now = time.time()
+        with self._lock, self._connection:
+            return [
+                self._connection.execute(
+                    """INSERT INTO tasks (url, task, kwargs, max_actions, timeout, max_attempts, status, created)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (t["url"], t["task"], json.dumps(t.get("kwargs") or {}), t.get("max_actions", 40),
+                     t.get("timeout", DEFAULT_TIMEOUT), t.get("max_attempts", DEFAULT_MAX_ATTEMPTS), PENDING, now),
+                ).lastrowid
+                for t in tasks
+            ]
+
+    def claim(self, runner: int) -> Optional[QueuedTask]:
+        """Marks the oldest pending task as running for the `runner` process, None if there is none."""
+        with self._lock:
+            while True:
+                row = self._connection.execute(
+                    "SELECT id FROM tasks WHERE status = ? ORDER BY id LIMIT 1", (PENDING,)).fetchone()
+                if row is None:
+                    return None
+                with self._connection:
+                    claimed = self._connection.execute(
+                        """UPDATE tasks SET status = ?, runner = ?, attempts = attempts + 1, started = ?
+                           WHERE id = ? AND status = ?""",
+                        (RUNNING, runner, time.time(), row["id"], PENDING),
+                    ).rowcount
+                if claimed:  # otherwise another runner claimed it first
+                    return self.get(row["id"], lock=False)
+
+    def finish(self, task_id: int, succeeded: bool, output: Any = None, error: str = None,
+               duration: float = None) -> Optional[str]:
+        """
+        Records the outcome of an attempt. Failed tasks go back to pending until they reach their `max_attempts`.
+        Returns the new status, None if the task is no longer running (it was cancelled).
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT attempts, max_attempts FROM tasks WHERE id = ? AND status = ?", (task_id, RUNNING)).fetchone()
+            if row is None:
+                return None
+            if succeeded:
+                status = SUCCEEDED
+            else:
+                status = PENDING if row["attempts"] < row["max_attempts"] else FAILED
+            self._connection.execute(
+                """UPDATE tasks SET status = ?, runner = NULL, finished = ?, duration = ?, output = ?, error = ?
+                   WHERE id = ?""",
+                (status, time.time(), duration, json.dumps(output, default=str), error, task_id),
+            )
+            return status
+
+    def requeue(self, task_ids: List[int]) -> None:
+        """Gives running tasks back to the queue without counting the interrupted attempt."""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "UPDATE tasks SET status = ?, runner = NULL, attempts = attempts - 1 WHERE id = ? AND status = ?",
+                [(PENDING, task_id, RUNNING) for task_id in task_ids],
+            )
+
+    def recover(self) -> int:
+        """Requeues the tasks left running by runners that exited without finishing them, e.g. after a crash."""
+        with self._lock:
+            rows = self._connection.execute("SELECT id, runner FROM tasks WHERE status = ?", (RUNNING,)).fetchall()
+            orphans = [row["id"] for row in rows if row["runner"] is None or not _is_process_alive(row["runner"])]
+            with self._connection:
+                self._connection.executemany(
+                    """UPDATE tasks SET status = CASE WHEN attempts < max_attempts THEN ? ELSE ? END, runner = NULL,
+                       error = 'The runner exited during the task' WHERE id = ? AND status = ?""",
+                    [(PENDING, FAILED, task_id, RUNNING) for task_id in orphans],
+                )
+        if orphans:
+            logger.info(f"Recovered {len(orphans)} tasks left running by a previous run")
+        return len(orphans)
+
+    def cancel(self, task_ids: List[int] = None) -> int:
+        """Cancels the given (or all) pending and running tasks, a runner stops the running ones."""
+        query = "UPDATE tasks SET status = ?, runner = NULL, finished = ? WHERE status IN (?, ?)"
+        parameters = (CANCELLED, time.time(), PENDING, RUNNING)
+        with self._lock, self._connection:
+            if task_ids is None:
+                return self._connection.execute(query, parameters).rowcount
+            return sum(self._connection.execute(query + " AND id = ?", parameters + (task_id,)).rowcount
+                       for task_id in task_ids)
+
+    def get(self, task_id: int, lock: bool = True) -> Optional[QueuedTask]:
+        if lock:
+            with self._lock:
+                return self.get(task_id, lock=False)
+        row = self._connection.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return QueuedTask.from_row(row) if row else None
+
+    def statuses(self, task_ids: List[int]) -> Dict[int, str]:
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT id, status FROM tasks WHERE id IN ({', '.join('?' * len(task_ids))})", task_ids).fetchall()
+        return {row["id"]: row["status"] for row in rows}
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._connection.execute("SELECT status, COUNT(*) AS count FROM tasks GROUP BY status").fetchall()
+        return {status: 0 for status in STATUSES} | {row["status"]: row["count"] for row in rows}
+
+    def tasks(self, status: str = None) -> List[QueuedTask]:
+        with self._lock:
+            if status is None:
+                rows = self._connection.execute("SELECT * FROM tasks ORDER BY id").fetchall()
+            else:
+                rows = self._connection.execute("SELECT * FROM tasks WHERE status = ? ORDER BY id", (status,)).fetchall()
+        return [QueuedTask.from_row(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class AgentTaskRunner:
+    """Runs the tasks of a worker process with `act`, on a browser kept warm between tasks."""
+
+    def __init__(self, headless: bool = True, **act_options):
+        unknown = sorted(name for name in act_options if name not in ACT_OPTIONS or name in TASK_FIELDS + ("pool",))
+        if unknown:
+            raise ValueError(f"{unknown} are not act options the runner can set")
+        self.headless = headless
+        self.act_options = act_options  # e.g. screenshot_config, network_policy, must be picklable
+        self.pool = None
+
+    def __enter__(self):
+        from pywebagent.env.pool import BrowserPool
+
+        self.pool = BrowserPool(size=1, contexts_per_browser=1, headless=self.headless).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pool.close()
+
+    def run(self, task: QueuedTask):
+        """Returns whether the task succeeded and its output."""
+        from pywebagent.agent import act
+
+        check_task_kwargs(task.kwargs)  # queued by an older version
+        result = act(task.url, task.task, task.max_actions, pool=self.pool, **self.act_options, **task.kwargs)
+        return result.succeeded, result.output
+
+
+def _worker_main(connection, task_runner) -> None:
+    """Announces it is ready once the browser is up, then runs the tasks it receives until it gets None."""
+    with task_runner:
+        connection.send(None)
+        while True:
+            task = connection.recv()
+            if task is None:
+                return
+            start_time = time.perf_counter()
+            try:
+                succeeded, output = task_runner.run(task)
+                error = None
+            except Exception as e:
+                logger.exception(f"Task {task.id} raised")
+                succeeded, output, error = False, None, f"{type(e).__name__}: {e}"
+            connection.send((succeeded, output, error, time.perf_counter() - start_time))
+
+
+@dataclass(eq=False)
+class _Worker:
+    process: Any
+    connection: Any
+    ready: bool = False
+    task: Optional[QueuedTask] = None
+    started: float = 0.0
+
+
+@dataclass
+class BatchStats:
+    workers: int = 0
+    elapsed: float = 0.0
+    succeeded: int = 0
+    failed: int = 0
+    retried: int = 0  # failed attempts that were queued again
+    timed_out: int = 0  # attempts, retried or not
+    cancelled: int = 0  # while running
+    worker_restarts: int = 0
+    durations: List[float] = field(default_factory=list)  # of every finished attempt
+
+    @property
+    def finished(self) -> int:
+        return self.succeeded + self.failed
+
+    @property
+    def tasks_per_minute(self) -> float:
+        return 60 * self.finished / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, fraction: float) -> float:
+        durations = sorted(self.durations)
+        return durations[min(len(durations) - 1, int(fraction * len(durations)))] if durations else 0.0
+
+
+def format_stats(stats: BatchStats) -> str:
+    return "\n".join([
+        f"{stats.finished} tasks in {stats.elapsed:.1f}s on {stats.workers} workers: "
+        f"{stats.tasks_per_minute:.1f} tasks/min, {stats.tasks_per_minute / max(stats.workers, 1):.2f} per worker",
+        f"succeeded {stats.succeeded}, failed {stats.failed}, retried {stats.retried}, timed out {stats.timed_out}, "
+        f"cancelled {stats.cancelled}, worker restarts {stats.worker_restarts}",
+        f"attempt duration p50 {stats.percentile(0.5):.1f}s, p95 {stats.percentile(0.95):.1f}s",
+    ])
+
+
+class BatchRunner:
+    """
+    Runs the tasks of a `TaskQueue` on `workers` processes, each one running a task at a time with `task_runner`
+    (an `AgentTaskRunner` by default). The runner enforces the timeouts and cancellations by restarting the
+    worker, a hung browser can't block it.
+    """
+
+    def __init__(self, queue: TaskQueue, workers: int = None, task_runner=None, poll_interval: float = 0.5):
+        self.queue = queue
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)  # a browser keeps about a core busy
+        self.task_runner = task_runner or AgentTaskRunner()
+        self.poll_interval = poll_interval
+        self._context = multiprocessing.get_context("spawn")  # forking a process with playwright threads is unsafe
+        self._startup_failures = 0
+        self._stats = BatchStats()
+
+    def run(self, stop_when_empty: bool = True) -> BatchStats:
+        """Runs until the queue is empty (or forever), tasks running when interrupted are requeued."""
+        self.queue.recover()
+        self._stats = BatchStats(workers=self.workers)
+        start_time = time.perf_counter()
+        workers = [self._spawn() for _ in range(self.workers)]
+        try:
+            while True:
+                self._dispatch(workers)
+                if stop_when_empty and all(worker.task is None for worker in workers) and not self.queue.counts()[PENDING]:
+                    break
+                for connection in wait([worker.connection for worker in workers], timeout=self.poll_interval):
+                    self._receive(next(worker for worker in workers if worker.connection is connection))
+                for i, worker in enumerate(workers):
+                    if self._must_restart(worker):
+                        workers[i] = self._restart(worker)
+        finally:
+            self.queue.requeue([worker.task.id for worker in workers if worker.task is not None])
+            for worker in workers:
+                self._stop(worker)
+            self._stats.elapsed = time.perf_counter() - start_time
+        return self._stats
+
+    def _spawn(self) -> _Worker:
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(child_connection, self.task_runner), daemon=True)
+        process.start()
+        child_connection.close()
+        return _Worker(process, parent_connection)
+
+    def _dispatch(self, workers: List[_Worker]) -> None:
+        for worker in workers:
+            if worker.ready and worker.task is None:
+                task = self.queue.claim(os.getpid())
+                if task is None:
+                    return
+                logger.info(f"Task {task.id} (attempt {task.attempts}) started: {task.task}")
+                worker.task, worker.started = task, time.monotonic()
+                worker.connection.send(task)
+
+    def _receive(self, worker: _Worker) -> None:
+        try:
+            message = worker.connection.recv()
+        except EOFError:
+            return  # the worker died, handled by _must_restart
+        if message is None:
+            worker.ready = True
+            self._startup_failures = 0
+            return
+        succeeded, output, error, duration = message
+        self._finish(worker, succeeded, output, error, duration)
+
+    def _finish(self, worker: _Worker, succeeded: bool, output=None, error=None, duration=None) -> None:
+        task, worker.task = worker.task, None
+        status = self.queue.finish(task.id, succeeded, output, error, duration)
+        if status is None:
+            return  # cancelled meanwhile
+        self._stats.durations.append(duration if duration is not None else time.monotonic() - worker.started)
+        if status == PENDING:
+            self._stats.retried += 1
+        elif status == SUCCEEDED:
+            self._stats.succeeded += 1
+        else:
+            self._stats.failed += 1
+        logger.info(f"Task {task.id} {status if status != PENDING else 'failed, retrying'}"
+                    + (f": {error}" if error else ""))
+
+    def _must_restart(self, worker: _Worker) -> bool:
+        if not worker.process.is_alive():
+            if not worker.ready:
+                self._startup_failures += 1
+                if self._startup_failures >= MAX_STARTUP_FAILURES:
+                    raise RuntimeError(f"{MAX_STARTUP_FAILURES} workers exited before being ready, see their logs")
+            if worker.task is not None:
+                self._finish(worker, False, error=f"The worker exited with code {worker.process.exitcode}")
+            return True
+        if worker.task is None:
+            return False
+        if time.monotonic() - worker.started > worker.task.timeout:
+            self._stats.timed_out += 1
+            self._finish(worker, False, error=f"Timed out after {worker.task.timeout:.0f}s")
+            return True
+        if self.queue.statuses([worker.task.id]).get(worker.task.id) == CANCELLED:
+            logger.info(f"Task {worker.task.id} cancelled")
+            self._stats.cancelled += 1
+            worker.task = None
+            return True
+        return False
+
+    def _restart(self, worker: _Worker) -> _Worker:
+        self._stats.worker_restarts += 1
+        self._stop(worker, graceful=False)
+        return self._spawn()
+
+    @staticmethod
+    def _stop(worker: _Worker, graceful: bool = True) -> None:
+        if graceful and worker.process.is_alive():
+            try:
+                worker.connection.send(None)
+                worker.process.join(10)
+            except (BrokenPipeError, OSError):
+                pass
+        if worker.process.is_alive():
+            # the playwright driver exits when its pipe to the worker closes, and takes the browser with it
+            worker.process.terminate()
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.kill()
+        worker.connection.close()
+
+
+def load_tasks(path) -> List[dict]:
+    """Tasks of a JSON list file, or of a file with a JSON object per line."""
+    text = Path(path).read_text()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m pywebagent.batch", description="Runs batches of agent tasks.")
+    parser.add_argument("--db", default=DEFAULT_QUEUE_PATH, help="queue database (default %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="queue the tasks of files")
+    add.add_argument("files", nargs="+")
+    run = commands.add_parser("run", help="run the queued tasks, resuming an interrupted run")
+    run.add_argument("files", nargs="*", help="tasks to queue before running")
+    run.add_argument("--workers", type=int, help="worker processes, each with a browser (default half the cores)")
+    run.add_argument("--headed", action="store_true", help="show the browsers")
+    run.add_argument("--forever", action="store_true", help="keep waiting for new tasks once the queue is empty")
+    for command in (add, run):
+        command.add_argument("--max-actions", type=int, default=40)
+        command.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="seconds per attempt")
+        command.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    commands.add_parser("status", help="count the tasks by status")
+    cancel = commands.add_parser("cancel", help="cancel pending and running tasks")
+    cancel.add_argument("ids", nargs="*", type=int, help="all tasks if none is given")
+    results = commands.add_parser("results", help="print the tasks as JSON lines")
+    results.add_argument("--status", choices=STATUSES)
+    args = parser.parse_args(argv)
+
+    queue = TaskQueue(args.db)
+    try:
+        if args.command in ("add", "run"):
+            defaults = {"max_actions": args.max_actions, "timeout": args.timeout, "max_attempts": args.max_attempts}
+            for path in args.files:
+                ids = queue.add_many([{**defaults, **task} for task in load_tasks(path)])
+                print(f"Queued {len(ids)} tasks from {path}")
+        if args.command == "run":
+            logging.basicConfig(level=logging.INFO, format="%(asctime)s %(processName)s %(name)s: %(message)s")
+            runner = BatchRunner(queue, workers=args.workers, task_runner=AgentTaskRunner(headless=not args.headed))
+            print(format_stats(runner.run(stop_when_empty=not args.forever)))
+        elif args.command == "status":
+            print(" ".join(f"{status}={count}" for status, count in queue.counts().items()))
+        elif args.command == "cancel":
+            print(f"Cancelled {queue.cancel(args.ids or None)} tasks")
+        elif args.command == "results":
+            for task in queue.tasks(args.status):
+                print(json.dumps(task.to_dict(), default=str))
+    finally:
+        queue.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
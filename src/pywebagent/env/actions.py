@@ -1,87 +1,125 @@
-import time
 import logging
-from attr import dataclass
+import re
+from collections import deque
+from dataclasses import dataclass, field
 import playwright
-import subprocess
+from pywebagent import tracing
 
 logger = logging.getLogger(__name__)
 
+# Resolves a marked element from the page side registry (see mark_borders.js) and colors its border.
+# Returns the element once the color change is painted, or null if it is no longer attached.
+HIGHLIGHT_ELEMENT_JS = "([id, color]) => window.__pywebagent__.highlight(id, color)"
+RESTORE_HIGHLIGHT_JS = "([id, color]) => { window.__pywebagent__.highlight(id, color, false); }"
+HAS_VALUE_JS = "([id, value]) => window.__pywebagent__.resolve(id)?.value === value"
+GET_VALUE_JS = "id => window.__pywebagent__.resolve(id)?.value ?? null"
+EXPECT_TIMEOUT = 5000  # ms a postcondition of a plan (or an element of a page not seen yet) may take to show up
+MAX_LOG_HISTORY = 50  # log messages kept per step, the oldest ones are dropped
+
+
+class PostconditionError(Exception):
+    """An expectation of a plan did not hold, the rest of the plan is skipped and the model sees the page again."""
+
+
+def new_log_history() -> deque:
+    return deque(maxlen=MAX_LOG_HISTORY)
+
+
 @dataclass
 class EnvState:
+    """The state of one run, each run gets its own."""
     has_successfully_completed: bool = False
     has_failed: bool = False
-    output: dict = {}
+    output: dict = field(default_factory=dict)
     timeframe: int = 0
-    log_history: list[str] = []
+    log_history: deque = field(default_factory=new_log_history)
+    reason: str = None  # given by the model when it finished the task
+
+
+def locate_by_text(page, text: str):
+    """The first button or link named `text`, or else the first element showing it."""
+    name = re.compile(re.escape(text), re.IGNORECASE)
+    return page.get_by_role("button", name=name).or_(page.get_by_role("link", name=name)).or_(page.get_by_text(text)).first
+
+
+def locate_field(page, label: str):
+    return page.get_by_label(label).or_(page.get_by_placeholder(label)).first
+
+
+def validate_sub_agent_url(url: str, current_url: str) -> None:
+    # if url is not valid
+    if not url.startswith("https://"):
+        raise Exception("URL must start with https://")
+    
+    # get the domain from url so https://www.google.com becomes google.com for example
+    domain = url.split("://")[1].split("/")[0]
+    existing_domain = current_url.split("://")[1].split("/")[0]
+    if domain == existing_domain:
+        raise Exception("Sub agent cannot act on the same domain as this agent, complete the task thrugh other actions instead")
 
 
 class Actions:
-    def __init__(self, page, marked_elements: list, env_state: EnvState) -> None:
+    def __init__(self, page, marked_elements: list, env_state: EnvState, sub_agent_runner=None) -> None:
         self.env_state = env_state
         self.page = page
         self.marked_elements = marked_elements
+        self.sub_agent_runner = sub_agent_runner
 
     def finish(self, success, output: dict, reason: str) -> None:
         self.env_state.has_successfully_completed = success
         self.env_state.has_failed = not success
         self.env_state.output = output
+        self.env_state.reason = reason
 
     def act(self, url, task, log_message, **kwargs) -> None:
-        # if url is not valid
-        if not url.startswith("https://"):
-            raise Exception("URL must start with https://")
-        
-        # get the domain from url so https://www.google.com becomes google.com for example
-        domain = url.split("://")[1].split("/")[0]
-        existing_domain = self.page.url.split("://")[1].split("/")[0]
-        if domain == existing_domain:
-            raise Exception("Sub agent cannot act on the same domain as this agent, complete the task thrugh other actions instead")
+        if log_message:
+            self.env_state.log_history.append(log_message)
+        return self._run_sub_agents([{"url": url, "task": task, "args": kwargs}])[0]
 
+    def act_many(self, sub_tasks: list, log_message) -> list:
         if log_message:
             self.env_state.log_history.append(log_message)
-        process = subprocess.Popen(["python", "run.py", "--url", url, "--task", task, "--kwargs", str(kwargs)], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        stdout, stderr = process.communicate()
-        if process.returncode != 0:
-            raise Exception("Error running ai agent:", stderr)
-        stdout = stdout.split("\n")
-        status = stdout[-3][len("Status: "):]
-        assert status == "TASK_STATUS.SUCCESS", f"AI agent failed with status {status}"
-        output = stdout[-2][len("Output: "):]
-        try:
-            output = eval(output)
-        except Exception as e:
-            raise Exception("Failed to parse output as JSON from AI agent:", stdout, e)
+        return self._run_sub_agents(sub_tasks)
+
+    def _run_sub_agents(self, sub_tasks: list) -> list:
+        for sub_task in sub_tasks:
+            validate_sub_agent_url(sub_task["url"], self.page.url)
+        if self.sub_agent_runner is None:
+            raise Exception("Sub agents are not available in this environment")
 
-        self.env_state.log_history.append(f"Sub agent finished successfully with output: {output}")
-        return output
+        results = self.sub_agent_runner(sub_tasks)
+        failed = [(sub_task["task"], result.status) for sub_task, result in zip(sub_tasks, results) if not result.succeeded]
+        assert not failed, f"AI agent failed with status {failed}"
+        outputs = [result.output for result in results]
+        for output in outputs:
+            self.env_state.log_history.append(f"Sub agent finished successfully with output: {output}")
+        return outputs
         
     def set_page(self, page):
         self.page = page
 
+    @tracing.traced("actions.interact")
     def _visualized_interact(self, item_id: int, func: str, *args, **kwargs) -> None:
         """Mark element border with red and executes the given function."""
         if item_id not in self.marked_elements:
             raise Exception(f"Element with id {item_id} is not marked in the webpage.")
-        element_info = self.marked_elements[item_id]
-        xpath = element_info['xpath']
-        iframe = element_info['iframe']
-        element = iframe.evaluate_handle(
-            f"document.evaluate('{xpath}', document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue")
-        
-
-        border = iframe.evaluate_handle(f"document.getElementById('item_id_border__{item_id}')")
-        label = iframe.evaluate_handle(f"document.getElementById('item_id_label__{item_id}')")
-        border.evaluate(f"(element) => element.style.borderColor = 'red'")
-        label.evaluate(f"(element) => element.style.backgroundColor = 'red'")
-        
-        time.sleep(1)  # Wait a bit for the color change to be visible
+        iframe = self.marked_elements[item_id]['iframe']
+        tracing.current_span().set(function=func, element_id=item_id)
+        with tracing.span("actions.highlight"):
+            element = iframe.evaluate_handle(HIGHLIGHT_ELEMENT_JS, [item_id, 'red']).as_element()
+        if element is None:
+            raise Exception(f"Element with id {item_id} is no longer attached to the webpage.")
 
         # str func to element func
         element_func = getattr(element, func)
         assert element_func, f"Element with id {id} does not have a function {func}."
-        element_func(*args, **kwargs)
-        border.evaluate(f"(element) => element.style.borderColor = 'green'")
-        label.evaluate(f"(element) => element.style.backgroundColor = 'green'")
+        with tracing.span(f"actions.{func}"):
+            element_func(*args, **kwargs)
+        with tracing.span("actions.restore_highlight"):
+            try:
+                iframe.evaluate(RESTORE_HIGHLIGHT_JS, [item_id, 'green'])
+            except Exception as e:
+                logger.debug(f"Could not restore highlight of element {item_id}, the page probably navigated: {e}")
         
         element.dispose()
     
@@ -170,6 +208,49 @@ class Actions:
             else:
                 raise e
             
+    def click_text(self, text: str, log_message: str) -> None:
+        """Clicks an element by its text, for pages reached during a plan whose elements have no ids yet."""
+        self.env_state.log_history.append(log_message)
+        with tracing.span("actions.click_text"):
+            locate_by_text(self.page, text).click(timeout=EXPECT_TIMEOUT)
+
+    def input_text_by_label(self, label: str, text: str, clear_before_input: bool, log_message: str) -> None:
+        self.env_state.log_history.append(log_message)
+        with tracing.span("actions.input_text_by_label"):
+            field = locate_field(self.page, label)
+            if clear_before_input:
+                field.fill(text, timeout=EXPECT_TIMEOUT)
+            else:
+                field.type(text, timeout=EXPECT_TIMEOUT)
+
+    @tracing.traced("actions.expect_url")
+    def expect_url(self, pattern: str, log_message: str) -> None:
+        try:
+            self.page.wait_for_url(lambda url: pattern in url, wait_until="commit", timeout=EXPECT_TIMEOUT)
+        except playwright._impl._api_types.TimeoutError:
+            raise PostconditionError(f"Expected the URL to contain {pattern!r}, but it is {self.page.url}")
+        self.env_state.log_history.append(log_message)
+
+    @tracing.traced("actions.expect_text")
+    def expect_text(self, text: str, log_message: str) -> None:
+        try:
+            self.page.get_by_text(text).first.wait_for(state="visible", timeout=EXPECT_TIMEOUT)
+        except playwright._impl._api_types.TimeoutError:
+            raise PostconditionError(f"Expected {text!r} to be visible on the page, but it is not")
+        self.env_state.log_history.append(log_message)
+
+    @tracing.traced("actions.expect_value")
+    def expect_value(self, item_id: int, value: str, log_message: str) -> None:
+        if item_id not in self.marked_elements:
+            raise Exception(f"Element with id {item_id} is not marked in the webpage.")
+        iframe = self.marked_elements[item_id]['iframe']
+        try:
+            iframe.wait_for_function(HAS_VALUE_JS, arg=[item_id, value], timeout=EXPECT_TIMEOUT)
+        except playwright._impl._api_types.TimeoutError:
+            actual = iframe.evaluate(GET_VALUE_JS, item_id)
+            raise PostconditionError(f"Expected element {item_id} to have the value {value!r}, but it has {actual!r}")
+        self.env_state.log_history.append(log_message)
+
     @staticmethod
     def _is_unstable_element_exception(e):
         e_lines = str(e).split('\n')
@@ -0,0 +1,279 @@
+import ast
+import logging
+import sys
+import playwright
+from pywebagent import tracing
+from pywebagent.env.actions import (
+    EXPECT_TIMEOUT,
+    GET_VALUE_JS,
+    HAS_VALUE_JS,
+    HIGHLIGHT_ELEMENT_JS,
+    RESTORE_HIGHLIGHT_JS,
+    Actions,
+    EnvState,
+    PostconditionError,
+    locate_by_text,
+    locate_field,
+    validate_sub_agent_url,
+)
+
+logger = logging.getLogger(__name__)
+
+STEP_FUNCTION_NAME = "__pywebagent_step__"
+
+
+def _is_action_call(node) -> bool:
+    return (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+            and isinstance(node.func.value, ast.Name) and node.func.value.id == "actions")
+
+
+class _AwaitActionCalls(ast.NodeTransformer):
+    """
+    Wraps every `actions.<func>(...)` call in an await expression.
+    Awaiting is only possible at the top level of the code and in async functions, calls in nested functions,
+    lambdas and classes are rejected with a SyntaxError.
+    """
+
+    def __init__(self, code: str):
+        self.lines = code.splitlines()
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if _is_action_call(node):
+            return ast.copy_location(ast.Await(value=node), node)
+        return node
+
+    def _reject_action_calls(self, node):
+        for child in ast.walk(node):
+            if _is_action_call(child):
+                kind = {ast.FunctionDef: "function", ast.Lambda: "lambda", ast.ClassDef: "class"}[type(node)]
+                line = self.lines[child.lineno - 1] if child.lineno <= len(self.lines) else None
+                raise SyntaxError(f"actions.{child.func.attr} can't be called inside a nested {kind}, "
+                                  f"call the actions at the top level of the code",
+                                  ("<string>", child.lineno, child.col_offset + 1, line))
+        return node
+
+    visit_FunctionDef = visit_Lambda = visit_ClassDef = _reject_action_calls
+
+
+def compile_async_step(code: str):
+    """
+    Compiles the generated (synchronous looking) code into an async function definition.
+    Every call on `actions` is awaited, line numbers are kept so errors point at the original code.
+    """
+    module = ast.parse(code)
+    transformer = _AwaitActionCalls(code)
+    body = [transformer.visit(stmt) for stmt in module.body] or [ast.Pass()]
+    function = ast.AsyncFunctionDef(
+        name=STEP_FUNCTION_NAME,
+        args=ast.arguments(posonlyargs=[], args=[], kwonlyargs=[], kw_defaults=[], defaults=[]),
+        body=body,
+        decorator_list=[],
+        returns=None,
+        lineno=1,
+        col_offset=0,
+    )
+    if sys.version_info >= (3, 12):
+        function.type_params = []
+    # Variables defined by the code are kept in the execution context, like the synchronous exec
+    names = sorted({node.id for node in ast.walk(module) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)})
+    if names:
+        function.body.insert(0, ast.Global(names=names, lineno=1, col_offset=0))
+    wrapper = ast.Module(body=[function], type_ignores=[])
+    ast.fix_missing_locations(wrapper)
+    return compile(wrapper, "<string>", "exec")
+
+
+class AsyncActions:
+    """Async counterpart of `Actions`, driving a page of playwright's async API."""
+
+    def __init__(self, page, marked_elements: list, env_state: EnvState, sub_agent_runner=None) -> None:
+        self.env_state = env_state
+        self.page = page
+        self.marked_elements = marked_elements
+        self.sub_agent_runner = sub_agent_runner
+
+    async def finish(self, success, output: dict, reason: str) -> None:
+        self.env_state.has_successfully_completed = success
+        self.env_state.has_failed = not success
+        self.env_state.output = output
+        self.env_state.reason = reason
+
+    async def act(self, url, task, log_message, **kwargs) -> None:
+        if log_message:
+            self.env_state.log_history.append(log_message)
+        return (await self._run_sub_agents([{"url": url, "task": task, "args": kwargs}]))[0]
+
+    async def act_many(self, sub_tasks: list, log_message) -> list:
+        if log_message:
+            self.env_state.log_history.append(log_message)
+        return await self._run_sub_agents(sub_tasks)
+
+    async def _run_sub_agents(self, sub_tasks: list) -> list:
+        for sub_task in sub_tasks:
+            validate_sub_agent_url(sub_task["url"], self.page.url)
+        if self.sub_agent_runner is None:
+            raise Exception("Sub agents are not available in this environment")
+
+        results = await self.sub_agent_runner(sub_tasks)
+        failed = [(sub_task["task"], result.status) for sub_task, result in zip(sub_tasks, results) if not result.succeeded]
+        assert not failed, f"AI agent failed with status {failed}"
+        outputs = [result.output for result in results]
+        for output in outputs:
+            self.env_state.log_history.append(f"Sub agent finished successfully with output: {output}")
+        return outputs
+
+    def set_page(self, page):
+        self.page = page
+
+    @tracing.traced("actions.interact")
+    async def _visualized_interact(self, item_id: int, func: str, *args, **kwargs) -> None:
+        """Mark element border with red and executes the given function."""
+        if item_id not in self.marked_elements:
+            raise Exception(f"Element with id {item_id} is not marked in the webpage.")
+        iframe = self.marked_elements[item_id]['iframe']
+        tracing.current_span().set(function=func, element_id=item_id)
+        with tracing.span("actions.highlight"):
+            element = (await iframe.evaluate_handle(HIGHLIGHT_ELEMENT_JS, [item_id, 'red'])).as_element()
+        if element is None:
+            raise Exception(f"Element with id {item_id} is no longer attached to the webpage.")
+
+        # str func to element func
+        element_func = getattr(element, func)
+        assert element_func, f"Element with id {id} does not have a function {func}."
+        with tracing.span(f"actions.{func}"):
+            await element_func(*args, **kwargs)
+        with tracing.span("actions.restore_highlight"):
+            try:
+                await iframe.evaluate(RESTORE_HIGHLIGHT_JS, [item_id, 'green'])
+            except Exception as e:
+                logger.debug(f"Could not restore highlight of element {item_id}, the page probably navigated: {e}")
+
+        await element.dispose()
+
+    async def click(self, item_id: int, log_message: str, force=False) -> None:
+        """
+        Attempts to click an element identified by `item_id`.
+        Checks if a file chooser dialog opens as a result of the click, which is unexpected behavior.
+        If the element is not clickable and `force` is False, retries with force click.
+        """
+        if log_message:
+            self.env_state.log_history.append(log_message)
+        try:
+            inner_exception_raised = False
+            async with self.page.expect_file_chooser(timeout=1200):
+                try:
+                    await self._visualized_interact(item_id, "click", timeout=5000, force=force, no_wait_after=True)
+                except Exception as e_click:
+                    inner_exception_raised = True
+                    inner_exception = e_click
+
+        except playwright._impl._api_types.TimeoutError:
+            if not inner_exception_raised:
+                return  # Expected scenario: file chooser did not open.
+
+            # Handle click-related exceptions.
+            if inner_exception_raised:
+                if Actions._is_unstable_element_exception(inner_exception) and not force:
+                    return await self.click(item_id, log_message="", force=True)
+                else:
+                    raise inner_exception
+        except Exception as e:
+            assert False, f"Unexpected exception raised: {e}"  # Unexpected exception outside the file chooser context.
+
+        raise Exception("filechooser event was triggered unexpectedly. Consider using upload_files() instead of click() for this element.")
+
+    async def scroll(self, direction: str, log_message: str) -> None:
+        self.env_state.log_history.append(log_message)
+        if direction not in ["up", "down"]:
+            raise Exception("direction must be either 'up' or 'down'")
+
+        # Scroll by the height of the viewport for page down/up
+        scroll_height = "window.innerHeight"  # Gets the height of the viewport
+
+        if direction == "up":
+            await self.page.evaluate(f"window.scrollBy(0, -{scroll_height})")
+        else:
+            await self.page.evaluate(f"window.scrollBy(0, {scroll_height})")
+
+    async def combobox_select(self, item_id: int, option: str, log_message: str) -> None:
+        self.env_state.log_history.append(log_message)
+        await self._visualized_interact(item_id, "select_option", option)
+
+    async def input_text(self, item_id: int, text: str, clear_before_input: bool, log_message: str):
+        self.env_state.log_history.append(log_message)
+        if clear_before_input:
+            await self._visualized_interact(item_id, "fill", text)
+        else:
+            await self._visualized_interact(item_id, "type", text)
+
+    async def upload_files(self, item_id: int, files: list, log_message: str) -> None:
+        self.env_state.log_history.append(log_message)
+        try:
+            async with self.page.expect_file_chooser(timeout=2000) as file_chooser_info:
+                successfully_clicked = False
+                click_exception = None
+                try:
+                    await self._visualized_interact(item_id, "click", timeout=1000, force=False)
+                    successfully_clicked = True
+                except Exception as e_click:
+                    click_exception = e_click
+                    if Actions._is_unstable_element_exception(e_click):
+                        try:
+                            await self._visualized_interact(item_id, "click", timeout=1000, force=True)
+                            successfully_clicked = True
+                        except Exception as e_click_force:
+                            click_exception = e_click_force
+                            raise e_click_force
+                    else:
+                        raise e_click
+
+            file_chooser = await file_chooser_info.value
+            await file_chooser.set_files(files)
+        except playwright._impl._api_types.TimeoutError as e:
+            if not successfully_clicked:
+                raise click_exception
+            else:
+                raise e
+
+    async def click_text(self, text: str, log_message: str) -> None:
+        self.env_state.log_history.append(log_message)
+        with tracing.span("actions.click_text"):
+            await locate_by_text(self.page, text).click(timeout=EXPECT_TIMEOUT)
+
+    async def input_text_by_label(self, label: str, text: str, clear_before_input: bool, log_message: str) -> None:
+        self.env_state.log_history.append(log_message)
+        with tracing.span("actions.input_text_by_label"):
+            field = locate_field(self.page, label)
+            if clear_before_input:
+                await field.fill(text, timeout=EXPECT_TIMEOUT)
+            else:
+                await field.type(text, timeout=EXPECT_TIMEOUT)
+
+    @tracing.traced("actions.expect_url")
+    async def expect_url(self, pattern: str, log_message: str) -> None:
+        try:
+            await self.page.wait_for_url(lambda url: pattern in url, wait_until="commit", timeout=EXPECT_TIMEOUT)
+        except playwright._impl._api_types.TimeoutError:
+            raise PostconditionError(f"Expected the URL to contain {pattern!r}, but it is {self.page.url}")
+        self.env_state.log_history.append(log_message)
+
+    @tracing.traced("actions.expect_text")
+    async def expect_text(self, text: str, log_message: str) -> None:
+        try:
+            await self.page.get_by_text(text).first.wait_for(state="visible", timeout=EXPECT_TIMEOUT)
+        except playwright._impl._api_types.TimeoutError:
+            raise PostconditionError(f"Expected {text!r} to be visible on the page, but it is not")
+        self.env_state.log_history.append(log_message)
+
+    @tracing.traced("actions.expect_value")
+    async def expect_value(self, item_id: int, value: str, log_message: str) -> None:
+        if item_id not in self.marked_elements:
+            raise Exception(f"Element with id {item_id} is not marked in the webpage.")
+        iframe = self.marked_elements[item_id]['iframe']
+        try:
+            await iframe.wait_for_function(HAS_VALUE_JS, arg=[item_id, value], timeout=EXPECT_TIMEOUT)
+        except playwright._impl._api_types.TimeoutError:
+            actual = await iframe.evaluate(GET_VALUE_JS, item_id)
+            raise PostconditionError(f"Expected element {item_id} to have the value {value!r}, but it has {actual!r}")
+        self.env_state.log_history.append(log_message)
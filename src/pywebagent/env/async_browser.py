@@ -0,0 +1,175 @@
+import logging
+from pywebagent.env.actions import new_log_history
+from pywebagent.env.async_actions import AsyncActions, compile_async_step, STEP_FUNCTION_NAME
+from pywebagent.env.browser import BaseBrowserEnv, WebpageObservation, format_execution_error
+from pywebagent.env.marking import async_evaluate_in_frames, async_mark_frames
+from pywebagent.env.network import AssetCache, NetworkPolicy
+from pywebagent.env.delta import DeltaConfig, ObservationDelta, async_capture_thumbnail
+from pywebagent.env.sessions import DEFAULT_ACCOUNT, SessionStore, async_is_login_page
+from pywebagent.env.screenshot import ScreenshotConfig, async_capture_screenshot
+from pywebagent.env.server import connect_browser, get_browser_endpoint
+from pywebagent.env.settle import SettleConfig, async_wait_for_settle
+from pywebagent.env.spill import SpillStore
+from pywebagent import tracing
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBrowserEnv(BaseBrowserEnv):
+    """
+    Async counterpart of `BrowserEnv`.
+    Several environments can share one launched browser, each one works in its own isolated context.
+    """
+
+    def __init__(self, browser=None, headless: bool = True, settle_config: SettleConfig = None,
+                 incremental_marking: bool = True, screenshot_config: ScreenshotConfig = None,
+                 delta_config: DeltaConfig = None, network_policy: NetworkPolicy = None, asset_cache: AssetCache = None,
+                 session_store: SessionStore = None, session_account: str = DEFAULT_ACCOUNT, browser_endpoint: str = None,
+                 spill_store: SpillStore = None):
+        super().__init__(settle_config, incremental_marking, screenshot_config, delta_config, network_policy,
+                         asset_cache, session_store, session_account, spill_store)
+        self.browser = browser
+        self.browser_endpoint = browser_endpoint
+        self.headless = headless
+        self._owns_browser = browser is None
+        self._playwright_context_manager = None
+
+    async def start(self):
+        """Launches (or connects to) a private browser, only needed when no shared browser was given."""
+        if self.browser is None:
+            from playwright.async_api import async_playwright
+
+            self._playwright_context_manager = async_playwright()
+            playwright = await self._playwright_context_manager.__aenter__()
+            endpoint = get_browser_endpoint(self.browser_endpoint)
+            if endpoint:
+                self.browser = await connect_browser(playwright.chromium, endpoint)
+            else:
+                self.browser = await playwright.chromium.launch(
+                    channel="chrome",
+                    headless=self.headless,
+                )
+        return self
+
+    @tracing.traced("env.step")
+    async def step(self, code: str, marked_elements: list = []) -> WebpageObservation:
+        self.env_state.log_history = new_log_history()  # Clear log history to have logs only for the current step
+        actions = AsyncActions(self.page, marked_elements, self.env_state, self.sub_agent_runner)
+        context = {"actions": actions}
+        with tracing.span("env.exec", code_chars=len(code)) as span:
+            try:
+                error_message = None
+                logger.info(f"Executing code: {code}")
+                exec(compile_async_step(code), context, context)
+                await context[STEP_FUNCTION_NAME]()
+            except Exception as e:
+                error_message = format_execution_error(code, e, code_name=STEP_FUNCTION_NAME)
+                logger.warning(error_message)
+                span.record_error(error_message)
+            finally:
+                await self._remove_elements_marks()
+
+        settle_time = (await self._wait_for_settle()).waited
+        await self._update_session()
+
+        self.env_state.timeframe += 1
+        obs = await self.get_observation()
+
+        # if a new page was opened, switch to it
+        if len(self.context.pages) > 1:
+            await self.page.close()
+            self._set_page(self.context.pages[-1])
+            settle_time += (await self._wait_for_settle()).waited
+            obs = await self.get_observation()
+
+        obs.settle_time = settle_time
+        obs.error_message = error_message
+        return obs
+
+    @tracing.traced("env.mark_elements")
+    async def _mark_elements(self):
+        frames = self.page.frames
+        result = await async_mark_frames(frames, self._next_element_id, self.incremental_marking,
+                                         self._mark_elements_js_script)
+        return self._merge_marks(frames, result)
+
+    async def get_element_html(self, element_id: int) -> str:
+        """Fetches the HTML of a marked element from the page, only when it is actually needed."""
+        element_info = self.marked_elements[element_id]
+        return await element_info['iframe'].evaluate("id => window.__pywebagent__.html(id)", element_id)
+
+    @tracing.traced("env.remove_marks")
+    async def _remove_elements_marks(self):
+        await async_evaluate_in_frames(self.page.frames, self.remove_elements_marks_js_script)
+
+    @tracing.traced("env.observe")
+    async def get_observation(self) -> WebpageObservation:
+        marked_elements = await self._mark_elements()
+        if self._cdp_session is None:
+            self._cdp_session = await self.context.new_cdp_session(self.page)
+        image = await async_capture_screenshot(self.page, self._cdp_session, marked_elements, self.screenshot_config)
+        delta = await self._observe_delta(marked_elements) if self.delta_config is not None else None
+        return self._new_observation(marked_elements, image, delta)
+
+    @tracing.traced("env.reset")
+    async def reset(self, url) -> WebpageObservation:
+        await self.start()
+        session = self._load_session(url)
+        if self.context is not None:
+            await self.context.close()
+        self.context = await self.browser.new_context(**self._context_options(session))
+        self._set_page(await self.context.new_page())
+        await self.network_router.async_install(self.context)
+
+        #  Overrides the standard file picker function in the browser with a custom implementation
+        # for file selection. This allows filechooser events to be triggered from the python code.
+        await self.page.add_init_script(self.override_file_chooser_js_script)
+        await self.page.add_init_script(self._mark_elements_js_script)  # installs the marker in every frame once
+
+        await self.page.goto(url)
+        logger.info("Waiting for page to load...")
+        settle = await self._wait_for_settle()
+        logger.info("Page loaded")
+        self._start_run(url, session)
+        await self._update_session()
+        obs = await self.get_observation()
+        obs.settle_time = settle.waited
+        return obs
+
+    @tracing.traced("env.delta")
+    async def _observe_delta(self, marked_elements) -> ObservationDelta:
+        delta = self._compare_thumbnail(await async_capture_thumbnail(self.page, self._cdp_session))
+        if delta.image_mode == "crop":
+            delta.crop = await async_capture_screenshot(
+                self.page, self._cdp_session, marked_elements, self.screenshot_config, clip=delta.changed_region)
+        if delta.image_mode != "full":
+            delta.keyframe = await async_capture_screenshot(
+                self.page, self._cdp_session, marked_elements, self._keyframe_config())
+        self._log_delta(delta)
+        return delta
+
+    async def _update_session(self):
+        """Drops the saved session when the site asks to log in again, saves it once the task succeeded."""
+        if self._checks_login() and await async_is_login_page(self.page):
+            self._drop_session()
+        if self._saves_session():
+            try:
+                self.session_store.save(self._session_url, await self.context.storage_state(), self.session_account)
+            except Exception as e:
+                logger.warning(f"Could not save the session: {e}")
+
+    async def _wait_for_settle(self):
+        return await async_wait_for_settle(self.page, self._request_tracker, self.settle_config)
+
+    def spawn(self) -> "AsyncBrowserEnv":
+        """Creates an environment for a sub-agent, on this environment's browser but in its own context."""
+        return AsyncBrowserEnv(browser=self.browser, **self.spawn_options())
+
+    async def close(self):
+        if self.context is not None:
+            await self.context.close()
+            self.context = None
+        if self._owns_browser and self.browser is not None:
+            await self.browser.close()
+            self.browser = None
+            await self._playwright_context_manager.__aexit__(None, None, None)
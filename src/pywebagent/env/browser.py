@@ -1,16 +1,26 @@
-import os
-from pathlib import Path
-import traceback
-import time
 import logging
-from dataclasses import dataclass
-from typing import Any, Tuple, Dict
-from playwright.sync_api import sync_playwright
-from pywebagent.env.actions import Actions, EnvState
+from dataclasses import dataclass, field
+from typing import Any, List, Tuple, Dict
+from pywebagent.env.actions import Actions, EnvState, new_log_history
+from pywebagent.env.network import AssetCache, NetworkPolicy, NetworkRouter
+from pywebagent.env.marking import evaluate_in_frames, mark_frames, merge_frame_elements
+from pywebagent.env.delta import DeltaConfig, ObservationDelta, capture_thumbnail, compare, get_keyframe_config
+from pywebagent.env.sessions import DEFAULT_ACCOUNT, SessionStore, apply_storage_state, is_login_page
+from pywebagent.env.screenshot import Screenshot, ScreenshotConfig, capture_screenshot
+from pywebagent.env.scripts import load_js_script
+from pywebagent.env.server import connect_browser, get_browser_endpoint
+from pywebagent.env.settle import RequestTracker, SettleConfig, wait_for_settle
+from pywebagent.env.spill import SpillStore
+from pywebagent import tracing
 
 logger = logging.getLogger(__name__)
 
-JS_DIRECTORY = Path(os.path.dirname(os.path.realpath(__file__))) / "../js"
+CONTEXT_OPTIONS = {
+    "viewport": {"width": 1600, "height": 900},
+    "storage_state": None,
+    "geolocation": {"longitude": -122.417168, "latitude": 37.785834},  # USA
+    "device_scale_factor": 1,
+}
 
 
 @dataclass
@@ -20,150 +30,340 @@ class WebpageObservation:
     screenshot: bytes
     marked_elements: Dict[str, Any]
     env_state: EnvState = None
+    image: Screenshot = None  # the encoded screenshot, `screenshot` holds its bytes
+    settle_time: float = 0.0  # seconds spent waiting for the page to settle before this observation
+    delta: ObservationDelta = None  # visual change since the previous observation, with a `delta_config`
+    added_element_ids: List[int] = field(default_factory=list)  # marked since the previous observation
+    removed_element_ids: List[int] = field(default_factory=list)  # no longer marked since the previous observation
 
+    def spill(self, store: SpillStore) -> None:
+        """Moves the screenshots to `store`, they are read back from disk if they are needed again."""
+        images = [self.image] + ([self.delta.crop, self.delta.keyframe] if self.delta is not None else [])
+        for image in images:
+            if image is not None:
+                image.spill(store)
+        if self.image is not None:
+            self.screenshot = self.image.data
+        elif isinstance(self.screenshot, bytes):
+            self.screenshot = store.put(self.screenshot)
 
-class BrowserEnv:
-    def __init__(self, headless: bool = True):
-        # headless = 'new' if headless else False TODO make this work
-        self.context_manager = sync_playwright()
-        self.playwright = self.context_manager.__enter__()
-        self.browser = self.playwright.chromium.launch(
-            channel="chrome",
-            headless=headless,
+
+def diff_element_ids(previous: Dict[int, Any], current: Dict[int, Any]) -> Tuple[List[int], List[int]]:
+    """Returns the (added, removed) ids between two observations' marked elements, ids are stable across steps."""
+    added = sorted(current.keys() - previous.keys())
+    removed = sorted(previous.keys() - current.keys())
+    return added, removed
+
+
+def format_execution_error(code: str, e: Exception, code_name: str = "<module>") -> str:
+    """Builds the error message shown to the model, pointing at the failing line of the generated code."""
+    # Extract exception line number and rethrow it with it
+    exc_tb = e.__traceback__
+    line_of_code = "N/A"
+    while exc_tb is not None:
+        frame = exc_tb.tb_frame
+        lineno = exc_tb.tb_lineno
+        if frame.f_code.co_name == code_name and frame.f_code.co_filename == "<string>":
+            line_of_code = code.split('\n')[lineno - 1].lstrip()
+            break
+        exc_tb = exc_tb.tb_next
+
+    return f"Error in execution of script. At line: \"{line_of_code}\". Error: \"{e}\""
+
+
+class BaseBrowserEnv:
+    """
+    What `BrowserEnv` and `AsyncBrowserEnv` share: their options, the state of a run and the decisions made from it.
+    The calls to the browser, sync or async, are left to them.
+    """
+
+    def __init__(self, settle_config: SettleConfig = None, incremental_marking: bool = True,
+                 screenshot_config: ScreenshotConfig = None, delta_config: DeltaConfig = None,
+                 network_policy: NetworkPolicy = None, asset_cache: AssetCache = None, session_store: SessionStore = None,
+                 session_account: str = DEFAULT_ACCOUNT, spill_store: SpillStore = None):
+        self.settle_config = settle_config or SettleConfig()
+        self.incremental_marking = incremental_marking
+        self.screenshot_config = screenshot_config or ScreenshotConfig()
+        self.screenshot_sizes = []  # bytes of each observation's screenshot since reset
+        self.delta_config = delta_config
+        self._previous_thumbnail = None
+        self.spill_store = spill_store  # past observations' screenshots are moved there
+        self._last_observation = None
+        self.network_router = NetworkRouter(network_policy, asset_cache)
+        self.session_store = session_store
+        self.session_account = session_account
+        self._session_url = None
+        self._session_loaded = False  # a saved session is in use and was not rejected by the site yet
+        self.context = None
+        self.page = None
+        self._cdp_session = None
+        self.sub_agent_runner = None  # set by the agent, runs sub-agents for `actions.act`
+        self.marked_elements = {}
+        self._next_element_id = 0  # ids are never reused until reset, so the model's ids stay meaningful
+
+        self._mark_elements_js_script = load_js_script("mark_borders.js")
+        self.remove_elements_marks_js_script = load_js_script("remove_mark_borders.js")
+        self.override_file_chooser_js_script = load_js_script("override_file_chooser.js")
+
+    def spawn_options(self) -> Dict[str, Any]:
+        """The options a sub-agent's environment gets from this one, it works as the same account."""
+        return dict(settle_config=self.settle_config, incremental_marking=self.incremental_marking,
+                    screenshot_config=self.screenshot_config, delta_config=self.delta_config,
+                    network_policy=self.network_router.policy, asset_cache=self.network_router.cache,
+                    session_store=self.session_store, session_account=self.session_account,
+                    spill_store=self.spill_store)
+
+    def _load_session(self, url):
+        return self.session_store.load(url, self.session_account) if self.session_store else None
+
+    @staticmethod
+    def _context_options(session) -> Dict[str, Any]:
+        return {**CONTEXT_OPTIONS, "storage_state": session}
+
+    def _start_run(self, url, session) -> None:
+        """Starts the state of a new run on `url`, once its page loaded."""
+        self._session_url = url
+        self._session_loaded = session is not None
+        self.env_state = EnvState()
+        self.marked_elements = {}
+        self._next_element_id = 0
+        self.screenshot_sizes = []
+
+    def _checks_login(self) -> bool:
+        """A login page is only looked for while a saved session is in use."""
+        return self.session_store is not None and self._session_loaded
+
+    def _drop_session(self) -> None:
+        logger.info(f"Landed on a login page at {self.page.url}, the saved session is no longer valid")
+        self.session_store.invalidate(self._session_url, self.session_account)
+        self._session_loaded = False
+
+    def _saves_session(self) -> bool:
+        return self.session_store is not None and self.env_state.has_successfully_completed
+
+    def _merge_marks(self, frames: list, result) -> Dict[int, Any]:
+        self._next_element_id = result.next_id
+        return merge_frame_elements(frames, result)
+
+    def _new_observation(self, marked_elements, image: Screenshot, delta: ObservationDelta) -> WebpageObservation:
+        """The observation of the elements and images just captured, the previous observation is spilled."""
+        added_element_ids, removed_element_ids = diff_element_ids(self.marked_elements, marked_elements)
+        self.marked_elements = marked_elements
+        self.screenshot_sizes.append(image.size)
+        observation = WebpageObservation(
+            url=self.page.url,
+            error_message=None,
+            screenshot=image.data,
+            image=image,
+            delta=delta,
+            marked_elements=marked_elements,
+            env_state=self.env_state,
+            added_element_ids=added_element_ids,
+            removed_element_ids=removed_element_ids,
         )
+        self._spill_last_observation(observation)
+        return observation
 
-        with open(JS_DIRECTORY / "mark_borders.js", 'r') as file:
-            self._mark_elements_js_script = file.read()
-        with open(JS_DIRECTORY / "remove_mark_borders.js", 'r') as file:
-            self.remove_elements_marks_js_script = file.read()
-        with open(JS_DIRECTORY / "override_file_chooser.js", 'r') as file:
-            self.override_file_chooser_js_script = file.read()
-        
+    def _spill_last_observation(self, observation: WebpageObservation):
+        if self.spill_store is None:
+            return
+        if self._last_observation is not None:
+            self._last_observation.spill(self.spill_store)
+        self._last_observation = observation
+
+    def _compare_thumbnail(self, thumbnail) -> ObservationDelta:
+        delta = compare(self._previous_thumbnail, thumbnail, self.delta_config)
+        self._previous_thumbnail = thumbnail
+        return delta
+
+    def _keyframe_config(self) -> ScreenshotConfig:
+        return get_keyframe_config(self.screenshot_config, self.delta_config)
+
+    @staticmethod
+    def _log_delta(delta: ObservationDelta) -> None:
+        logger.info(f"Page changed by {delta.changed_fraction:.1%}, sending {delta.image_mode} image")
+        tracing.current_span().set(image_mode=delta.image_mode, changed_fraction=delta.changed_fraction)
+
+    def _set_page(self, page):
+        self.page = page
+        self._request_tracker = RequestTracker(page)
+        self._cdp_session = None
+        self._previous_thumbnail = None
+
+
+class BrowserEnv(BaseBrowserEnv):
+    def __init__(self, headless: bool = True, pool=None, browser=None, settle_config: SettleConfig = None,
+                 incremental_marking: bool = True, screenshot_config: ScreenshotConfig = None,
+                 delta_config: DeltaConfig = None, network_policy: NetworkPolicy = None, asset_cache: AssetCache = None,
+                 session_store: SessionStore = None, session_account: str = DEFAULT_ACCOUNT, browser_endpoint: str = None,
+                 spill_store: SpillStore = None):
+        """
+        Launches a private browser, unless a `BrowserPool` or an already launched `browser` is given.
+        With a `browser_endpoint` (or PYWEBAGENT_BROWSER_ENDPOINT), it connects to a running browser instead.
+        With a pool, `reset` leases a warm context from it and `close` gives it back.
+        `settle_config` bounds how long to wait for the page to become quiet after each action.
+        With `incremental_marking`, only the parts of the page that changed since the last observation are re-marked.
+        `screenshot_config` sets the format, quality, size budget and cropping of the screenshots sent to the LLM.
+        With `delta_config`, observations tell how the page changed visually, so unchanged pages aren't resent in full.
+        `network_policy` blocks requests by resource type and domain, `asset_cache` serves static assets from disk.
+        With a `session_store`, the logged in state of `session_account` on the site is loaded on reset and saved
+        when the task succeeds, so repeated tasks skip the login.
+        With a `spill_store`, the screenshots of an observation are moved to disk once the next one is taken.
+        """
+        super().__init__(settle_config, incremental_marking, screenshot_config, delta_config, network_policy,
+                         asset_cache, session_store, session_account, spill_store)
+        self.pool = pool
+        self.lease = None
+        self._owns_browser = pool is None and browser is None
+        self.browser = browser
+        if self._owns_browser:
+            from playwright.sync_api import sync_playwright  # only needed here, keeps importing the agent cheap
+
+            # headless = 'new' if headless else False TODO make this work
+            self.context_manager = sync_playwright()
+            self.playwright = self.context_manager.__enter__()
+            endpoint = get_browser_endpoint(browser_endpoint)
+            if endpoint:
+                self.browser = connect_browser(self.playwright.chromium, endpoint)
+            else:
+                self.browser = self.playwright.chromium.launch(
+                    channel="chrome",
+                    headless=headless,
+                )
+
+    @tracing.traced("env.step")
     def step(self, code: str, marked_elements: list = []) -> WebpageObservation:
-        self.env_state.log_history = []  # Clear log history to have logs only for the current step
-        actions = Actions(self.page, marked_elements, self.env_state)
+        self.env_state.log_history = new_log_history()  # Clear log history to have logs only for the current step
+        actions = Actions(self.page, marked_elements, self.env_state, self.sub_agent_runner)
         context = {"actions": actions}
-        try:
-            error_message = None
-            logger.info(f"Executing code: {code}")
-            exec(code, context, context)
-        except Exception as e:
-            # Extract exception line number and rethrow it with it
-            _, _, exc_tb = traceback.sys.exc_info()
-            line_of_code = "N/A"
-            while exc_tb is not None:
-                frame = exc_tb.tb_frame
-                lineno = exc_tb.tb_lineno
-                if frame.f_code.co_name == "<module>" and frame.f_code.co_filename == "<string>":
-                    line_of_code = code.split('\n')[lineno - 1].lstrip()
-                    break
-                exc_tb = exc_tb.tb_next
-
-            error_message = f"Error in execution of script. At line: \"{line_of_code}\". Error: \"{e}\""
-            logger.warning(error_message)
-        finally:
-            self._remove_elements_marks()
-
-        try:
-            self.page.wait_for_load_state("networkidle", timeout=5000)
-        except Exception as e:
-            logger.warning(f"Exception while waiting for load state: {e}")
+        with tracing.span("env.exec", code_chars=len(code)) as span:
+            try:
+                error_message = None
+                logger.info(f"Executing code: {code}")
+                exec(code, context, context)
+            except Exception as e:
+                error_message = format_execution_error(code, e)
+                logger.warning(error_message)
+                span.record_error(error_message)
+            finally:
+                self._remove_elements_marks()
+
+        settle_time = self._wait_for_settle().waited
+        self._update_session()
 
         self.env_state.timeframe += 1
-        time.sleep(2)
         obs = self.get_observation()
 
         # if a new page was opened, switch to it
         if len(self.context.pages) > 1:
             self.page.close()
-            self.page = self.context.pages[-1]
-            try:
-                self.page.wait_for_load_state("networkidle", timeout=5000)
-            except Exception as e:
-                logger.warning(f"Exception while waiting for load state: {e}")
+            self._set_page(self.context.pages[-1])
+            settle_time += self._wait_for_settle().waited
             obs = self.get_observation()
 
+        obs.settle_time = settle_time
         obs.error_message = error_message
         return obs
     
+    @tracing.traced("env.mark_elements")
     def _mark_elements(self):
-        def run_script_in_frame(frame, counter, iframe_name=None):
-            # Modify the script to start with the specific counter
-            modified_script = self._mark_elements_js_script.replace(
-                'let counter = 0;', f'let counter = {counter};')
-
-            try:
-                elements = frame.evaluate(modified_script)
-            except Exception as e:
-                # log exception
-                logger.warning(f"Exception while running script in frame {iframe_name}: {e}")
-                elements = []
-
-            # Add iframe origin information to each element
-            for element in elements:
-                element['iframe'] = frame
-                element['iframe_name'] = iframe_name
-
-            return elements
-
-        counter = 0
-        marked_elements = []
-        for frame in self.page.frames:
-            iframe_name = frame.name or frame.url  # Use the frame's name or URL as an identifier
-            marked_elements_iframe = run_script_in_frame(frame, counter, iframe_name=iframe_name)
-            marked_elements.extend(marked_elements_iframe)
-            counter += len(marked_elements_iframe)
-
-        marked_elements = {element['id']: element for element in marked_elements}
-        return marked_elements
+        frames = self.page.frames
+        result = mark_frames(frames, self._next_element_id, self.incremental_marking, self._mark_elements_js_script)
+        return self._merge_marks(frames, result)
     
+    def get_element_html(self, element_id: int) -> str:
+        """Fetches the HTML of a marked element from the page, only when it is actually needed."""
+        element_info = self.marked_elements[element_id]
+        return element_info['iframe'].evaluate("id => window.__pywebagent__.html(id)", element_id)
+
+    @tracing.traced("env.remove_marks")
     def _remove_elements_marks(self):
-        for frame in self.page.frames:
-            try:
-                frame.evaluate(self.remove_elements_marks_js_script)
-            except Exception as e:
-                logger.warning(f"Exception while running removal script in frame {frame.name}: {e}")
-                if "Target closed" in str(e):
-                    return 
+        evaluate_in_frames(self.page.frames, self.remove_elements_marks_js_script)
     
+    @tracing.traced("env.observe")
     def get_observation(self) -> WebpageObservation:
         marked_elements = self._mark_elements()
-        screenshot = self.page.screenshot()
-
-        return WebpageObservation(
-            url=self.page.url,
-            error_message=None,
-            screenshot=screenshot,
-            marked_elements=marked_elements,
-            env_state = self.env_state,
-        )
+        if self._cdp_session is None:
+            self._cdp_session = self.context.new_cdp_session(self.page)
+        image = capture_screenshot(self.page, self._cdp_session, marked_elements, self.screenshot_config)
+        delta = self._observe_delta(marked_elements) if self.delta_config is not None else None
+        return self._new_observation(marked_elements, image, delta)
         
+    @tracing.traced("env.reset")
     def reset(self, url) -> Tuple[WebpageObservation, Dict[str, Any]]:
-        geolocation = {"longitude": -122.417168, "latitude": 37.785834}  # USA
-        self.context = self.browser.new_context(
-            viewport={"width": 1600, "height": 900},
-            storage_state=None,
-            geolocation=geolocation,
-            device_scale_factor=1,
-        )
-        self.page = self.context.new_page()
+        session = self._load_session(url)
+        if self.pool is not None:
+            if self.lease is not None:
+                self.lease.page = self.page  # the agent may have switched to a newly opened page
+                self.pool.release(self.lease)
+            self.lease = self.pool.acquire()
+            self.context = self.lease.context
+            self._set_page(self.lease.page)
+            if session:
+                apply_storage_state(self.context, self.page, session)
+        else:
+            if self.context is not None:
+                self.context.close()  # every run starts from a clean context, its pages and memory are freed
+            self.context = self.browser.new_context(**self._context_options(session))
+            self._set_page(self.context.new_page())
+        self.network_router.install(self.context)  # on the context, so pages opened by the agent are routed too
 
         #  Overrides the standard file picker function in the browser with a custom implementation 
         # for file selection. This allows filechooser events to be triggered from the python code.
         self.page.add_init_script(self.override_file_chooser_js_script)
+        self.page.add_init_script(self._mark_elements_js_script)  # installs the marker in every frame once
 
         self.page.goto(url)
         logger.info("Waiting for page to load...")
-        try:
-            self.page.wait_for_load_state("networkidle")
-        except Exception as e:
-            logger.warning(f"Exception while waiting for load state: {e}")
-            # try to wait for "load" state, sometimes the page is stuck with network traffic loading
-            self.page.wait_for_load_state("load")
+        settle = self._wait_for_settle()
         logger.info("Page loaded")
-        self.env_state = EnvState()
-        return self.get_observation()
+        self._start_run(url, session)
+        self._update_session()
+        obs = self.get_observation()
+        obs.settle_time = settle.waited
+        return obs
+
+    @tracing.traced("env.delta")
+    def _observe_delta(self, marked_elements) -> ObservationDelta:
+        delta = self._compare_thumbnail(capture_thumbnail(self.page, self._cdp_session))
+        if delta.image_mode == "crop":
+            delta.crop = capture_screenshot(
+                self.page, self._cdp_session, marked_elements, self.screenshot_config, clip=delta.changed_region)
+        if delta.image_mode != "full":
+            delta.keyframe = capture_screenshot(self.page, self._cdp_session, marked_elements, self._keyframe_config())
+        self._log_delta(delta)
+        return delta
+
+    def _update_session(self):
+        """Drops the saved session when the site asks to log in again, saves it once the task succeeded."""
+        if self._checks_login() and is_login_page(self.page):
+            self._drop_session()
+        if self._saves_session():
+            try:
+                self.session_store.save(self._session_url, self.context.storage_state(), self.session_account)
+            except Exception as e:
+                logger.warning(f"Could not save the session: {e}")
+
+    def _wait_for_settle(self):
+        return wait_for_settle(self.page, self._request_tracker, self.settle_config)
+
+    def spawn(self) -> "BrowserEnv":
+        """Creates an environment for a sub-agent, on this environment's browser (or pool) but in its own context."""
+        if self.pool is not None:
+            return BrowserEnv(pool=self.pool, **self.spawn_options())
+        return BrowserEnv(browser=self.browser, **self.spawn_options())
 
     def close(self):
-        self.context_manager.__exit__()
+        if self.pool is not None:
+            if self.lease is not None:
+                self.lease.page = self.page  # the agent may have switched to a newly opened page
+                self.pool.release(self.lease)
+                self.lease = None
+            return
+        if not self._owns_browser:
+            if self.context is not None:
+                self.context.close()
+                self.context = None
+            return
         self.browser.close()
+        self.context_manager.__exit__()
@@ -0,0 +1,169 @@
+"""
+Visual change between two observations, so unchanged or barely changed pages don't resend a full screenshot.
+
+A tiny PNG of the viewport is captured with the DevTools protocol (the browser does the downscaling),
+decoded with Pillow and compared with NumPy: a perceptual hash for large changes and a per-pixel diff that
+locates the changed region.
+"""
+import base64
+import io
+import logging
+from dataclasses import dataclass, replace
+from typing import Dict, Optional
+import numpy as np
+from PIL import Image
+from pywebagent import tracing
+from pywebagent.env.screenshot import VIEWPORT_JS, Screenshot, ScreenshotConfig
+
+logger = logging.getLogger(__name__)
+
+IMAGE_MODES = ("none", "crop", "full")
+THUMBNAIL_WIDTH = 160
+HASH_SIZE = 8  # 64 bit hash
+MIN_KEYFRAME_WIDTH = 512  # narrower, the element labels can't be read
+
+
+@dataclass
+class DeltaConfig:
+    none_below: float = 0.002  # changed fraction of the viewport under which no new image is sent
+    crop_below: float = 0.3  # changed fraction under which only the changed region is sent
+    pixel_threshold: int = 24  # grayscale difference (0-255) for a thumbnail pixel to count as changed
+    hash_distance_full: int = 16  # hash bits that differ for the change to be a new page, whatever the diff says
+    crop_margin: int = 40  # page px around the changed region
+    keyframe_width: int = 1024  # px, full frame sent with "none" and "crop", the prompt has no earlier screenshot
+
+    def __post_init__(self):
+        if self.keyframe_width is None or self.keyframe_width < MIN_KEYFRAME_WIDTH:
+            raise ValueError(f"keyframe_width must be at least {MIN_KEYFRAME_WIDTH} px for the element labels to be "
+                             f"readable, got {self.keyframe_width}")
+
+
+@dataclass
+class Thumbnail:
+    pixels: np.ndarray  # grayscale, float32
+    viewport: Dict[str, float]  # page area it covers
+    url: str
+
+    @property
+    def phash(self) -> int:
+        if "_phash" not in self.__dict__:
+            self._phash = perceptual_hash(self.pixels)
+        return self._phash
+
+
+@dataclass
+class ObservationDelta:
+    image_mode: str  # one of IMAGE_MODES
+    phash: int
+    hash_distance: Optional[int] = None  # bits differing from the previous observation's hash
+    changed_fraction: float = 1.0
+    changed_region: Optional[Dict[str, float]] = None  # page coordinates
+    crop: Optional[Screenshot] = None  # the changed region, for "crop"
+    keyframe: Optional[Screenshot] = None  # downscaled full frame, for "none" and "crop"
+
+
+def decode_thumbnail(data: bytes) -> np.ndarray:
+    """Decodes a thumbnail to grayscale pixels with Pillow."""
+    with Image.open(io.BytesIO(data)) as image:
+        return np.asarray(image.convert("L"), dtype=np.float32)
+
+
+def _block_means(gray: np.ndarray, rows: int, columns: int) -> np.ndarray:
+    height, width = gray.shape
+    row_edges = np.linspace(0, height, rows + 1).astype(int)
+    column_edges = np.linspace(0, width, columns + 1).astype(int)
+    return np.array([
+        [gray[row_edges[r]:max(row_edges[r + 1], row_edges[r] + 1), column_edges[c]:max(column_edges[c + 1], column_edges[c] + 1)].mean()
+         for c in range(columns)]
+        for r in range(rows)
+    ])
+
+
+def perceptual_hash(gray: np.ndarray) -> int:
+    """Difference hash: each bit tells if a block is brighter than its right neighbour."""
+    blocks = _block_means(gray, HASH_SIZE, HASH_SIZE + 1)
+    bits = (blocks[:, 1:] > blocks[:, :-1]).flatten()
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+
+def screenshot_hash(data: bytes) -> int:
+    """Perceptual hash of an encoded screenshot, decoded at about the size of a thumbnail."""
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft("L", (THUMBNAIL_WIDTH, THUMBNAIL_WIDTH))  # JPEGs are decoded already downscaled
+        gray = image.convert("L")
+    gray.thumbnail((THUMBNAIL_WIDTH, THUMBNAIL_WIDTH))
+    return perceptual_hash(np.asarray(gray, dtype=np.float32))
+
+
+def hash_distance(hash1: int, hash2: int) -> int:
+    return bin(hash1 ^ hash2).count("1")
+
+
+def changed_region(previous: Thumbnail, current: Thumbnail, config: DeltaConfig):
+    """The changed fraction of the viewport, and the bounding box of the change in page coordinates."""
+    if previous.pixels.shape != current.pixels.shape:
+        return 1.0, None
+    changed = np.abs(current.pixels - previous.pixels) > config.pixel_threshold
+    fraction = float(changed.mean())
+    if not changed.any():
+        return fraction, None
+    rows, columns = np.nonzero(changed)
+    height, width = changed.shape
+    viewport = current.viewport
+    scale_x, scale_y = viewport["width"] / width, viewport["height"] / height
+    left = max(0.0, columns.min() * scale_x - config.crop_margin)
+    top = max(0.0, rows.min() * scale_y - config.crop_margin)
+    right = min(viewport["width"], (columns.max() + 1) * scale_x + config.crop_margin)
+    bottom = min(viewport["height"], (rows.max() + 1) * scale_y + config.crop_margin)
+    region = {"x": viewport["x"] + left, "y": viewport["y"] + top, "width": right - left, "height": bottom - top}
+    return fraction, region
+
+
+def compare(previous: Optional[Thumbnail], current: Thumbnail, config: DeltaConfig) -> ObservationDelta:
+    """Decides what image the next prompt needs."""
+    phash = current.phash
+    if previous is None or previous.url != current.url or previous.viewport != current.viewport:
+        return ObservationDelta(image_mode="full", phash=phash)
+    distance = hash_distance(previous.phash, phash)
+    fraction, region = changed_region(previous, current, config)
+    delta = ObservationDelta(image_mode="full", phash=phash, hash_distance=distance,
+                             changed_fraction=fraction, changed_region=region)
+    if distance >= config.hash_distance_full:
+        return delta
+    if fraction < config.none_below:
+        delta.image_mode = "none"
+    elif fraction < config.crop_below and region is not None:
+        delta.image_mode = "crop"
+    return delta
+
+
+def get_keyframe_config(screenshot_config: ScreenshotConfig, config: DeltaConfig) -> ScreenshotConfig:
+    """The full viewport, downscaled but in the detail of the screenshots so its labels stay readable."""
+    max_width = min(screenshot_config.max_width or config.keyframe_width, config.keyframe_width)
+    return replace(screenshot_config, max_width=max_width, max_bytes=None, crop_to_marked_elements=False)
+
+
+def _thumbnail_params(viewport):
+    return {
+        "format": "png",
+        "clip": {**viewport, "scale": THUMBNAIL_WIDTH / max(viewport["width"], 1)},
+        "captureBeyondViewport": False,
+    }
+
+
+def _to_thumbnail(data: str, viewport, url) -> Thumbnail:
+    return Thumbnail(pixels=decode_thumbnail(base64.b64decode(data)), viewport=viewport, url=url)
+
+
+@tracing.traced("env.thumbnail")
+def capture_thumbnail(page, cdp_session) -> Thumbnail:
+    viewport = page.evaluate(VIEWPORT_JS)
+    data = cdp_session.send("Page.captureScreenshot", _thumbnail_params(viewport))["data"]
+    return _to_thumbnail(data, viewport, page.url)
+
+
+@tracing.traced("env.thumbnail")
+async def async_capture_thumbnail(page, cdp_session) -> Thumbnail:
+    viewport = await page.evaluate(VIEWPORT_JS)
+    data = (await cdp_session.send("Page.captureScreenshot", _thumbnail_params(viewport)))["data"]
+    return _to_thumbnail(data, viewport, page.url)
@@ -0,0 +1,254 @@
+"""
+Marks the elements of all the frames of a page.
+
+mark_borders.js installs `window.__pywebagent_marker__` in each document once, by an init script or on first use,
+afterwards a pass only sends its options. Frames that can't show anything, such as hidden ad or tracking frames,
+are skipped, their parent frame lists which of its frame elements are visible in one call.
+
+The sync playwright API can only wait for one call at a time, so `mark_frames` marks the visible frames one after
+another, in a single round trip each, a parent frame lists its frames in the same call as its marking.
+`async_mark_frames`, used by the async environment, lists the frames of all the parents at the same time, measures
+the visible frames at the same time, and once each frame tells how many new elements it found, draws them at the same
+time with consecutive id ranges. Its latency is a few round trips whatever the number of frames.
+"""
+import asyncio
+import logging
+import sys
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
+from pywebagent import tracing
+
+logger = logging.getLogger(__name__)
+
+MARK_JS = "options => window.__pywebagent_marker__ ? window.__pywebagent_marker__.mark(options) : null"
+MEASURE_JS = "options => window.__pywebagent_marker__ ? window.__pywebagent_marker__.measure(options) : null"
+DRAW_JS = "nextId => window.__pywebagent_marker__.draw(nextId)"
+FRAMES_JS = "() => window.__pywebagent_marker__ ? window.__pywebagent_marker__.frames() : null"
+
+
+@dataclass
+class MarkingResult:
+    elements: Dict[int, List[Dict[str, Any]]] = field(default_factory=dict)  # frame index -> marked elements
+    next_id: int = 0
+    skipped_frames: int = 0
+    incremental_frames: int = 0
+    errors: List[str] = field(default_factory=list)
+
+
+def get_frame_name(frame) -> str:
+    return frame.name or frame.url  # Use the frame's name or URL as an identifier
+
+
+class MarkedElement:
+    """
+    A marked element, as described by the marker, and the frame it is in.
+    Slotted, pages have hundreds of them, and read like the marker's dict: `element['tag']`, `element.get('value')`.
+    Fields the marker left out are None and missing from the mapping.
+    """
+
+    __slots__ = ("id", "tag", "bbox", "label", "role", "name", "region", "value", "states", "iframe")
+
+    def __init__(self, id: int, tag: str, bbox: Dict[str, int], label: str = None, role: str = None, name: str = None,
+                 region: str = None, value: str = None, states: List[str] = None, iframe=None):
+        self.id = id
+        self.tag = sys.intern(tag)  # the same few strings on every element
+        self.bbox = bbox
+        self.label = label
+        self.role = sys.intern(role) if role else role
+        self.name = name
+        self.region = sys.intern(region) if region else region
+        self.value = value
+        self.states = states
+        self.iframe = iframe
+
+    @classmethod
+    def from_metadata(cls, metadata: Dict[str, Any], frame) -> "MarkedElement":
+        return cls(**{key: metadata.get(key) for key in cls.__slots__ if key != "iframe"}, iframe=frame)
+
+    @property
+    def iframe_name(self) -> str:
+        return get_frame_name(self.iframe)
+
+    def __getitem__(self, key: str):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key: str, default=None):
+        value = getattr(self, key, None) if key in self.__slots__ or key == "iframe_name" else None
+        return default if value is None else value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __repr__(self) -> str:
+        return f"MarkedElement({self.id}, {self.tag}, {self.name or self.label!r})"
+
+
+def child_frames_visibility(children: list, embeds: List[Dict[str, Any]]) -> Dict[Any, bool]:
+    """
+    Matches the child frames of a frame to the frame elements listed by its marker, by name, then by url, then in
+    order when as many of both are left. Children left without a match aren't in the result.
+    """
+    visibility = {}
+    embeds = list(embeds)
+    for attribute, key in (("name", "name"), ("url", "src")):
+        embed_counts = Counter(embed[key] for embed in embeds)
+        child_counts = Counter(getattr(child, attribute) for child in children if child not in visibility)
+        for child in children:
+            value = getattr(child, attribute)
+            if child in visibility or not value or embed_counts[value] != 1 or child_counts[value] != 1:
+                continue
+            embed = next(embed for embed in embeds if embed[key] == value)
+            visibility[child] = embed["visible"]
+            embeds.remove(embed)
+    rest = [child for child in children if child not in visibility]
+    if len(rest) == len(embeds):
+        visibility.update((child, embed["visible"]) for child, embed in zip(rest, embeds))
+    return visibility
+
+
+def is_frame_shown(frame, shown: Dict[Any, bool], visibility: Dict[Any, bool]) -> bool:
+    """
+    The main frame is, a child frame when its parent is and its element is visible (or wasn't listed).
+    Frames come after their parents in `page.frames`, `shown` records the frames seen so far.
+    """
+    parent = frame.parent_frame
+    shown[frame] = parent is None or (
+        shown.get(parent, True) and visibility.get(frame, True) and not frame.is_detached())
+    return shown[frame]
+
+
+def evaluate_marker(frame, expression: str, arg, install_script: str):
+    """Calls the marker, installing it first in documents the init script didn't run in (e.g. pages opened before)."""
+    result = frame.evaluate(expression, arg)
+    if result is None:
+        frame.evaluate(install_script)
+        result = frame.evaluate(expression, arg)
+    return result
+
+
+async def async_evaluate_marker(frame, expression: str, arg, install_script: str):
+    """Async version of `evaluate_marker`."""
+    result = await frame.evaluate(expression, arg)
+    if result is None:
+        await frame.evaluate(install_script)
+        result = await frame.evaluate(expression, arg)
+    return result
+
+
+def record_error(result: MarkingResult, frame, error) -> None:
+    message = f"Exception while running script in frame {get_frame_name(frame)}: {error}"
+    logger.warning(message)
+    result.errors.append(message)
+
+
+def add_marks(result: MarkingResult, index: int, marks: Dict[str, Any]) -> None:
+    result.elements[index] = marks["elements"]
+    result.next_id = marks["nextId"]
+    result.incremental_frames += int(marks["incremental"])
+
+
+def mark_frames(frames: list, next_id: int, incremental: bool, install_script: str) -> MarkingResult:
+    """
+    Marks the visible frames one after another, new elements get ids starting at `next_id`, in the order of `frames`.
+    A frame that fails is logged and has no elements, the other frames are still marked.
+    """
+    result = MarkingResult(next_id=next_id)
+    shown, visibility = {}, {}
+    for index, frame in enumerate(frames):
+        if not is_frame_shown(frame, shown, visibility):
+            result.skipped_frames += 1
+            continue
+        children = frame.child_frames
+        options = {"nextId": result.next_id, "incremental": incremental, "frames": bool(children)}
+        try:
+            marks = evaluate_marker(frame, MARK_JS, options, install_script)
+        except Exception as e:
+            record_error(result, frame, e)
+            continue
+        add_marks(result, index, marks)
+        if children:
+            visibility.update(child_frames_visibility(children, marks["frames"]))
+    return result
+
+
+async def async_mark_frames(frames: list, next_id: int, incremental: bool, install_script: str) -> MarkingResult:
+    """Async version of `mark_frames`, the frames are marked concurrently."""
+    result = MarkingResult(next_id=next_id)
+    parents = [frame for frame in frames if frame.child_frames]
+    listed = await asyncio.gather(
+        *(async_evaluate_marker(frame, FRAMES_JS, None, install_script) for frame in parents), return_exceptions=True)
+    visibility = {}
+    for parent, embeds in zip(parents, listed):
+        if not isinstance(embeds, Exception):  # otherwise its frames are marked
+            visibility.update(child_frames_visibility(parent.child_frames, embeds))
+    shown = {}
+    indices = [index for index, frame in enumerate(frames) if is_frame_shown(frame, shown, visibility)]
+    result.skipped_frames = len(frames) - len(indices)
+    options = {"nextId": next_id, "incremental": incremental, "frames": False}
+
+    if len(indices) == 1:  # usually, a single round trip then
+        index = indices[0]
+        try:
+            marks = await async_evaluate_marker(frames[index], MARK_JS, options, install_script)
+        except Exception as e:
+            record_error(result, frames[index], e)
+            return result
+        add_marks(result, index, marks)
+        return result
+
+    measured = await asyncio.gather(
+        *(async_evaluate_marker(frames[index], MEASURE_JS, options, install_script) for index in indices),
+        return_exceptions=True)
+    start_ids = {}
+    for index, measure in zip(indices, measured):
+        if isinstance(measure, Exception):
+            record_error(result, frames[index], measure)
+            continue
+        start_ids[index] = result.next_id
+        result.next_id += measure["newElements"]
+        result.incremental_frames += int(measure["incremental"])
+
+    drawn = await asyncio.gather(
+        *(frames[index].evaluate(DRAW_JS, start_id) for index, start_id in start_ids.items()), return_exceptions=True)
+    for index, marks in zip(start_ids, drawn):
+        if isinstance(marks, Exception):
+            record_error(result, frames[index], marks)  # its id range is left unused
+            continue
+        result.elements[index] = marks["elements"]
+    return result
+
+
+def merge_frame_elements(frames: list, result: MarkingResult) -> Dict[int, MarkedElement]:
+    """The marked elements of all the frames by id, each one knows the frame it is in."""
+    marked_elements = {}
+    for index, elements in result.elements.items():
+        for metadata in elements:
+            marked_elements[metadata['id']] = MarkedElement.from_metadata(metadata, frames[index])
+    span = tracing.current_span()
+    span.set(frames=len(frames), skipped_frames=result.skipped_frames, incremental_frames=result.incremental_frames,
+             elements=len(marked_elements))
+    for error in result.errors:
+        span.record_error(error)
+    return marked_elements
+
+
+def evaluate_in_frames(frames: list, script: str) -> None:
+    """Runs a script in all the frames, logging the frames it failed in."""
+    for frame in frames:
+        try:
+            frame.evaluate(script)
+        except Exception as e:
+            if "Target closed" not in str(e):
+                logger.warning(f"Exception while running script in frame {get_frame_name(frame)}: {e}")
+
+
+async def async_evaluate_in_frames(frames: list, script: str) -> None:
+    """Async version of `evaluate_in_frames`, runs the script in all the frames at once."""
+    results = await asyncio.gather(*(frame.evaluate(script) for frame in frames), return_exceptions=True)
+    for frame, error in zip(frames, results):
+        if isinstance(error, Exception) and "Target closed" not in str(error):
+            logger.warning(f"Exception while running script in frame {get_frame_name(frame)}: {error}")
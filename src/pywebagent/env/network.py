@@ -0,0 +1,394 @@
+"""
+Request routing of browser contexts: a blocking policy and a shared on-disk cache of static assets.
+
+`NetworkPolicy` aborts requests by resource type and domain, ads, trackers and beacons otherwise keep the page
+busy and delay settling. `AssetCache` stores scripts, stylesheets, images and fonts by the hash of their content,
+in a directory shared by all contexts, processes and runs. Responses are only stored and reused as their
+Cache-Control, Expires, ETag and Last-Modified headers allow, stale entries are revalidated. As the cache is shared
+by the sessions of different accounts, requests sending cookies and responses marked private are never stored.
+`NetworkRouter` installs both on a context with `context.route`, with the sync or the async playwright API.
+"""
+import email.utils
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+ROUTE_PATTERN = "**/*"
+DEFAULT_CACHE_DIRECTORY = Path(os.environ.get("PYWEBAGENT_CACHE_DIR", Path.home() / ".cache" / "pywebagent")) / "assets"
+CACHEABLE_RESOURCE_TYPES = ("script", "stylesheet", "image", "font")
+CACHEABLE_STATUSES = (200, 203)
+HEURISTIC_FRESHNESS_FRACTION = 0.1  # of the time since Last-Modified, as browsers do without explicit freshness
+MAX_HEURISTIC_FRESHNESS = 24 * 3600
+# Not stored, the cached body is already decoded and its length is set when fulfilling
+SKIPPED_HEADERS = ("content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive", "set-cookie")
+# Sent by the browser revalidating its own copy, the cache has no body to answer a 304 with
+CONDITIONAL_HEADERS = ("if-none-match", "if-modified-since")
+
+# Ad networks, analytics and session recording, blocked by the built-in policy
+TRACKER_DOMAINS = (
+    "doubleclick.net", "googlesyndication.com", "googleadservices.com", "google-analytics.com",
+    "googletagmanager.com", "googletagservices.com", "adservice.google.com", "amazon-adsystem.com",
+    "adnxs.com", "criteo.com", "criteo.net", "taboola.com", "outbrain.com", "scorecardresearch.com",
+    "quantserve.com", "connect.facebook.net", "analytics.tiktok.com", "bat.bing.com", "clarity.ms",
+    "hotjar.com", "fullstory.com", "mixpanel.com", "segment.io", "cdn.segment.com", "nr-data.net",
+    "ads.linkedin.com", "px.ads.linkedin.com", "snap.licdn.com", "adsrvr.org", "rubiconproject.com",
+    "pubmatic.com", "moatads.com", "hubspot.com",
+)
+
+
+@dataclass
+class NetworkPolicy:
+    blocked_resource_types: Tuple[str, ...] = ("media", "texttrack", "ping")
+    blocked_domains: Tuple[str, ...] = TRACKER_DOMAINS  # a domain also blocks its subdomains
+    allowed_domains: Tuple[str, ...] = ()  # never blocked, e.g. the site under test
+
+    @classmethod
+    def load(cls, path) -> "NetworkPolicy":
+        """Reads a policy from a JSON file with any of the fields, `extends_default` adds to the built-in lists."""
+        data = json.loads(Path(path).read_text())
+        base = cls() if data.pop("extends_default", False) else cls(blocked_resource_types=(), blocked_domains=())
+        return replace(
+            base,
+            blocked_resource_types=base.blocked_resource_types + tuple(data.get("blocked_resource_types", ())),
+            blocked_domains=base.blocked_domains + tuple(data.get("blocked_domains", ())),
+            allowed_domains=base.allowed_domains + tuple(data.get("allowed_domains", ())),
+        )
+
+    def blocks(self, url: str, resource_type: str) -> bool:
+        host = (urlsplit(url).hostname or "").lower()
+        if _matches_domain(host, self.allowed_domains):
+            return False
+        return resource_type in self.blocked_resource_types or _matches_domain(host, self.blocked_domains)
+
+
+def _matches_domain(host: str, domains) -> bool:
+    return any(host == domain or host.endswith("." + domain) for domain in domains)
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def _parse_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def get_expiry(headers: Dict[str, str], now: float) -> Optional[float]:
+    """
+    When a response stops being fresh, following RFC 9111 for a cache shared by several users.
+    None if it must not be stored. A response with validators but no freshness is stored already stale.
+    """
+    directives = parse_cache_control(headers.get("cache-control"))
+    if "no-store" in directives or "private" in directives:
+        return None
+    if "vary" in headers and headers["vary"].lower().strip() not in ("accept-encoding", ""):
+        return None
+    has_validators = "etag" in headers or "last-modified" in headers
+    if "no-cache" in directives:
+        return now if has_validators else None
+    try:
+        if "max-age" in directives:
+            return now + max(0, int(directives["max-age"]) - int(headers.get("age", 0)))
+    except (TypeError, ValueError):
+        return now if has_validators else None
+    expires = _parse_date(headers.get("expires"))
+    if "expires" in headers:
+        date = _parse_date(headers.get("date")) or now
+        return now + max(0.0, expires - date) if expires is not None else (now if has_validators else None)
+    last_modified = _parse_date(headers.get("last-modified"))
+    if last_modified is not None:
+        return now + min(MAX_HEURISTIC_FRESHNESS, max(0.0, now - last_modified) * HEURISTIC_FRESHNESS_FRACTION)
+    return now if has_validators else None
+
+
+@dataclass
+class CachedAsset:
+    url: str
+    digest: str  # sha256 of the body, the name of its file
+    status: int
+    headers: Dict[str, str]
+    expires: float
+    size: int
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.expires
+
+    def validators(self) -> Dict[str, str]:
+        """Headers of a conditional request revalidating this asset."""
+        headers = {}
+        if "etag" in self.headers:
+            headers["if-none-match"] = self.headers["etag"]
+        if "last-modified" in self.headers:
+            headers["if-modified-since"] = self.headers["last-modified"]
+        return headers
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    expires REAL NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assets_digest ON assets (digest);
+CREATE INDEX IF NOT EXISTS assets_last_used ON assets (last_used);
+"""
+
+
+class AssetCache:
+    """
+    Content-addressed on-disk cache of static assets, safe to share between threads and processes.
+    Bodies are stored once per content hash, whatever URLs serve them. The least recently used assets are
+    evicted when the bodies take more than `max_bytes`.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_bytes: int = 512 * 2**20, clock=time.time):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.clock = clock
+        (self.directory / "blobs").mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.directory / "index.sqlite", check_same_thread=False, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.directory / "blobs" / digest[:2] / digest[2:]
+
+    def lookup(self, url: str) -> Optional[CachedAsset]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT url, digest, status, headers, expires, size FROM assets WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        asset = CachedAsset(row[0], row[1], row[2], json.loads(row[3]), row[4], row[5])
+        return asset if self._blob_path(asset.digest).exists() else None  # evicted by another process
+
+    def read(self, asset: CachedAsset) -> bytes:
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE assets SET last_used = ? WHERE url = ?", (self.clock(), asset.url))
+        return self._blob_path(asset.digest).read_bytes()
+
+    def store(self, url: str, status: int, headers: Dict[str, str], body: bytes) -> Optional[CachedAsset]:
+        """Stores a response if its headers allow it, returns the cached asset or None."""
+        now = self.clock()
+        headers = {name.lower(): value for name, value in headers.items()}
+        expires = get_expiry(headers, now)
+        if status not in CACHEABLE_STATUSES or expires is None or "set-cookie" in headers:
+            return None
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._blob_path(digest)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            temporary = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            temporary.write_bytes(body)
+            os.replace(temporary, path)  # atomic, readers never see a partial body
+        stored_headers = {name: value for name, value in headers.items() if name not in SKIPPED_HEADERS}
+        asset = CachedAsset(url, digest, status, stored_headers, expires, len(body))
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO assets VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, digest, status, json.dumps(stored_headers), expires, len(body), now),
+            )
+        self._evict()
+        return asset
+
+    def refresh(self, asset: CachedAsset, headers: Dict[str, str]) -> CachedAsset:
+        """Updates a revalidated asset with the headers of the 304 response."""
+        headers = {name.lower(): value for name, value in headers.items() if name.lower() not in SKIPPED_HEADERS}
+        merged = {**asset.headers, **headers}
+        expires = get_expiry(merged, self.clock())
+        asset = replace(asset, headers=merged, expires=expires if expires is not None else self.clock())
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE assets SET headers = ?, expires = ? WHERE url = ?",
+                                     (json.dumps(merged), asset.expires, asset.url))
+        return asset
+
+    def total_bytes(self) -> int:
+        """Size of the stored bodies, a body shared by several URLs counts once."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT digest, MAX(size) AS size FROM assets GROUP BY digest)"
+            ).fetchone()
+        return row[0]
+
+    def _evict(self):
+        if self.total_bytes() <= self.max_bytes:
+            return
+        with self._lock, self._connection:
+            rows = self._connection.execute("SELECT url, digest, size FROM assets ORDER BY last_used").fetchall()
+            sizes = {digest: size for _, digest, size in rows}
+            total = sum(sizes.values())
+            references = {}
+            for _, digest, _ in rows:
+                references[digest] = references.get(digest, 0) + 1
+            for url, digest, size in rows:
+                if total <= self.max_bytes:
+                    break
+                self._connection.execute("DELETE FROM assets WHERE url = ?", (url,))
+                references[digest] -= 1
+                if references[digest] == 0:
+                    total -= size
+                    self._blob_path(digest).unlink(missing_ok=True)
+
+    def clear(self):
+        with self._lock, self._connection:
+            for (digest,) in self._connection.execute("SELECT DISTINCT digest FROM assets").fetchall():
+                self._blob_path(digest).unlink(missing_ok=True)
+            self._connection.execute("DELETE FROM assets")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+@dataclass
+class NetworkStats:
+    blocked: int = 0
+    cache_hits: int = 0  # served from the cache without a request
+    revalidated: int = 0  # stale assets the server confirmed with a 304
+    cache_misses: int = 0
+    stored: int = 0
+    bytes_from_cache: int = 0
+    bytes_downloaded: int = 0  # bodies of the cacheable requests that went to the network
+    blocked_by_type: Dict[str, int] = field(default_factory=dict)
+
+
+class NetworkRouter:
+    """Applies a policy and an asset cache to the requests of a context, either can be None."""
+
+    def __init__(self, policy: NetworkPolicy = None, cache: AssetCache = None):
+        self.policy = policy
+        self.cache = cache
+        self.stats = NetworkStats()
+
+    def _is_cacheable(self, request) -> bool:
+        headers = request.headers
+        return (self.cache is not None and request.method == "GET" and request.resource_type in CACHEABLE_RESOURCE_TYPES
+                and "range" not in headers and "authorization" not in headers and "cookie" not in headers
+                and urlsplit(request.url).scheme in ("http", "https"))
+
+    def _should_block(self, request) -> bool:
+        if self.policy is None or not self.policy.blocks(request.url, request.resource_type):
+            return False
+        self.stats.blocked += 1
+        self.stats.blocked_by_type[request.resource_type] = self.stats.blocked_by_type.get(request.resource_type, 0) + 1
+        return True
+
+    def _fulfill_cached(self, asset: CachedAsset) -> dict:
+        body = self.cache.read(asset)
+        self.stats.bytes_from_cache += len(body)
+        return {"status": asset.status, "headers": asset.headers, "body": body}
+
+    @staticmethod
+    def _is_browser_revalidation(request, asset: Optional[CachedAsset]) -> bool:
+        """A conditional request for an asset the cache doesn't have, it goes on as the browser sent it."""
+        return asset is None and any(name in request.headers for name in CONDITIONAL_HEADERS)
+
+    def _on_response(self, request, asset: Optional[CachedAsset], response, body: Optional[bytes]) -> dict:
+        """Keyword arguments of `route.fulfill` for a response fetched from the network."""
+        headers = response.headers
+        if response.status == 304 and asset is not None:
+            self.stats.revalidated += 1
+            return self._fulfill_cached(self.cache.refresh(asset, headers))
+        self.stats.cache_misses += 1
+        self.stats.bytes_downloaded += len(body)
+        if self.cache.store(request.url, response.status, headers, body) is not None:
+            self.stats.stored += 1
+        return {"status": response.status,
+                "headers": {name: value for name, value in headers.items() if name.lower() not in SKIPPED_HEADERS},
+                "body": body}
+
+    def handle(self, route):
+        """Route handler for the sync API."""
+        request = route.request
+        if self._should_block(request):
+            route.abort("blockedbyclient")
+            return
+        if not self._is_cacheable(request):
+            route.fallback()
+            return
+        asset = self.cache.lookup(request.url)
+        if asset is not None and asset.is_fresh(self.cache.clock()):
+            self.stats.cache_hits += 1
+            route.fulfill(**self._fulfill_cached(asset))
+            return
+        if self._is_browser_revalidation(request, asset):
+            route.fallback()
+            return
+        try:
+            headers = {**request.headers, **asset.validators()} if asset is not None else None
+            response = route.fetch(headers=headers)
+            body = response.body() if response.status != 304 or asset is None else None
+        except Exception as e:
+            logger.debug(f"Fetching {request.url} for the asset cache failed: {e}")
+            route.fallback()
+            return
+        route.fulfill(**self._on_response(request, asset, response, body))
+
+    async def async_handle(self, route):
+        """Route handler for the async API."""
+        request = route.request
+        if self._should_block(request):
+            await route.abort("blockedbyclient")
+            return
+        if not self._is_cacheable(request):
+            await route.fallback()
+            return
+        asset = self.cache.lookup(request.url)
+        if asset is not None and asset.is_fresh(self.cache.clock()):
+            self.stats.cache_hits += 1
+            await route.fulfill(**self._fulfill_cached(asset))
+            return
+        if self._is_browser_revalidation(request, asset):
+            await route.fallback()
+            return
+        try:
+            headers = {**request.headers, **asset.validators()} if asset is not None else None
+            response = await route.fetch(headers=headers)
+            body = await response.body() if response.status != 304 or asset is None else None
+        except Exception as e:
+            logger.debug(f"Fetching {request.url} for the asset cache failed: {e}")
+            await route.fallback()
+            return
+        await route.fulfill(**self._on_response(request, asset, response, body))
+
+    @property
+    def enabled(self) -> bool:
+        return self.policy is not None or self.cache is not None
+
+    def install(self, context):
+        if self.enabled:
+            context.route(ROUTE_PATTERN, self.handle)
+
+    async def async_install(self, context):
+        if self.enabled:
+            await context.route(ROUTE_PATTERN, self.async_handle)
+
+
+def uninstall_routes(context):
+    """Removes the routes of any `NetworkRouter`, before a context is reused for another task."""
+    context.unroute(ROUTE_PATTERN)
@@ -0,0 +1,280 @@
+import time
+import logging
+from dataclasses import dataclass, field, replace
+from typing import Any, Optional
+from urllib.parse import urlparse
+from pywebagent.env.browser import CONTEXT_OPTIONS
+from pywebagent.env.network import uninstall_routes
+from pywebagent.env.server import connect_browser, get_browser_endpoint
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PoolStats:
+    hits: int = 0  # acquisitions served by a pre-created context
+    misses: int = 0  # acquisitions that had to create a context (and maybe launch a browser)
+    total_acquire_time: float = 0.0
+    max_acquire_time: float = 0.0
+    browsers_launched: int = 0
+    browsers_retired: int = 0
+    contexts_recycled: int = 0
+    contexts_discarded: int = 0
+
+    @property
+    def acquisitions(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.acquisitions if self.acquisitions else 0.0
+
+    @property
+    def mean_acquire_time(self) -> float:
+        return self.total_acquire_time / self.acquisitions if self.acquisitions else 0.0
+
+
+@dataclass(eq=False)
+class _PooledBrowser:
+    browser: Any
+    uses: int = 0
+    leased: int = 0
+    retiring: bool = False
+    idle: list = field(default_factory=list)  # (context, page) pairs ready to be handed out
+
+
+@dataclass(eq=False)
+class BrowserLease:
+    browser: Any
+    context: Any
+    page: Any
+    origins: set = field(default_factory=set)  # origins visited during the lease, their storage is wiped on release
+    _slot: Optional[_PooledBrowser] = None
+    _listeners: tuple = ()
+
+
+class BrowserPool:
+    """
+    Keeps launched browsers with pre-created contexts, so `act()` does not pay for a cold start.
+    Contexts are cleaned (cookies, storage, permissions, pages and their init scripts) and recycled on release.
+    A browser is retired after `max_uses_per_browser` leases.
+    With a `browser_endpoint` (or PYWEBAGENT_BROWSER_ENDPOINT), the pool connects to a running browser instead of
+    launching its own, and retiring only disconnects from it.
+
+    Like playwright's sync API, a pool must only be used from the thread that created it.
+    """
+
+    def __init__(self, size: int = 1, contexts_per_browser: int = 2, max_uses_per_browser: int = 50,
+                 headless: bool = True, context_options: dict = None, launch_options: dict = None,
+                 browser_endpoint: str = None):
+        self.size = size
+        self.contexts_per_browser = contexts_per_browser
+        self.max_uses_per_browser = max_uses_per_browser
+        self.context_options = context_options if context_options is not None else CONTEXT_OPTIONS
+        self.launch_options = {"channel": "chrome", "headless": headless, **(launch_options or {})}
+        self.browser_endpoint = get_browser_endpoint(browser_endpoint)
+        self._stats = PoolStats()
+        self._slots = []
+        self._context_manager = None
+        self._playwright = None
+
+    @property
+    def stats(self) -> PoolStats:
+        return replace(self._stats)
+
+    def start(self):
+        if self._playwright is None:
+            from playwright.sync_api import sync_playwright
+
+            self._context_manager = sync_playwright()
+            self._playwright = self._context_manager.__enter__()
+        while len(self._slots) < self.size:
+            self._launch()
+        for slot in self._slots:
+            self._fill(slot)
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def acquire(self) -> BrowserLease:
+        if self._playwright is None:
+            self.start()
+        start_time = time.perf_counter()
+
+        lease = self._acquire_idle()
+        if lease is not None:
+            self._stats.hits += 1
+        else:
+            self._stats.misses += 1
+            slot = self._available_slot() or self._launch()
+            context, page = self._new_context(slot)
+            lease = BrowserLease(browser=slot.browser, context=context, page=page, _slot=slot)
+
+        slot = lease._slot
+        slot.uses += 1
+        slot.leased += 1
+        if slot.uses >= self.max_uses_per_browser:
+            slot.retiring = True
+        self._track_origins(lease)
+
+        elapsed = time.perf_counter() - start_time
+        self._stats.total_acquire_time += elapsed
+        self._stats.max_acquire_time = max(self._stats.max_acquire_time, elapsed)
+        return lease
+
+    def release(self, lease: BrowserLease, reusable: bool = True) -> None:
+        """Returns a lease to the pool. Pass `reusable=False` if the context is known to be in a bad state."""
+        slot = lease._slot
+        lease._slot = None
+        if slot is None:
+            return  # already released
+        slot.leased -= 1
+
+        if reusable and not slot.retiring and self._is_healthy(slot, lease.page):
+            try:
+                page = self._clean(lease)
+                slot.idle.append((lease.context, page))
+                self._stats.contexts_recycled += 1
+            except Exception as e:
+                logger.warning(f"Failed to recycle browser context: {e}")
+                self._discard_context(lease.context)
+        else:
+            self._discard_context(lease.context)
+
+        if slot.retiring:
+            self._retire_if_unused(slot)
+        else:
+            self._fill(slot)
+
+    def close(self):
+        for slot in self._slots:
+            try:
+                slot.browser.close()
+            except Exception as e:
+                logger.warning(f"Exception while closing pooled browser: {e}")
+        self._slots = []
+        if self._context_manager is not None:
+            self._context_manager.__exit__()
+            self._context_manager = None
+            self._playwright = None
+
+    def _launch(self) -> _PooledBrowser:
+        if self.browser_endpoint:
+            browser = connect_browser(self._playwright.chromium, self.browser_endpoint)
+        else:
+            browser = self._playwright.chromium.launch(**self.launch_options)
+        slot = _PooledBrowser(browser=browser)
+        self._slots.append(slot)
+        self._stats.browsers_launched += 1
+        return slot
+
+    def _available_slot(self) -> Optional[_PooledBrowser]:
+        for slot in list(self._slots):
+            if not slot.browser.is_connected():
+                # The browser crashed or was closed, replace it
+                slot.retiring = True
+                self._retire_if_unused(slot)
+        for slot in self._slots:
+            if not slot.retiring:
+                return slot
+        return None
+
+    def _acquire_idle(self) -> Optional[BrowserLease]:
+        for slot in self._slots:
+            if slot.retiring:
+                continue
+            while slot.idle:
+                context, page = slot.idle.pop()
+                if self._is_healthy(slot, page):
+                    return BrowserLease(browser=slot.browser, context=context, page=page, _slot=slot)
+                self._discard_context(context)
+        return None
+
+    def _new_context(self, slot: _PooledBrowser):
+        context = slot.browser.new_context(**self.context_options)
+        return context, context.new_page()
+
+    def _fill(self, slot: _PooledBrowser) -> None:
+        """Pre-creates contexts up to `contexts_per_browser`, keeping the cost out of `acquire`."""
+        while (not slot.retiring and slot.browser.is_connected()
+               and len(slot.idle) + slot.leased < self.contexts_per_browser):
+            slot.idle.append(self._new_context(slot))
+
+    def _is_healthy(self, slot: _PooledBrowser, page) -> bool:
+        if not slot.browser.is_connected() or page.is_closed():
+            return False
+        try:
+            return page.evaluate("1") == 1
+        except Exception:
+            return False
+
+    def _track_origins(self, lease: BrowserLease) -> None:
+        def on_navigation(frame):
+            origin = _origin(frame.url)
+            if origin:
+                lease.origins.add(origin)
+
+        def on_page(page):
+            page.on("framenavigated", on_navigation)
+
+        lease.page.on("framenavigated", on_navigation)
+        lease.context.on("page", on_page)
+        lease._listeners = (on_navigation, on_page)
+
+    def _clean(self, lease: BrowserLease):
+        """Wipes all state the lease left in its context and returns a fresh page for it."""
+        context = lease.context
+        on_navigation, on_page = lease._listeners
+        context.remove_listener("page", on_page)
+        uninstall_routes(context)  # the next lease may use another network policy
+        for page in context.pages:
+            lease.origins.update(filter(None, (_origin(frame.url) for frame in page.frames)))
+
+        # A new page drops the page level init scripts, routes and listeners of the previous lease
+        fresh_page = context.new_page()
+        cdp = context.new_cdp_session(fresh_page)
+        try:
+            for origin in lease.origins:
+                cdp.send("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        finally:
+            cdp.detach()
+        for page in context.pages:
+            if page != fresh_page:
+                page.close()
+        context.clear_cookies()
+        context.clear_permissions()
+        return fresh_page
+
+    def _discard_context(self, context) -> None:
+        self._stats.contexts_discarded += 1
+        try:
+            context.close()
+        except Exception as e:
+            logger.warning(f"Exception while closing browser context: {e}")
+
+    def _retire_if_unused(self, slot: _PooledBrowser) -> None:
+        if slot.leased:
+            return
+        for context, _ in slot.idle:
+            self._discard_context(context)
+        slot.idle = []
+        try:
+            slot.browser.close()
+        except Exception as e:
+            logger.warning(f"Exception while closing retired browser: {e}")
+        self._slots.remove(slot)
+        self._stats.browsers_retired += 1
+        # Keep the pool at its configured size
+        while len(self._slots) < self.size:
+            self._fill(self._launch())
+
+
+def _origin(url: str) -> Optional[str]:
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https"):
+        return None
+    return f"{parsed.scheme}://{parsed.netloc}"
@@ -0,0 +1,171 @@
+import base64
+import logging
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Any, Dict, Optional, Union
+from pywebagent import tracing
+from pywebagent.env.spill import SpilledBytes
+
+logger = logging.getLogger(__name__)
+
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+CROP_MARGIN = 24  # px around the marked elements, so their labels stay visible
+MIN_QUALITY = 40
+QUALITY_STEP = 15
+SCALE_STEP = 0.75
+MAX_ENCODING_ATTEMPTS = 8
+
+VIEWPORT_JS = """() => ({
+    x: window.scrollX,
+    y: window.scrollY,
+    width: document.documentElement.clientWidth,
+    height: document.documentElement.clientHeight,
+})"""
+
+
+@dataclass
+class ScreenshotConfig:
+    format: str = "jpeg"  # png, jpeg or webp
+    quality: int = 80  # jpeg and webp only
+    max_width: Optional[int] = None  # downscale wider images to this width
+    max_bytes: Optional[int] = None  # lower the quality, then the resolution, until the image fits
+    crop_to_marked_elements: bool = False  # only keep the area that holds the marked elements
+    detail: str = "high"  # detail level asked from the LLM: low, high or auto
+
+    def __post_init__(self):
+        if self.format not in MIME_TYPES:
+            raise ValueError(f"Unsupported screenshot format {self.format}, expected one of {list(MIME_TYPES)}")
+
+
+class Screenshot:
+    """An encoded screenshot, the base64 encoding is computed once however many times it is sent."""
+
+    def __init__(self, data: Union[bytes, SpilledBytes], format: str, width: int, height: int, detail: str = "high", encoded: str = None):
+        self.data = data
+        self.format = format
+        self.width = width
+        self.height = height
+        self.detail = detail
+        if encoded is not None:
+            self.__dict__["base64"] = encoded  # the DevTools protocol already sends base64
+
+    @property
+    def mime_type(self) -> str:
+        return MIME_TYPES[self.format]
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    @cached_property
+    def base64(self) -> str:
+        return base64.b64encode(bytes(self.data)).decode('utf-8')
+
+    def spill(self, store) -> None:
+        """Moves the image to a `SpillStore`, it is read back from disk if it is sent again."""
+        if isinstance(self.data, bytes):
+            self.data = store.put(self.data)
+        self.__dict__.pop("base64", None)
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{self.base64}"
+
+    def __repr__(self) -> str:
+        return f"Screenshot({self.format}, {self.width}x{self.height}, {self.size} bytes)"
+
+
+def get_clip(viewport: Dict[str, float], marked_elements: Dict[int, Any], config: ScreenshotConfig, main_frame=None) -> Dict[str, float]:
+    """
+    The page area to capture, in page coordinates.
+    Crops to the marked elements if configured. Boxes of elements in child frames are relative to their frame,
+    so pages with marked elements in frames are not cropped.
+    """
+    clip = dict(viewport)
+    boxes = [element["bbox"] for element in marked_elements.values() if element.get("iframe") is main_frame]
+    if not config.crop_to_marked_elements or not boxes or len(boxes) != len(marked_elements):
+        return clip
+    left = max(viewport["x"], min(box["x"] for box in boxes) - CROP_MARGIN)
+    top = max(viewport["y"], min(box["y"] for box in boxes) - CROP_MARGIN)
+    right = min(viewport["x"] + viewport["width"], max(box["x"] + box["width"] for box in boxes) + CROP_MARGIN)
+    bottom = min(viewport["y"] + viewport["height"], max(box["y"] + box["height"] for box in boxes) + CROP_MARGIN)
+    if right - left < 1 or bottom - top < 1:
+        return clip
+    return {"x": left, "y": top, "width": right - left, "height": bottom - top}
+
+
+def get_initial_scale(clip: Dict[str, float], config: ScreenshotConfig) -> float:
+    if config.max_width and clip["width"] > config.max_width:
+        return config.max_width / clip["width"]
+    return 1.0
+
+
+def next_encoding(quality: int, scale: float, config: ScreenshotConfig):
+    """The next (quality, scale) to try when an image is over the byte budget, None when there is nothing left to try."""
+    if config.format != "png" and quality - QUALITY_STEP >= MIN_QUALITY:
+        return quality - QUALITY_STEP, scale
+    if scale * SCALE_STEP >= 0.1:
+        return quality, scale * SCALE_STEP
+    return None
+
+
+def _capture_params(clip, quality, scale, config):
+    params = {
+        "format": config.format,
+        "clip": {**clip, "scale": scale},
+        "captureBeyondViewport": False,
+    }
+    if config.format != "png":
+        params["quality"] = quality
+    return params
+
+
+def _build_screenshot(data, clip, scale, config, attempts):
+    screenshot = Screenshot(
+        data=base64.b64decode(data),
+        format=config.format,
+        width=round(clip["width"] * scale),
+        height=round(clip["height"] * scale),
+        detail=config.detail,
+        encoded=data,
+    )
+    logger.info(f"Captured {screenshot} in {attempts} attempt(s)")
+    tracing.current_span().set(bytes=screenshot.size, width=screenshot.width, height=screenshot.height,
+                               format=screenshot.format, attempts=attempts)
+    return screenshot
+
+
+@tracing.traced("env.screenshot")
+def capture_screenshot(page, cdp_session, marked_elements: Dict[int, Any], config: ScreenshotConfig,
+                       clip: Dict[str, float] = None) -> Screenshot:
+    """
+    Captures the viewport (or `clip`) with the DevTools protocol, which encodes and scales the image in the browser.
+    Playwright's screenshot only does full resolution png or jpeg.
+    """
+    if clip is None:
+        clip = get_clip(page.evaluate(VIEWPORT_JS), marked_elements, config, page.main_frame)
+    quality, scale = config.quality, get_initial_scale(clip, config)
+    for attempt in range(1, MAX_ENCODING_ATTEMPTS + 1):
+        data = cdp_session.send("Page.captureScreenshot", _capture_params(clip, quality, scale, config))["data"]
+        # the base64 data is 4/3 of the image size
+        next_attempt = next_encoding(quality, scale, config)
+        if config.max_bytes is None or len(data) * 3 // 4 <= config.max_bytes or next_attempt is None:
+            break
+        quality, scale = next_attempt
+    return _build_screenshot(data, clip, scale, config, attempt)
+
+
+@tracing.traced("env.screenshot")
+async def async_capture_screenshot(page, cdp_session, marked_elements: Dict[int, Any], config: ScreenshotConfig,
+                                   clip: Dict[str, float] = None) -> Screenshot:
+    """Async version of `capture_screenshot`."""
+    if clip is None:
+        clip = get_clip(await page.evaluate(VIEWPORT_JS), marked_elements, config, page.main_frame)
+    quality, scale = config.quality, get_initial_scale(clip, config)
+    for attempt in range(1, MAX_ENCODING_ATTEMPTS + 1):
+        data = (await cdp_session.send("Page.captureScreenshot", _capture_params(clip, quality, scale, config)))["data"]
+        next_attempt = next_encoding(quality, scale, config)
+        if config.max_bytes is None or len(data) * 3 // 4 <= config.max_bytes or next_attempt is None:
+            break
+        quality, scale = next_attempt
+    return _build_screenshot(data, clip, scale, config, attempt)
@@ -0,0 +1,12 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+
+JS_DIRECTORY = Path(os.path.dirname(os.path.realpath(__file__))) / "../js"
+
+
+@lru_cache(maxsize=None)
+def load_js_script(name: str) -> str:
+    """Reads a script from the js directory, only once per process."""
+    with open(JS_DIRECTORY / name, 'r') as file:
+        return file.read()
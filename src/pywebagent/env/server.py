@@ -0,0 +1,94 @@
+"""
+Attaches to a browser that is already running, instead of launching one for every process.
+
+Launching Chrome takes most of the cold start of a short-lived process (`run.py`, a batch worker). Keep a browser
+warm with the daemon and point the environments at it, each one then only creates its own context:
+
+    python -m pywebagent.env.server --port 9222
+    export PYWEBAGENT_BROWSER_ENDPOINT=http://127.0.0.1:9222
+
+An endpoint is either a Chrome DevTools Protocol endpoint (http://host:port, or ws://.../devtools/browser/...) or
+the websocket of a playwright server (`playwright run-server`).
+"""
+import argparse
+import logging
+import os
+import signal
+import sys
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT_ENVIRONMENT_VARIABLE = "PYWEBAGENT_BROWSER_ENDPOINT"
+DEFAULT_PORT = 9222
+
+
+def get_browser_endpoint(endpoint: Optional[str] = None) -> Optional[str]:
+    return endpoint or os.environ.get(ENDPOINT_ENVIRONMENT_VARIABLE) or None
+
+
+def is_cdp_endpoint(endpoint: str) -> bool:
+    return endpoint.startswith(("http://", "https://")) or "/devtools/browser/" in endpoint
+
+
+def connect_browser(browser_type, endpoint: str):
+    """
+    Connects a playwright `browser_type` to the endpoint, awaitable with the async API.
+    Closing the returned browser only disconnects, and closes the contexts created through it.
+    """
+    logger.info(f"Connecting to the browser at {endpoint}")
+    if is_cdp_endpoint(endpoint):
+        return browser_type.connect_over_cdp(endpoint)
+    return browser_type.connect(endpoint)
+
+
+def serve(port: int = DEFAULT_PORT, headless: bool = True, channel: Optional[str] = "chrome") -> None:
+    """Keeps a browser listening for CDP connections on localhost, relaunching it if it exits, until SIGINT or SIGTERM."""
+    from playwright.sync_api import sync_playwright
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    launch_options = {
+        "headless": headless,
+        "channel": channel,
+        "args": [f"--remote-debugging-port={port}", "--remote-debugging-address=127.0.0.1"],
+    }
+    with sync_playwright() as playwright:
+        try:
+            while not stopping:
+                browser = playwright.chromium.launch(**launch_options)
+                disconnected = []
+                browser.on("disconnected", lambda _, disconnected=disconnected: disconnected.append(True))
+                # Waiting on a page runs playwright's event loop, which notices the browser exiting
+                watcher = browser.new_page()
+                print(f"Browser ready, export {ENDPOINT_ENVIRONMENT_VARIABLE}=http://127.0.0.1:{port}", flush=True)
+                while not disconnected and not stopping:
+                    try:
+                        watcher.wait_for_timeout(1000)
+                    except Exception as e:
+                        logger.debug(f"Waiting on the browser failed: {e}")
+                        try:
+                            watcher = browser.new_page()  # a client closed it
+                        except Exception:
+                            break  # the browser went away
+                if not stopping:
+                    logger.warning("The browser exited, relaunching it")
+            browser.close()
+        except KeyboardInterrupt:
+            pass
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m pywebagent.env.server",
+                                     description="Keeps a browser warm for pywebagent processes to connect to.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="CDP port on 127.0.0.1 (default %(default)s)")
+    parser.add_argument("--headed", action="store_true", help="show the browser")
+    parser.add_argument("--channel", default="chrome", help="browser channel, empty for the bundled chromium")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    serve(args.port, headless=not args.headed, channel=args.channel or None)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
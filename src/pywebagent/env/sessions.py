@@ -0,0 +1,173 @@
+"""
+Keeps the logged in state of sites between runs, so repeated tasks skip the login steps.
+
+The playwright storage state (cookies and local storage) of a context is saved after a successful task, keyed by
+the domain the task started on and an account name, and loaded into the context of the next run on that domain.
+States are encrypted on disk with Fernet (`pip install cryptography`). A state expires after `max_age`, and is
+dropped as soon as the agent lands on a login page with it, since the site did not accept it anymore.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION_DIRECTORY = Path(os.environ.get("PYWEBAGENT_CACHE_DIR", Path.home() / ".cache" / "pywebagent")) / "sessions"
+KEY_ENVIRONMENT_VARIABLE = "PYWEBAGENT_SESSION_KEY"
+DEFAULT_ACCOUNT = "default"
+LOGIN_URL_PATTERN = re.compile(r"/(log-?in|sign-?in|auth|sso|session/new)(/|$)", re.IGNORECASE)
+
+# True when the page shows a password field, the surest sign of a login form
+HAS_PASSWORD_FIELD_JS = """() => Array.from(document.querySelectorAll('input[type=password]')).some(input => {
+    const rect = input.getBoundingClientRect();
+    const style = getComputedStyle(input);
+    return rect.width > 0 && rect.height > 0 && style.visibility !== 'hidden' && style.display !== 'none';
+})"""
+
+
+def get_session_domain(url: str) -> str:
+    """The host without a leading www., so https://www.example.com/a and https://example.com share a session."""
+    host = urlsplit(url).hostname or ""
+    return host[4:] if host.startswith("www.") else host
+
+
+def is_login_url(url: str) -> bool:
+    return LOGIN_URL_PATTERN.search(urlsplit(url).path) is not None
+
+
+def is_login_page(page) -> bool:
+    if is_login_url(page.url):
+        return True
+    try:
+        return page.evaluate(HAS_PASSWORD_FIELD_JS)
+    except Exception as e:
+        logger.debug(f"Could not look for a login form: {e}")
+        return False
+
+
+async def async_is_login_page(page) -> bool:
+    if is_login_url(page.url):
+        return True
+    try:
+        return await page.evaluate(HAS_PASSWORD_FIELD_JS)
+    except Exception as e:
+        logger.debug(f"Could not look for a login form: {e}")
+        return False
+
+
+def drop_expired_cookies(storage_state: dict, now: float) -> dict:
+    """Session cookies (expires -1) are kept, the browser never got to drop them since it was never closed."""
+    cookies = [cookie for cookie in storage_state.get("cookies", []) if not 0 <= cookie.get("expires", -1) <= now]
+    return {**storage_state, "cookies": cookies}
+
+
+def _load_fernet(key, directory: Path):
+    try:
+        from cryptography.fernet import Fernet
+    except ImportError as e:
+        raise ImportError("SessionStore encrypts sessions with the cryptography package, pip install cryptography") from e
+
+    key = key or os.environ.get(KEY_ENVIRONMENT_VARIABLE)
+    if key is None:
+        key_path = directory / "session.key"
+        if not key_path.exists():
+            # Only readable by the user, like ssh keys. O_EXCL so concurrent runs agree on a single key.
+            try:
+                fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                with os.fdopen(fd, "wb") as file:
+                    file.write(Fernet.generate_key())
+            except FileExistsError:
+                pass
+        key = key_path.read_bytes().strip()
+    return Fernet(key)
+
+
+class SessionStore:
+    """
+    Encrypted storage states on disk, one file per (domain, account).
+    The key is `key`, the PYWEBAGENT_SESSION_KEY environment variable, or one generated in `directory`.
+    """
+
+    def __init__(self, directory=DEFAULT_SESSION_DIRECTORY, key: Optional[bytes] = None,
+                 max_age: float = 7 * 24 * 3600, clock=time.time):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_age = max_age
+        self.clock = clock
+        self._fernet = _load_fernet(key, self.directory)
+
+    def _path(self, domain: str, account: str) -> Path:
+        digest = hashlib.sha256(json.dumps([domain, account]).encode()).hexdigest()
+        return self.directory / f"{digest}.session"
+
+    def load(self, url: str, account: str = DEFAULT_ACCOUNT) -> Optional[dict]:
+        """The storage state saved for the domain of `url`, None if there is none or it expired."""
+        from cryptography.fernet import InvalidToken
+
+        domain = get_session_domain(url)
+        path = self._path(domain, account)
+        try:
+            token = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        try:
+            data = json.loads(self._fernet.decrypt_at_time(token, int(self.max_age), int(self.clock())))
+        except InvalidToken:
+            logger.info(f"Session of {account} on {domain} expired or was saved with another key, dropping it")
+            path.unlink(missing_ok=True)
+            return None
+        logger.info(f"Loaded the session of {account} on {domain}")
+        return drop_expired_cookies(data["storage_state"], self.clock())
+
+    def save(self, url: str, storage_state: dict, account: str = DEFAULT_ACCOUNT) -> None:
+        domain = get_session_domain(url)
+        data = json.dumps({"domain": domain, "account": account, "storage_state": storage_state})
+        token = self._fernet.encrypt_at_time(data.encode(), int(self.clock()))
+        path = self._path(domain, account)
+        temporary_path = path.with_suffix(f".{os.getpid()}.tmp")
+        fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            file.write(token)
+        os.replace(temporary_path, path)  # concurrent runs never read a partial file
+        logger.info(f"Saved the session of {account} on {domain}")
+
+    def invalidate(self, url: str, account: str = DEFAULT_ACCOUNT) -> None:
+        self._path(get_session_domain(url), account).unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        for path in self.directory.glob("*.session"):
+            path.unlink(missing_ok=True)
+
+
+def local_storage_script(storage_state: dict) -> Optional[str]:
+    """
+    An init script filling the local storage of the state's origins, for contexts that already exist (a pool's)
+    and so can't be created with the state. It runs once per tab, later writes of the site are kept.
+    """
+    origins = {
+        origin["origin"]: {item["name"]: item["value"] for item in origin.get("localStorage", [])}
+        for origin in storage_state.get("origins", [])
+    }
+    if not origins:
+        return None
+    return f"""(() => {{
+        const items = {json.dumps(origins)}[location.origin];
+        if (!items || sessionStorage.getItem('__pywebagent_session__')) return;
+        for (const [name, value] of Object.entries(items)) localStorage.setItem(name, value);
+        sessionStorage.setItem('__pywebagent_session__', '1');
+    }})()"""
+
+
+def apply_storage_state(context, page, storage_state: dict) -> None:
+    if storage_state.get("cookies"):
+        context.add_cookies(storage_state["cookies"])
+    script = local_storage_script(storage_state)
+    if script:
+        page.add_init_script(script)  # a page init script, so the pool drops it with the page on release
+
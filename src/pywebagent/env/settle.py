@@ -0,0 +1,131 @@
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from pywebagent import tracing
+from pywebagent.env.scripts import load_js_script
+
+logger = logging.getLogger(__name__)
+
+# Streaming connections never finish, they must not keep a page from settling
+IGNORED_RESOURCE_TYPES = ("websocket", "eventsource")
+
+
+@dataclass
+class SettleConfig:
+    quiet_ms: int = 300  # how long DOM, network and animations must be quiet
+    timeout_ms: int = 5000  # upper bound on the wait
+    long_request_ms: int = 3000  # requests pending longer than this are treated as long polling and ignored
+
+
+@dataclass
+class SettleResult:
+    waited: float  # seconds
+    timed_out: bool
+
+
+class RequestTracker:
+    """Counts the in-flight requests of a page, works with both the sync and async playwright APIs."""
+
+    def __init__(self, page):
+        self.page = page
+        self._pending = {}  # request -> start time
+        self.last_activity = time.monotonic()
+        page.on("request", self._on_request)
+        page.on("requestfinished", self._on_request_done)
+        page.on("requestfailed", self._on_request_done)
+
+    def _on_request(self, request):
+        if request.resource_type in IGNORED_RESOURCE_TYPES:
+            return
+        now = time.monotonic()
+        self._pending[request] = now
+        self.last_activity = now
+
+    def _on_request_done(self, request):
+        if self._pending.pop(request, None) is not None:
+            self.last_activity = time.monotonic()
+
+    def quiet_for(self, long_request_ms: int) -> float:
+        """Milliseconds since the network was last active, 0 while relevant requests are pending."""
+        now = time.monotonic()
+        if any((now - started) * 1000 < long_request_ms for started in self._pending.values()):
+            return 0.0
+        return (now - self.last_activity) * 1000
+
+
+@tracing.traced("env.settle")
+def wait_for_settle(page, tracker: RequestTracker, config: SettleConfig) -> SettleResult:
+    """
+    Waits until DOM mutations, in-flight requests and animation frames were quiet for `config.quiet_ms`,
+    at most `config.timeout_ms`. Returns as soon as the page is quiet, instead of sleeping a fixed time.
+    """
+    script = load_js_script("wait_for_settle.js")
+    start = time.monotonic()
+    while True:
+        remaining_ms = config.timeout_ms - (time.monotonic() - start) * 1000
+        if page.is_closed():
+            return _result(start, timed_out=False)
+        if remaining_ms <= 0:
+            return _result(start, timed_out=True)
+        try:
+            page_state = page.evaluate(script, {"quietMs": config.quiet_ms, "timeoutMs": remaining_ms})
+        except Exception as e:
+            # Usually a navigation destroyed the execution context, wait for the new document
+            logger.debug(f"Exception while waiting for page to settle: {e}")
+            _wait_for_document(page, remaining_ms)
+            continue
+        if page_state["timedOut"]:
+            return _result(start, timed_out=True)
+
+        network_quiet_ms = tracker.quiet_for(config.long_request_ms)
+        if network_quiet_ms >= config.quiet_ms:
+            return _result(start, timed_out=False)
+        remaining_ms = config.timeout_ms - (time.monotonic() - start) * 1000  # the evaluation took some of it
+        # wait_for_timeout keeps dispatching playwright events, unlike time.sleep
+        page.wait_for_timeout(max(0.0, min(config.quiet_ms - network_quiet_ms, remaining_ms)))
+
+
+@tracing.traced("env.settle")
+async def async_wait_for_settle(page, tracker: RequestTracker, config: SettleConfig) -> SettleResult:
+    """Async version of `wait_for_settle`."""
+    script = load_js_script("wait_for_settle.js")
+    start = time.monotonic()
+    while True:
+        remaining_ms = config.timeout_ms - (time.monotonic() - start) * 1000
+        if page.is_closed():
+            return _result(start, timed_out=False)
+        if remaining_ms <= 0:
+            return _result(start, timed_out=True)
+        try:
+            page_state = await page.evaluate(script, {"quietMs": config.quiet_ms, "timeoutMs": remaining_ms})
+        except Exception as e:
+            # Usually a navigation destroyed the execution context, wait for the new document
+            logger.debug(f"Exception while waiting for page to settle: {e}")
+            try:
+                await page.wait_for_load_state("domcontentloaded", timeout=remaining_ms)
+            except Exception:
+                await asyncio.sleep(0.05)
+            continue
+        if page_state["timedOut"]:
+            return _result(start, timed_out=True)
+
+        network_quiet_ms = tracker.quiet_for(config.long_request_ms)
+        if network_quiet_ms >= config.quiet_ms:
+            return _result(start, timed_out=False)
+        remaining_ms = config.timeout_ms - (time.monotonic() - start) * 1000  # the evaluation took some of it
+        await asyncio.sleep(max(0.0, min(config.quiet_ms - network_quiet_ms, remaining_ms)) / 1000)
+
+
+def _wait_for_document(page, remaining_ms):
+    try:
+        page.wait_for_load_state("domcontentloaded", timeout=remaining_ms)
+    except Exception:
+        time.sleep(0.05)
+
+
+def _result(start, timed_out) -> SettleResult:
+    result = SettleResult(waited=time.monotonic() - start, timed_out=timed_out)
+    logger.info(f"Page settled after {result.waited:.2f}s" + (" (timed out)" if timed_out else ""))
+    tracing.current_span().set(timed_out=timed_out)
+    return result
@@ -0,0 +1,145 @@
+"""
+An on-disk store for the screenshots of past observations, so long-lived processes don't keep them in memory.
+
+Payloads are appended to segment files and read back through memory maps. Pages of a segment are only resident
+while they are being read, they are released right after, so the memory of the process doesn't grow with the
+number of steps. Once the store holds more than `max_bytes`, its oldest segments are deleted, reading a payload
+that was in them raises `SpillExpiredError`.
+"""
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class SpillExpiredError(LookupError):
+    """The payload was in a segment deleted to keep the store under its size limit."""
+
+
+class SpilledBytes:
+    """A payload moved to a `SpillStore`, only its location is kept in memory."""
+
+    __slots__ = ("_store", "segment", "offset", "size")
+
+    def __init__(self, store: "SpillStore", segment: int, offset: int, size: int):
+        self._store = store
+        self.segment = segment
+        self.offset = offset
+        self.size = size
+
+    def tobytes(self) -> bytes:
+        return self._store.read(self)
+
+    __bytes__ = tobytes
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __repr__(self) -> str:
+        return f"SpilledBytes(segment {self.segment}, {self.size} bytes)"
+
+
+class _Segment:
+    __slots__ = ("path", "file", "map", "used")
+
+    def __init__(self, path: Path, size: int):
+        self.path = path
+        self.file = open(path, "w+b")
+        self.file.truncate(size)  # sparse, disk space is only used as payloads are written
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.used = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.map)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+        self.path.unlink(missing_ok=True)
+
+
+class SpillStore:
+    """
+    Memory-mapped segment files in `directory`, a temporary directory removed on `close` by default.
+    Safe to share between the environments of a process.
+    """
+
+    def __init__(self, directory=None, segment_size: int = DEFAULT_SEGMENT_SIZE, max_bytes: int = DEFAULT_MAX_BYTES):
+        self._owns_directory = directory is None
+        self.directory = Path(directory or tempfile.mkdtemp(prefix="pywebagent-spill-"))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self._segments = OrderedDict()  # segment number -> _Segment, oldest first
+        self._next_segment = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        """Bytes held by the segments on disk."""
+        with self._lock:
+            return sum(segment.used for segment in self._segments.values())
+
+    def put(self, data: bytes) -> SpilledBytes:
+        with self._lock:
+            segment = self._writable_segment(len(data))
+            offset = segment.used
+            os.pwrite(segment.file.fileno(), data, offset)  # through the file, the mapping's pages aren't touched
+            segment.used += len(data)
+            self._evict()
+            return SpilledBytes(self, next(reversed(self._segments)), offset, len(data))
+
+    def read(self, ref: SpilledBytes) -> bytes:
+        with self._lock:
+            segment = self._segments.get(ref.segment)
+            if segment is None:
+                raise SpillExpiredError(f"{ref} was evicted, the store keeps at most {self.max_bytes} bytes")
+            data = segment.map[ref.offset:ref.offset + ref.size]
+            self._release(segment, ref.offset, ref.size)
+            return data
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
+            self._segments.clear()
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _writable_segment(self, size: int) -> _Segment:
+        if self._segments:
+            segment = next(reversed(self._segments.values()))
+            if segment.used + size <= segment.capacity:
+                return segment
+        number = self._next_segment
+        self._next_segment += 1
+        segment = _Segment(self.directory / f"segment-{number:06d}", max(self.segment_size, size))
+        self._segments[number] = segment
+        return segment
+
+    def _evict(self):
+        """Deletes the oldest segments while over `max_bytes`, the segment being written to is kept."""
+        total = sum(segment.used for segment in self._segments.values())
+        while total > self.max_bytes and len(self._segments) > 1:
+            number, segment = self._segments.popitem(last=False)
+            total -= segment.used
+            logger.info(f"Spill store over {self.max_bytes} bytes, deleted segment {number} ({segment.used} bytes)")
+            segment.close()
+
+    @staticmethod
+    def _release(segment: _Segment, offset: int, size: int):
+        """Drops the pages just read from the process's resident memory, they stay in the file."""
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        start = offset - offset % mmap.PAGESIZE
+        segment.map.madvise(mmap.MADV_DONTNEED, start, min(offset + size, segment.capacity) - start)
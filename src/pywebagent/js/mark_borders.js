@@ -1,276 +1,640 @@
 (function() {
-    function getAdjustedBoundingClientRect(element) {
-        const rect = element.getBoundingClientRect();
-        return {
-            top: rect.top + window.scrollY,
-            left: rect.left + window.scrollX,
-            bottom: rect.bottom + window.scrollY,
-            right: rect.right + window.scrollX,
-            width: rect.width,
-            height: rect.height
+    // Installs window.__pywebagent_marker__ in the document, once (as an init script, or on first use):
+    //   mark(options) - a whole pass, new elements get ids starting at options.nextId
+    //   measure(options) - only phase 1 of a pass, returns how many of the elements to mark have no id yet
+    //   draw(nextId) - phase 2 of the last measured pass, new ids start at nextId
+    //   frames() - the frame elements of the document and whether anything inside them can be seen
+    // so that the frames of a page are measured concurrently, and their id ranges assigned afterwards.
+    if (window.__pywebagent_marker__) {
+        return;
+    }
+
+    // Marks the elements that can be interacted with.
+    // The pass is split in two phases so that layout is computed once:
+    //   1. read - walk the DOM (pruning subtrees that can't render), measure and filter candidates
+    //   2. write - set aria labels and insert all borders and labels at once
+    // The page keeps state between passes in window.__pywebagent__:
+    //   - the marked elements keyed by id, only compact records are sent back to python
+    //   - stable ids, an element keeps its id for as long as it stays in the document
+    //   - a MutationObserver, so that an incremental pass only re-walks the subtrees that changed
+    const PRIORITISED_TAGS = ['INPUT', 'SELECT', 'A', 'BUTTON', 'TEXTAREA'];
+    const ELEMENT_CURSORS = ['pointer', 'hand', 'text'];
+    const TOP_ELEMENT_CURSORS = ['pointer', 'auto', 'hand', 'text'];
+    const GRID_CELL_SIZE = 200;
+    const SHORT_LABEL_LENGTH = 40;
+    const NAME_LENGTH = 80;
+    const VALUE_LENGTH = 40;
+    const INPUT_ROLES = {
+        button: 'button', submit: 'button', reset: 'button', image: 'button', file: 'button', checkbox: 'checkbox',
+        radio: 'radio', range: 'slider', number: 'spinbutton', search: 'searchbox',
+    };
+    const OVERLAY_ID = 'pywebagent-marks';
+
+    function createState() {
+        const state = {
+            ids: new WeakMap(), // element -> stable id
+            entries: new Map(), // id -> { element, border, label }
+            candidates: [], // { element, rect } of the elements that passed all checks in the last pass
+            occluded: [], // elements that failed only the hit tests in the last pass, they may get uncovered
+            dirty: new Set(), // roots of the subtrees that changed since the last pass
+            needsFullPass: true,
+            viewport: null,
+            overlay: null, // container of the borders and labels
+            pending: [], // the records measured by the last pass, until they are drawn
+
+            resolve(id) {
+                const entry = this.entries.get(id);
+                return entry && entry.element.isConnected ? entry.element : null;
+            },
+
+            // Colors the border and label of an element, resolves with the element once the change is painted
+            highlight(id, color, waitForPaint = true) {
+                const entry = this.entries.get(id);
+                if (!entry) {
+                    return null;
+                }
+                entry.border.style.borderColor = color;
+                entry.label.style.backgroundColor = color;
+                if (!waitForPaint) {
+                    return this.resolve(id);
+                }
+                return new Promise(resolve => requestAnimationFrame(() => requestAnimationFrame(() => resolve(this.resolve(id)))));
+            },
+
+            html(id) {
+                const element = this.resolve(id);
+                return element ? element.outerHTML : null;
+            },
+
+            clearMarks() {
+                this.collectMutations(this.observer.takeRecords());
+                if (this.overlay) {
+                    this.overlay.remove();
+                    this.overlay = null;
+                }
+                this.observer.takeRecords(); // our own mutation
+            },
+
+            isOverlayRecord(record) {
+                const overlay = this.overlay;
+                if (!overlay) {
+                    return false;
+                }
+                if (record.type === 'childList') {
+                    const nodes = [...record.addedNodes, ...record.removedNodes];
+                    if (nodes.length > 0 && nodes.every(node => node === overlay)) {
+                        return true;
+                    }
+                }
+                return overlay.contains(record.target);
+            },
+
+            collectMutations(records) {
+                for (const record of records) {
+                    if (this.isOverlayRecord(record)) {
+                        continue;
+                    }
+                    const target = record.target.nodeType === Node.ELEMENT_NODE ? record.target : record.target.parentElement;
+                    if (!target || !document.body || !document.body.contains(target)) {
+                        // e.g. a stylesheet was added to the head, anything may have changed
+                        this.needsFullPass = true;
+                        continue;
+                    }
+                    this.dirty.add(target);
+                }
+            },
         };
+        state.observer = new MutationObserver(records => state.collectMutations(records));
+        state.observer.observe(document, { subtree: true, childList: true, attributes: true, characterData: true });
+        return state;
+    }
+
+    function getOriginalLabel(element) {
+        const originalLabel = element.getAttribute('aria-label');
+        if (originalLabel && originalLabel.includes('item_id__')) {
+            return originalLabel.replace(/item_id__\d+__/, '').trim();
+        }
+        return originalLabel;
     }
 
-    function getAdjustedElementFromPoint(x, y) {
-        return document.elementFromPoint(x - window.scrollX, y - window.scrollY);
+    function getShortLabel(element, originalLabel) {
+        const text = originalLabel || element.getAttribute('placeholder') || element.getAttribute('title')
+            || element.getAttribute('alt') || element.innerText || element.value || '';
+        return String(text).replace(/\s+/g, ' ').trim().slice(0, SHORT_LABEL_LENGTH);
     }
 
-    function getXPathForElement(element) {
-        // Check if the element is the body, if so, return the XPath for body
-        if (element.tagName === 'BODY') {
-            return '/html/body';
-        }
-    
-        // Initialize an array to store the path parts
-        const paths = [];
-    
-        // Iterate up the DOM tree
-        for (; element && element.nodeType === Node.ELEMENT_NODE; element = element.parentNode) {
-            let index = 0;
-            let hasFollowingSibling = false;
-    
-            // Iterate over previous siblings to calculate the index
-            for (let sibling = element.previousSibling; sibling; sibling = sibling.previousSibling) {
-                if (sibling.nodeType === Node.DOCUMENT_TYPE_NODE) {
-                    continue;
+    // Role, accessible name, value and state, for the text view of the page (see text_view.py)
+    function getRole(element) {
+        const role = element.getAttribute('role');
+        if (role) {
+            return role;
+        }
+        switch (element.tagName) {
+            case 'A': return element.hasAttribute('href') ? 'link' : 'generic';
+            case 'BUTTON': return 'button';
+            case 'SELECT': return element.multiple ? 'listbox' : 'combobox';
+            case 'TEXTAREA': return 'textbox';
+            case 'INPUT': return INPUT_ROLES[element.type] || 'textbox';
+            case 'IMG': return 'img';
+            default: return element.tagName.toLowerCase();
+        }
+    }
+
+    function getAccessibleName(element, originalLabel) {
+        let name = originalLabel;
+        const labelledBy = element.getAttribute('aria-labelledby');
+        if (!name && labelledBy) {
+            name = labelledBy.split(/\s+/).map(id => document.getElementById(id)?.innerText || '').join(' ');
+        }
+        if (!name && element.labels && element.labels.length > 0) {
+            name = element.labels[0].innerText;
+        }
+        if (!name) {
+            const isField = ['INPUT', 'TEXTAREA', 'SELECT'].includes(element.tagName) && !INPUT_ROLES[element.type];
+            name = element.getAttribute('placeholder') || element.getAttribute('title') || element.getAttribute('alt')
+                || (isField ? '' : element.innerText || element.value) || '';
+        }
+        return String(name).replace(/\s+/g, ' ').trim().slice(0, NAME_LENGTH);
+    }
+
+    function getValue(element) {
+        if (element.tagName === 'SELECT') {
+            return element.selectedOptions[0]?.text || '';
+        }
+        if (!['INPUT', 'TEXTAREA'].includes(element.tagName) || INPUT_ROLES[element.type] === 'button'
+            || ['checkbox', 'radio'].includes(element.type)) {
+            return '';
+        }
+        if (element.type === 'password') {
+            return element.value ? '********' : '';
+        }
+        return String(element.value || '').slice(0, VALUE_LENGTH);
+    }
+
+    function getStates(element) {
+        const states = [];
+        if (element.disabled || element.getAttribute('aria-disabled') === 'true') {
+            states.push('disabled');
+        }
+        if (element.checked || element.getAttribute('aria-checked') === 'true') {
+            states.push('checked');
+        }
+        if (element.getAttribute('aria-selected') === 'true') {
+            states.push('selected');
+        }
+        const expanded = element.getAttribute('aria-expanded');
+        if (expanded) {
+            states.push(expanded === 'true' ? 'expanded' : 'collapsed');
+        }
+        if (element.required) {
+            states.push('required');
+        }
+        if (element === document.activeElement) {
+            states.push('focused');
+        }
+        return states;
+    }
+
+    // Where the element is in the viewport, as one of 9 regions: 'top left', 'top', ..., 'center', ..., 'bottom right'
+    function getRegion(rect, viewport) {
+        const column = Math.min(2, Math.max(0, Math.floor(3 * (rect.left + rect.width / 2 - viewport.scrollX) / viewport.width)));
+        const row = Math.min(2, Math.max(0, Math.floor(3 * (rect.top + rect.height / 2 - viewport.scrollY) / viewport.height)));
+        const vertical = ['top', '', 'bottom'][row];
+        const horizontal = ['left', '', 'right'][column];
+        return [vertical, horizontal].filter(Boolean).join(' ') || 'center';
+    }
+
+    function isSameRect(rect, rect2) {
+        return rect.top === rect2.top && rect.left === rect2.left
+            && rect.width === rect2.width && rect.height === rect2.height;
+    }
+
+    function getIntersectionRect(rect, rect2) {
+        const intersectionRect = {
+            top: Math.max(rect.top, rect2.top),
+            left: Math.max(rect.left, rect2.left),
+            right: Math.min(rect.right, rect2.right),
+            bottom: Math.min(rect.bottom, rect2.bottom)
+        };
+        intersectionRect.width = intersectionRect.right - intersectionRect.left;
+        intersectionRect.height = intersectionRect.bottom - intersectionRect.top;
+        return intersectionRect;
+    }
+
+    // Checks if rect2 is (mostly) contained in rect
+    function isRectContainedInRect(rect, rect2) {
+        const intersectionRect = getIntersectionRect(rect, rect2);
+        return (intersectionRect.width >= 0.9 * rect2.width
+            && intersectionRect.height >= 0.9 * rect2.height);
+    }
+
+    function isPrioritisedElement(elem) {
+        return PRIORITISED_TAGS.includes(elem.tagName) || (elem.onclick !== null);
+    }
+
+    // Subtrees that can't contain a visible element are skipped as a whole.
+    // Off-viewport subtrees can't be skipped, descendants may overflow their ancestors' boxes,
+    // but for them the viewport check below is the only work done.
+    function canSkipSubtree(style) {
+        return style.display === 'none';
+    }
+
+    function isElementVisible(element, style) {
+        return !(style.display === 'none' || style.visibility === 'hidden' ||
+                 element.offsetWidth === 0 || element.offsetHeight === 0 ||
+                 element.getClientRects().length === 0);
+    }
+
+    function isAccessibleFromPoint(element, topElement) {
+        return topElement !== null && (topElement === element || topElement.contains(element));
+    }
+
+    // Uniform grid over the page, used to find marked elements that may contain a rect
+    class SpatialIndex {
+        constructor(cellSize) {
+            this.cellSize = cellSize;
+            this.cells = new Map();
+        }
+
+        *cellKeys(rect) {
+            const x0 = Math.floor(rect.left / this.cellSize), x1 = Math.floor(rect.right / this.cellSize);
+            const y0 = Math.floor(rect.top / this.cellSize), y1 = Math.floor(rect.bottom / this.cellSize);
+            for (let x = x0; x <= x1; x++) {
+                for (let y = y0; y <= y1; y++) {
+                    yield `${x},${y}`;
                 }
-                if (sibling.nodeName === element.nodeName) {
-                    index++;
+            }
+        }
+
+        insert(record) {
+            for (const key of this.cellKeys(record.rect)) {
+                if (!this.cells.has(key)) {
+                    this.cells.set(key, []);
                 }
+                this.cells.get(key).push(record);
             }
-    
-            // Check for following siblings with the same tag name
-            for (let sibling = element.nextSibling; sibling && !hasFollowingSibling; sibling = sibling.nextSibling) {
-                if (sibling.nodeName === element.nodeName) {
-                    hasFollowingSibling = true;
+        }
+
+        query(rect) {
+            const found = new Set();
+            for (const key of this.cellKeys(rect)) {
+                for (const record of this.cells.get(key) || []) {
+                    found.add(record);
                 }
             }
-    
-            // Build the XPath part for this element
-            const tagName = element.nodeName.toLowerCase();
-            const pathIndex = (index || hasFollowingSibling) ? `[${index + 1}]` : '';
-            paths.splice(0, 0, tagName + pathIndex);
-        }
-    
-        return paths.length ? '/' + paths.join('/') : null;
-    }    
-
-  function createLabel(rect, id) {
-      const label = document.createElement('div');
-      let labelLeft = rect.left - 16; // Your original calculation
-      if (labelLeft < 0) {
-          labelLeft = 0;
-      }
-  
-      Object.assign(label.style, {
-          position: 'absolute',
-          color: 'white',
-          backgroundColor: 'green',
-          fontSize: '15.5px',
-          padding: '2px 4px',
-          zIndex: '10000',
-          pointerEvents: 'none',
-          top: `${rect.top + 2}px`, // rect.top < 20 ? `${rect.bottom + 2}px` : `${rect.top - 16}px`,
-          left: `${labelLeft}px`,
-          opacity: '0.8',
-          //fontWeight: 'bold', // Makes the text bold
-        //   border: '2px solid red', // Red border
-        //   textShadow: ' -1px -1px 0 black, 1px -1px 0 black, -1px 1px 0 black, 1px 1px 0 black' // Red border effect around text
-
-      });
-      label.id = `item_id_label__${id}`;
-      label.textContent = id.toString();
-      document.body.appendChild(label);
-  }
-
-  function getIntersectionRect(rect, rect2) {
-    const intersectionRect = {
-        top: Math.max(rect.top, rect2.top),
-        left: Math.max(rect.left, rect2.left),
-        right: Math.min(rect.right, rect2.right),
-        bottom: Math.min(rect.bottom, rect2.bottom)
-    };
-    intersectionRect.width = intersectionRect.right - intersectionRect.left;
-    intersectionRect.height = intersectionRect.bottom - intersectionRect.top;
-    return intersectionRect;
-  }
-
-  // Checks if rects of one element is contained in another element
-  function isRectContainedInElement(element, element2) {
-    const rect = getAdjustedBoundingClientRect(element);
-    const rect2 = getAdjustedBoundingClientRect(element2);
-    const intersectionRect = getIntersectionRect(rect, rect2);
-    return (intersectionRect.width >= 0.9 * rect2.width 
-        && intersectionRect.height >= 0.9 * rect2.height);
-  }
-
-  function isPrioritisedElement(elem) {
-    return ['INPUT', 'SELECT', 'A', 'BUTTON', 'TEXTAREA'].includes(elem.tagName) || (elem.onclick !== null);
-  }
-
-  function createBorder(element, id) {
-      let rect = getAdjustedBoundingClientRect(element);
-      const topElement = getAdjustedElementFromPoint(rect.left, rect.top);
-      if (topElement) {
-        const rect2 = getAdjustedBoundingClientRect(topElement);
-        const intersectionRect = getIntersectionRect(rect, rect2);
-        // If intersection exists, use it
-        if (intersectionRect.width > 1 && intersectionRect.height > 1) {
-            rect = intersectionRect;
+            return found;
         }
     }
-      const border = document.createElement('div');
-      const pos = rect;
-      const eps = 2;
-      Object.assign(border.style, {
-          position: 'absolute',
-          border: '2px solid green',
-          width: `${rect.width + eps}px`,
-          height: `${rect.height + eps}px`,
-          left: `${pos.left - eps}px`,
-          top: `${pos.top - eps}px`,
-          zIndex: '9999',
-          pointerEvents: 'none'
-      });
-      border.id = `item_id_border__${id}`; // Assign a unique ID to the border
-      document.body.appendChild(border);
-      createLabel(rect, id);
-  }
-
-  function isElementVisible(element) {
-      const style = window.getComputedStyle(element);
-      return !(style.display === 'none' || style.visibility === 'hidden' ||
-               element.offsetWidth === 0 || element.offsetHeight === 0 || 
-               element.getClientRects().length === 0);
-  }
-
-  function isElementMouseAccessible(element) {
-    const rect = getAdjustedBoundingClientRect(element);
-    if (rect.width < 2 || rect.height < 2) {
-      return false;
+
+    function createBorder(container, rect, id) {
+        const border = document.createElement('div');
+        const eps = 2;
+        Object.assign(border.style, {
+            position: 'absolute',
+            border: '2px solid green',
+            width: `${rect.width + eps}px`,
+            height: `${rect.height + eps}px`,
+            left: `${rect.left - eps}px`,
+            top: `${rect.top - eps}px`,
+            zIndex: '9999',
+            pointerEvents: 'none'
+        });
+        border.id = `item_id_border__${id}`; // Assign a unique ID to the border
+        container.appendChild(border);
+        return border;
     }
 
-    function AccessibleFromLoc(element, x, y) {
-        const topElement = getAdjustedElementFromPoint(x, y);
-        if (topElement === null) {
-            // console.log('topElement is null');
-            return false;
+    function createLabel(container, rect, id) {
+        const label = document.createElement('div');
+        let labelLeft = rect.left - 16;
+        if (labelLeft < 0) {
+            labelLeft = 0;
+        }
+
+        Object.assign(label.style, {
+            position: 'absolute',
+            color: 'white',
+            backgroundColor: 'green',
+            fontSize: '15.5px',
+            padding: '2px 4px',
+            zIndex: '10000',
+            pointerEvents: 'none',
+            top: `${rect.top + 2}px`,
+            left: `${labelLeft}px`,
+            opacity: '0.8',
+        });
+        label.id = `item_id_label__${id}`;
+        label.textContent = id.toString();
+        container.appendChild(label);
+        return label;
+    }
+
+    // Phase 1 - read
+    function measure(options) {
+        const scrollX = window.scrollX;
+        const scrollY = window.scrollY;
+        const viewportWidth = document.documentElement.clientWidth;
+        const viewportHeight = document.documentElement.clientHeight;
+
+        function getAdjustedBoundingClientRect(element) {
+            const rect = element.getBoundingClientRect();
+            return {
+                top: rect.top + scrollY,
+                left: rect.left + scrollX,
+                bottom: rect.bottom + scrollY,
+                right: rect.right + scrollX,
+                width: rect.width,
+                height: rect.height
+            };
+        }
+
+        function getAdjustedElementFromPoint(x, y) {
+            return document.elementFromPoint(x - scrollX, y - scrollY);
+        }
+
+        function isElementInViewport(rect) {
+            return (rect.bottom < viewportHeight + scrollY
+                && rect.right < viewportWidth + scrollX
+                && rect.top >= scrollY
+                && rect.left >= scrollX);
+        }
+
+        const occluded = [];
+
+        // Returns a candidate record if the element can be marked, null otherwise.
+        // The cheap checks come first, hit testing is only done for elements that pass them.
+        function measureCandidate(element, style) {
+            const rect = getAdjustedBoundingClientRect(element);
+            if (!isElementInViewport(rect) || !isElementVisible(element, style)) {
+                return null;
+            }
+            if (rect.width < 2 || rect.height < 2) {
+                return null;
+            }
+            if (!ELEMENT_CURSORS.includes(style.cursor)) {
+                return null;
+            }
+
+            const topLeftElement = getAdjustedElementFromPoint(rect.left, rect.top);
+            const cursorFromPoint = topLeftElement ? window.getComputedStyle(topLeftElement).cursor : 'n/a';
+            if (!TOP_ELEMENT_CURSORS.includes(cursorFromPoint)) {
+                occluded.push(element);
+                return null;
+            }
+
+            const isMouseAccessible = isAccessibleFromPoint(element, topLeftElement)
+                || isAccessibleFromPoint(element, getAdjustedElementFromPoint(rect.right, rect.top))
+                || isAccessibleFromPoint(element, getAdjustedElementFromPoint(rect.left, rect.bottom))
+                || isAccessibleFromPoint(element, getAdjustedElementFromPoint(rect.right, rect.bottom))
+                || isAccessibleFromPoint(element, getAdjustedElementFromPoint(rect.left + rect.width / 2, rect.top + rect.height / 2));
+            if (!isMouseAccessible) {
+                occluded.push(element);
+                return null;
+            }
+
+            return { element, rect, topLeftElement, prioritised: isPrioritisedElement(element), order: 0 };
         }
-        if (topElement !== element && !topElement.contains(element)) {
-            // console.log('topElement does not contain element', topElement, element);
+
+        const state = window.__pywebagent__ = window.__pywebagent__ || createState();
+        state.collectMutations(state.observer.takeRecords());
+
+        function isInsideDirtySubtree(element) {
+            for (let ancestor = element; ancestor; ancestor = ancestor.parentElement) {
+                if (state.dirty.has(ancestor)) {
+                    return true;
+                }
+            }
             return false;
         }
-        // if direct child of topElement, then accessible
 
-        return true;
-    }
+        // Only the changed subtrees are walked again when the rest of the page can't have changed
+        function canPassBeIncremental() {
+            const viewport = state.viewport;
+            if (!options.incremental || state.needsFullPass || !viewport || !document.body) {
+                return false;
+            }
+            if (viewport.scrollX !== scrollX || viewport.scrollY !== scrollY
+                || viewport.width !== viewportWidth || viewport.height !== viewportHeight) {
+                return false;
+            }
+            if (state.dirty.has(document.body)) {
+                return false;
+            }
+            // A layout shift moves elements without mutating them, only a full pass finds all of them
+            for (const candidate of state.candidates) {
+                if (candidate.element.isConnected && !isInsideDirtySubtree(candidate.element)
+                    && !isSameRect(getAdjustedBoundingClientRect(candidate.element), candidate.rect)) {
+                    return false;
+                }
+            }
+            return true;
+        }
 
-    return (AccessibleFromLoc(element, rect.left, rect.top) ) 
-        || AccessibleFromLoc(element, rect.right, rect.top) 
-        || AccessibleFromLoc(element, rect.left, rect.bottom) 
-        || AccessibleFromLoc(element, rect.right, rect.bottom) 
-        || AccessibleFromLoc(element, rect.left + rect.width / 2, rect.top + rect.height / 2);
-  }
-  
-  function isElementInViewport(element) {
-    const rect = getAdjustedBoundingClientRect(element);
-    return (rect.bottom < document.documentElement.clientHeight + window.scrollY 
-        && rect.right < document.documentElement.clientWidth + window.scrollX 
-        && rect.top >= window.scrollY 
-        && rect.left >= window.scrollX);
-  }
-
-  function isElementInteractable(element) {
-    const rect = getAdjustedBoundingClientRect(element);
-    cursor = window.getComputedStyle(element).cursor;
-
-    const centerX = rect.left;
-    const centerY = rect.top;
-    const topElement = getAdjustedElementFromPoint(centerX, centerY);
-    cursor_from_point = 'n/a'
-    if (topElement) {
-        cursor_from_point =  window.getComputedStyle(topElement).cursor;
-    }
+        function walkSubtree(root, includeRoot, visit) {
+            if (includeRoot) {
+                const style = window.getComputedStyle(root);
+                if (canSkipSubtree(style)) {
+                    return;
+                }
+                visit(root, style);
+            }
+            const walker = document.createTreeWalker(root, NodeFilter.SHOW_ELEMENT, {
+                acceptNode(element) {
+                    if (element === state.overlay) {
+                        return NodeFilter.FILTER_REJECT;
+                    }
+                    const style = window.getComputedStyle(element);
+                    if (canSkipSubtree(style)) {
+                        return NodeFilter.FILTER_REJECT;
+                    }
+                    visit(element, style);
+                    return NodeFilter.FILTER_SKIP;
+                }
+            });
+            walker.nextNode();
+        }
 
-    return (['pointer', 'hand', 'text'].includes(cursor) 
-        && ['pointer', 'auto', 'hand', 'text'].includes(cursor_from_point));
-  }
+        const incremental = canPassBeIncremental();
+        const candidates = [];
+        const visitElement = (element, style) => {
+            const candidate = measureCandidate(element, style);
+            if (candidate) {
+                candidates.push(candidate);
+            }
+        };
+        if (incremental) {
+            // Re-walk the changed subtrees, and re-measure the elements outside them that were (almost) markable
+            const roots = [...state.dirty].filter(element => element.isConnected
+                && !(element.parentElement && isInsideDirtySubtree(element.parentElement)));
+            for (const root of roots) {
+                walkSubtree(root, true, visitElement);
+            }
+            const previous = new Set([...state.candidates.map(candidate => candidate.element), ...state.occluded]);
+            for (const element of previous) {
+                if (element.isConnected && !isInsideDirtySubtree(element)) {
+                    visitElement(element, window.getComputedStyle(element));
+                }
+            }
+            candidates.sort((a, b) => a.element.compareDocumentPosition(b.element) & Node.DOCUMENT_POSITION_FOLLOWING ? -1 : 1);
+        } else if (document.body) {
+            walkSubtree(document.body, false, visitElement);
+        }
 
+        const marked = new Map(); // element -> candidate record, for the currently marked elements
+        const spatialIndex = new SpatialIndex(GRID_CELL_SIZE);
+        let insertionOrder = 0;
 
-  function isMarkableElement(element) {
-    return (isElementInViewport(element) && isElementVisible(element) && isElementMouseAccessible(element) && isElementInteractable(element));
-  }
+        // The earliest marked element that contains the candidate, in the DOM tree or by area.
+        // Since candidates are added in document order, the earliest marked ancestor is the outermost one.
+        function findRelatedMarkedRecord(candidate) {
+            let containing = null;
+            for (let ancestor = candidate.element.parentElement; ancestor; ancestor = ancestor.parentElement) {
+                const record = marked.get(ancestor);
+                if (record) {
+                    containing = record;
+                }
+            }
+            if (containing) {
+                return containing;
+            }
 
-  function findRelatedMarkedElement(element, markedElements) {
-    containing_element_index = markedElements.findIndex(e => e.contains(element));
-    intersecting_element_index = markedElements.findIndex(e => isRectContainedInElement(e, element));
-    element_index = markedElements.length;
+            let intersecting = null;
+            for (const record of spatialIndex.query(candidate.rect)) {
+                if (marked.get(record.element) === record
+                    && (intersecting === null || record.order < intersecting.order)
+                    && isRectContainedInRect(record.rect, candidate.rect)) {
+                    intersecting = record;
+                }
+            }
+            return intersecting;
+        }
 
-    if (containing_element_index !== -1) {
-        containing_element = markedElements[containing_element_index];
-        if ((isPrioritisedElement(element)) && !isPrioritisedElement(containing_element)) {
-            console.log("removing element by dom tree hirarchy", containing_element, "because of element", element);
-            return containing_element_index;
-        } else {
-            return element_index;
+        function addCandidate(candidate) {
+            const related = findRelatedMarkedRecord(candidate);
+            if (related) {
+                // Keep the already marked element, unless only the new one is a prioritised element
+                if (!(candidate.prioritised && !related.prioritised)) {
+                    return;
+                }
+                marked.delete(related.element);
+            }
+            candidate.order = insertionOrder++;
+            marked.set(candidate.element, candidate);
+            spatialIndex.insert(candidate);
         }
-    } else if (intersecting_element_index !== -1) {
-        intersecting_element = markedElements[intersecting_element_index];
-        if ((isPrioritisedElement(element)) && !isPrioritisedElement(intersecting_element)) {
-            console.log("removing element by intersection", intersecting_element, "because of element", element);
-            return intersecting_element_index;
-        } else {
-            return element_index;
+
+        candidates.forEach(addCandidate);
+
+        const markedRecords = [...marked.values()].sort((a, b) => a.order - b.order);
+        for (const record of markedRecords) {
+            // The border is drawn over the part of the element that isn't covered
+            record.borderRect = record.rect;
+            if (record.topLeftElement) {
+                const rect2 = getAdjustedBoundingClientRect(record.topLeftElement);
+                const intersectionRect = getIntersectionRect(record.rect, rect2);
+                // If intersection exists, use it
+                if (intersectionRect.width > 1 && intersectionRect.height > 1) {
+                    record.borderRect = intersectionRect;
+                }
+            }
+            record.originalLabel = getOriginalLabel(record.element);
+            record.shortLabel = getShortLabel(record.element, record.originalLabel);
+            record.role = getRole(record.element);
+            record.name = getAccessibleName(record.element, record.originalLabel);
+            record.value = getValue(record.element);
+            record.states = getStates(record.element);
         }
-    }
 
-    return -1;
-  }
+        state.candidates = candidates.map(candidate => ({ element: candidate.element, rect: candidate.rect }));
+        state.occluded = occluded;
+        state.dirty.clear();
+        state.needsFullPass = false;
+        state.viewport = { scrollX, scrollY, width: viewportWidth, height: viewportHeight };
+        state.pending = markedRecords;
 
-  // Main code - mark elements that can be interacted
-  const markedElements = [];
-  const allElements = document.querySelectorAll('body *');
-  allElements.forEach(element => {
-    if (isMarkableElement(element)) {
-        remove_elem_index = findRelatedMarkedElement(element, markedElements);
+        const newElements = markedRecords.filter(record => !state.ids.has(record.element)).length;
+        return { newElements: newElements, incremental: incremental };
+    }
 
-        markedElements.push(element);
-        // Remove element because of containing / intersecting element that's already marked
-        if (remove_elem_index !== -1) {
-            markedElements.splice(remove_elem_index, 1);
+    // Phase 2 - write
+    function draw(nextId) {
+        const state = window.__pywebagent__;
+        const markedRecords = state.pending;
+        state.pending = [];
+        state.clearMarks();
+        const overlay = document.createElement('div');
+        overlay.id = OVERLAY_ID;
+        const markedElementsMetadata = [];
+        state.entries = new Map();
+        for (const record of markedRecords) {
+            const element = record.element;
+            let id = state.ids.get(element);
+            if (id === undefined) {
+                id = nextId++;
+                state.ids.set(element, id);
+            }
+            const originalLabel = record.originalLabel;
+            let newLabel = `item_id__${id}__`;
+            if (originalLabel) {
+                newLabel = `${originalLabel} ${newLabel}`;
+            }
+            element.setAttribute('aria-label', newLabel);
+            const border = createBorder(overlay, record.borderRect, id);
+            const label = createLabel(overlay, record.borderRect, id);
+            state.entries.set(id, { element, border, label });
+            const metadata = {
+                id: id,
+                tag: element.tagName,
+                bbox: {
+                    x: Math.round(record.rect.left),
+                    y: Math.round(record.rect.top),
+                    width: Math.round(record.rect.width),
+                    height: Math.round(record.rect.height),
+                },
+                label: record.shortLabel,
+                role: record.role,
+                name: record.name,
+                region: getRegion(record.rect, state.viewport),
+            };
+            if (record.value) {
+                metadata.value = record.value;
+            }
+            if (record.states.length > 0) {
+                metadata.states = record.states;
+            }
+            markedElementsMetadata.push(metadata);
         }
+        if (document.body) {
+            document.body.appendChild(overlay);
+            state.overlay = overlay;
+        }
+        state.observer.takeRecords(); // our own writes
+
+        return { elements: markedElementsMetadata, nextId: nextId };
+    }
 
+    // The <iframe> and <frame> elements in document order, a frame is visible when its element is shown,
+    // isn't tiny, and is inside the viewport
+    function frames() {
+        return [...document.querySelectorAll('iframe, frame')].map(element => {
+            const rect = element.getBoundingClientRect();
+            const style = window.getComputedStyle(element);
+            return {
+                name: element.name || element.id,
+                src: element.src,
+                visible: rect.width >= 2 && rect.height >= 2 && style.visibility !== 'hidden' && style.opacity !== '0'
+                    && rect.bottom > 0 && rect.right > 0 && rect.top < window.innerHeight
+                    && rect.left < window.innerWidth,
+            };
+        });
     }
-  });
-
-  // Mark the elements
-  markedElementsMetadata = [];
-  let counter = 0;  // NOTE: changed from outside the script at browser.py
-  for (let i = 0; i < markedElements.length; i++) {
-    const element = markedElements[i];
-    let originalLabel = element.getAttribute('aria-label');
-    let newLabel = `item_id__${counter}__`;
-
-    if (originalLabel && originalLabel.includes('item_id__')) {
-        originalLabel = originalLabel.replace(/item_id__\d+__/, '').trim();
+
+    // With options.frames, also lists the frames (read while the layout of phase 1 is still clean)
+    function mark(options) {
+        const { incremental } = measure(options);
+        const embedded = options.frames ? frames() : undefined;
+        return { ...draw(options.nextId), incremental: incremental, frames: embedded };
     }
 
-    if (originalLabel) {
-        newLabel = `${originalLabel} ${newLabel}`;
-    }  
-    element.setAttribute('aria-label', newLabel); 
-    createBorder(element, counter);
-    markedElementsMetadata.push({
-        id: counter, 
-        tag: element.tagName, 
-        class: element.className, 
-        xpath: getXPathForElement(element),
-        html: element.outerHTML, // Adding the HTML of the element
-        element: element, // Store the actual element
-        old_aria_label: originalLabel
-    });
-    counter++;
-  }
-
-  return markedElementsMetadata;
-})();
\ No newline at end of file
+    window.__pywebagent_marker__ = { measure, draw, mark, frames };
+})();
@@ -1,15 +1,7 @@
 (function() {
-    function isScriptGeneratedElement(element) {
-        // Check if the ID matches the pattern for script-generated borders or labels
-        const isBorder = element.id.startsWith('item_id_border__');
-        const isLabel = element.id.startsWith('item_id_label__');
-        return isBorder || isLabel;
+    // The borders and labels are kept in a single overlay by mark_borders.js,
+    // removing it doesn't discard the changes the page made since the last marking pass
+    if (window.__pywebagent__) {
+        window.__pywebagent__.clearMarks();
     }
-  
-    const allElements = document.querySelectorAll('body *');
-    allElements.forEach(element => {
-        if (isScriptGeneratedElement(element)) {
-            element.parentNode.removeChild(element);
-        }
-    });
   })();
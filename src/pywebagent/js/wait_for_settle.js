@@ -0,0 +1,47 @@
+async ({ quietMs, timeoutMs }) => {
+    // Resolves once the DOM had no mutations and no (finite) animations ran for `quietMs`, or after `timeoutMs`.
+    const start = performance.now();
+    let lastActivity = start;
+    const markActivity = () => { lastActivity = performance.now(); };
+    const observer = new MutationObserver(markActivity);
+    observer.observe(document, { subtree: true, childList: true, attributes: true, characterData: true });
+
+    function hasRunningAnimations() {
+        if (!document.getAnimations) {
+            return false;
+        }
+        return document.getAnimations().some(animation => {
+            if (animation.playState !== 'running' || !animation.effect) {
+                return false;
+            }
+            // Endless animations (spinners, carousels) never settle, ignore them
+            return animation.effect.getComputedTiming().endTime !== Infinity;
+        });
+    }
+
+    function nextFrame() {
+        // requestAnimationFrame does not fire in background pages, fall back to a timer
+        return new Promise(resolve => {
+            requestAnimationFrame(resolve);
+            setTimeout(resolve, 100);
+        });
+    }
+
+    try {
+        while (true) {
+            await nextFrame();
+            if (hasRunningAnimations()) {
+                markActivity();
+            }
+            const now = performance.now();
+            if (now - lastActivity >= quietMs) {
+                return { waited: now - start, timedOut: false };
+            }
+            if (now - start >= timeoutMs) {
+                return { waited: now - start, timedOut: true };
+            }
+        }
+    } finally {
+        observer.disconnect();
+    }
+}
@@ -0,0 +1,597 @@
+"""
+A single LLM client layer shared by all the agents of a process.
+
+- `LLMBackend` implementations send one request: `LangChainBackend` (one reused `ChatOpenAI`)
+  and `OpenAIHTTPBackend` (the chat completions HTTP API over keep-alive connections).
+  `ScriptedBackend` replays recorded responses without a model.
+- `RateLimiter` is a process-wide RPM/TPM token bucket, every running agent waits on the same one.
+- `LLMClient` retries with jittered exponential backoff chosen by the error type, and keeps `LLMStats`.
+"""
+import asyncio
+import http.client
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from dataclasses import dataclass, field, replace
+from typing import AsyncIterator, Callable, Dict, Iterator, Optional
+from urllib.parse import urlsplit
+from pywebagent import tracing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gpt-4-vision-preview"
+DEFAULT_MAX_TOKENS = 2000
+DEFAULT_REQUEST_TIMEOUT = 120
+
+# Rough image token costs, used to reserve TPM before the actual usage is known
+IMAGE_TOKENS = {"low": 85, "high": 1105, "auto": 1105}
+
+
+@dataclass
+class LLMResponse:
+    content: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class LLMError(Exception):
+    """An error of an LLM request. `retryable` errors are retried by `LLMClient`."""
+
+    retryable = False
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RateLimitError(LLMError):
+    retryable = True
+
+
+class TransientLLMError(LLMError):
+    """Timeouts, dropped connections and server errors."""
+
+    retryable = True
+
+
+def classify_error(e: Exception) -> LLMError:
+    """Maps the exceptions of the backends' libraries to `LLMError` types."""
+    if isinstance(e, LLMError):
+        return e
+    status = getattr(e, "status_code", None) or getattr(e, "http_status", None)
+    name = type(e).__name__
+    if status == 429 or name == "RateLimitError":
+        return RateLimitError(str(e), status=status)
+    if (name in ("APITimeoutError", "Timeout", "APIConnectionError", "ServiceUnavailableError", "InternalServerError")
+            or isinstance(e, (TimeoutError, ConnectionError, http.client.HTTPException))
+            or (status is not None and status >= 500)):
+        return TransientLLMError(str(e), status=status)
+    return LLMError(str(e), status=status)
+
+
+@dataclass
+class BackoffPolicy:
+    base_delay: float = 1.0  # seconds, for transient errors
+    rate_limit_base_delay: float = 5.0  # seconds, rate limits take longer to clear
+    max_delay: float = 60.0
+
+    def delay(self, attempt: int, error: LLMError) -> float:
+        """Full jitter exponential backoff, a server provided Retry-After is respected as a lower bound."""
+        base = self.rate_limit_base_delay if isinstance(error, RateLimitError) else self.base_delay
+        delay = random.uniform(0, min(self.max_delay, base * 2 ** attempt))
+        if error.retry_after is not None:
+            delay = max(delay, min(error.retry_after, self.max_delay))
+        return delay
+
+
+class TokenBucket:
+    """Continuously refilled bucket of `capacity` tokens per minute."""
+
+    def __init__(self, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Takes `amount` tokens, possibly going into debt. Returns the seconds until the debt is paid."""
+        self._refill()
+        amount = min(amount, self.capacity)  # a request larger than the bucket would never fit
+        self.tokens -= amount
+        return max(0.0, -self.tokens * 60 / self.capacity)
+
+    def adjust(self, amount: float):
+        """Gives back (or takes more) tokens once the actual usage of a request is known."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    """Requests per minute and tokens per minute limits, shared by every thread and event loop of the process."""
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None, clock: Callable[[], float] = time.monotonic):
+        self._lock = threading.Lock()
+        self.requests = TokenBucket(rpm, clock) if rpm else None
+        self.tokens = TokenBucket(tpm, clock) if tpm else None
+
+    def reserve(self, estimated_tokens: int) -> float:
+        """Reserves capacity for one request, returns how long the caller must wait before sending it."""
+        with self._lock:
+            wait = 0.0
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1))
+            if self.tokens is not None:
+                wait = max(wait, self.tokens.reserve(estimated_tokens))
+            return wait
+
+    def acquire(self, estimated_tokens: int) -> float:
+        wait = self.reserve(estimated_tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def async_acquire(self, estimated_tokens: int) -> float:
+        wait = self.reserve(estimated_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def reconcile(self, estimated_tokens: int, used_tokens: int):
+        if self.tokens is not None and used_tokens:
+            with self._lock:
+                self.tokens.adjust(estimated_tokens - used_tokens)
+
+
+@dataclass
+class LLMStats:
+    requests: int = 0
+    retries: int = 0
+    failures: int = 0
+    queue_wait: float = 0.0  # seconds spent waiting on the rate limiter
+    latency: float = 0.0  # seconds spent in successful requests
+    max_latency: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cancelled_streams: int = 0  # streamed responses stopped once the caller had what it needed
+    errors: Dict[str, int] = field(default_factory=dict)  # error type -> count
+
+    @property
+    def mean_latency(self) -> float:
+        return self.latency / self.requests if self.requests else 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+def message_role(message) -> str:
+    return {"human": "user", "ai": "assistant"}.get(message.type, message.type)
+
+
+def estimate_tokens(messages: list, max_tokens: int = 0) -> int:
+    """Approximate tokens of a request, OpenAI counts `max_tokens` against the TPM limit too."""
+    tokens = max_tokens
+    for message in messages:
+        content = message.content if isinstance(message.content, list) else [message.content]
+        for part in content:
+            if isinstance(part, str):
+                tokens += len(part) // 4
+            elif part.get("type") == "text":
+                tokens += len(part["text"]) // 4
+            elif part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS.get(part["image_url"].get("detail", "auto"), IMAGE_TOKENS["auto"])
+    return tokens
+
+
+class LLMBackend:
+    """Sends a single chat request, errors are raised as is and classified by `LLMClient`."""
+
+    model: str = DEFAULT_MODEL
+    max_tokens: int = DEFAULT_MAX_TOKENS
+
+    def complete(self, messages: list) -> LLMResponse:
+        raise NotImplementedError
+
+    async def acomplete(self, messages: list) -> LLMResponse:
+        return await asyncio.to_thread(self.complete, messages)
+
+    def stream(self, messages: list) -> Iterator[str]:
+        """Yields the response as it is generated, closing the iterator stops the generation."""
+        yield self.complete(messages).content
+
+    async def astream(self, messages: list) -> AsyncIterator[str]:
+        chunks = self.stream(messages)
+        done = object()
+        try:
+            while (chunk := await asyncio.to_thread(next, chunks, done)) is not done:
+                yield chunk
+        finally:
+            await asyncio.to_thread(chunks.close)
+
+    def close(self):
+        pass
+
+
+class LangChainBackend(LLMBackend):
+    """Sends requests through one `ChatOpenAI` instance, so its HTTP client and connections are reused."""
+
+    def __init__(self, model: str = DEFAULT_MODEL, temperature: float = 1, max_tokens: int = DEFAULT_MAX_TOKENS,
+                 request_timeout: float = DEFAULT_REQUEST_TIMEOUT):
+        from langchain.chat_models import ChatOpenAI
+
+        self.model = model
+        self.max_tokens = max_tokens
+        # Retries are done by LLMClient, with the shared rate limiter
+        self.llm = ChatOpenAI(
+            model_name=model,
+            temperature=temperature,
+            request_timeout=request_timeout,
+            max_tokens=max_tokens,
+            max_retries=0,
+        )
+
+    @staticmethod
+    def _to_response(result) -> LLMResponse:
+        usage = (result.llm_output or {}).get("token_usage", {})
+        return LLMResponse(
+            content=result.generations[0][0].message.content,
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            completion_tokens=usage.get("completion_tokens", 0),
+        )
+
+    def complete(self, messages: list) -> LLMResponse:
+        return self._to_response(self.llm.generate([messages]))
+
+    async def acomplete(self, messages: list) -> LLMResponse:
+        return self._to_response(await self.llm.agenerate([messages]))
+
+    def stream(self, messages: list) -> Iterator[str]:
+        for chunk in self.llm.stream(messages):
+            yield chunk.content
+
+    async def astream(self, messages: list) -> AsyncIterator[str]:
+        async for chunk in self.llm.astream(messages):
+            yield chunk.content
+
+
+class OpenAIHTTPBackend(LLMBackend):
+    """
+    Calls the chat completions API directly with the standard library.
+    Connections are kept alive and pooled, at most `max_connections` are open at once.
+    """
+
+    def __init__(self, model: str = DEFAULT_MODEL, temperature: float = 1, max_tokens: int = DEFAULT_MAX_TOKENS,
+                 request_timeout: float = DEFAULT_REQUEST_TIMEOUT, api_key: str = None,
+                 base_url: str = "https://api.openai.com/v1", max_connections: int = 8):
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.request_timeout = request_timeout
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY", "")
+        url = urlsplit(base_url)
+        self._connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self._host = url.netloc
+        self._path = url.path.rstrip("/") + "/chat/completions"
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self.connections_opened = 0
+
+    def _connect(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            self.connections_opened += 1
+            return self._connection_class(self._host, timeout=self.request_timeout)
+
+    def _body(self, messages: list, stream: bool = False) -> bytes:
+        return json.dumps({
+            "model": self.model,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "messages": [{"role": message_role(message), "content": message.content} for message in messages],
+            "stream": stream,
+        }).encode()
+
+    def _headers(self) -> dict:
+        return {"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"}
+
+    @staticmethod
+    def _raise_for_status(response, data: bytes):
+        if response.status < 400:
+            return
+        message = data.decode(errors="replace")[:500]
+        retry_after = _parse_retry_after(response.getheader("Retry-After"))
+        if response.status == 429:
+            raise RateLimitError(message, status=response.status, retry_after=retry_after)
+        if response.status >= 500 or response.status == 408:
+            raise TransientLLMError(message, status=response.status, retry_after=retry_after)
+        raise LLMError(message, status=response.status)
+
+    def complete(self, messages: list) -> LLMResponse:
+        body = self._body(messages)
+        with self._slots:
+            connection = self._connect()
+            try:
+                connection.request("POST", self._path, body=body, headers=self._headers())
+                response = connection.getresponse()
+                data = response.read()
+            except Exception:
+                connection.close()  # the connection state is unknown, don't reuse it
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._idle.put(connection)
+
+        self._raise_for_status(response, data)
+        payload = json.loads(data)
+        usage = payload.get("usage", {})
+        return LLMResponse(
+            content=payload["choices"][0]["message"]["content"],
+            prompt_tokens=usage.get("prompt_tokens", 0),
+            completion_tokens=usage.get("completion_tokens", 0),
+        )
+
+    def stream(self, messages: list) -> Iterator[str]:
+        """Reads the server-sent events of a streamed completion. Stopping early closes the connection, which cancels the generation."""
+        body = self._body(messages, stream=True)
+        with self._slots:
+            connection = self._connect()
+            reusable = False
+            try:
+                connection.request("POST", self._path, body=body, headers=self._headers())
+                response = connection.getresponse()
+                if response.status >= 400:
+                    data = response.read()
+                    reusable = not response.will_close
+                    self._raise_for_status(response, data)
+                for line in response:
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[len(b"data:"):].strip()
+                    if data == b"[DONE]":
+                        response.read()
+                        reusable = not response.will_close
+                        return
+                    content = json.loads(data)["choices"][0]["delta"].get("content")
+                    if content:
+                        yield content
+            finally:
+                if reusable:
+                    self._idle.put(connection)
+                else:
+                    connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ScriptedBackend(LLMBackend):
+    """
+    Replays recorded responses in order instead of calling a model, for tests and offline benchmarks.
+    `delay` simulates the model's latency, in seconds.
+    """
+
+    def __init__(self, responses: list, delay: float = 0.0, model: str = "scripted"):
+        self.model = model
+        self.delay = delay
+        self.requests = []  # the messages of each request
+        self._responses = list(responses)
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self) -> int:
+        return len(self._responses)
+
+    def complete(self, messages: list) -> LLMResponse:
+        with self._lock:
+            if not self._responses:
+                raise LLMError(f"Scripted backend ran out of responses after {len(self.requests)} requests")
+            self.requests.append(messages)
+            content = self._responses.pop(0)
+        if self.delay:
+            time.sleep(self.delay)
+        return LLMResponse(
+            content=content,
+            prompt_tokens=estimate_tokens(messages, max_tokens=0),
+            completion_tokens=len(content) // 4,
+        )
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None  # an HTTP date, the backoff delay is used instead
+
+
+class LLMClient:
+    """Sends requests through a backend, waiting on the rate limiter and retrying failed requests."""
+
+    def __init__(self, backend: LLMBackend = None, limiter: RateLimiter = None, max_retries: int = 5,
+                 backoff: BackoffPolicy = None):
+        self.backend = backend or LangChainBackend()
+        self.limiter = limiter or get_rate_limiter()
+        self.max_retries = max_retries
+        self.backoff = backoff or BackoffPolicy()
+        self._stats = LLMStats()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self) -> LLMStats:
+        with self._lock:
+            return replace(self._stats, errors=dict(self._stats.errors))
+
+    def _record_success(self, response: LLMResponse, latency: float, estimated_tokens: int):
+        self.limiter.reconcile(estimated_tokens, response.prompt_tokens + response.completion_tokens)
+        with self._lock:
+            self._stats.requests += 1
+            self._stats.latency += latency
+            self._stats.max_latency = max(self._stats.max_latency, latency)
+            self._stats.prompt_tokens += response.prompt_tokens
+            self._stats.completion_tokens += response.completion_tokens
+        tracing.current_span().set(latency=latency, prompt_tokens=response.prompt_tokens,
+                                   completion_tokens=response.completion_tokens)
+
+    def _record_error(self, e: Exception, attempt: int) -> float:
+        """Returns the delay before the next attempt, raises if the request shouldn't be retried."""
+        error = classify_error(e)
+        with self._lock:
+            name = type(error).__name__
+            self._stats.errors[name] = self._stats.errors.get(name, 0) + 1
+            if not error.retryable or attempt >= self.max_retries:
+                self._stats.failures += 1
+                if error is e:
+                    raise error
+                raise error from e
+            self._stats.retries += 1
+        tracing.current_span().add("retries")
+        delay = self.backoff.delay(attempt, error)
+        logger.warning(f"LLM request failed ({name}: {error}), retrying in {delay:.1f}s")
+        return delay
+
+    def _record_wait(self, waited: float):
+        with self._lock:
+            self._stats.queue_wait += waited
+        tracing.current_span().add("queue_wait", waited)
+
+    def complete(self, messages: list) -> LLMResponse:
+        estimated_tokens = estimate_tokens(messages, self.backend.max_tokens)
+        with tracing.span("llm.request", model=self.backend.model, estimated_tokens=estimated_tokens):
+            for attempt in range(self.max_retries + 1):
+                self._record_wait(self.limiter.acquire(estimated_tokens))
+                start = time.monotonic()
+                try:
+                    response = self.backend.complete(messages)
+                except Exception as e:
+                    time.sleep(self._record_error(e, attempt))
+                    continue
+                self._record_success(response, time.monotonic() - start, estimated_tokens)
+                return response
+
+    async def acomplete(self, messages: list) -> LLMResponse:
+        estimated_tokens = estimate_tokens(messages, self.backend.max_tokens)
+        with tracing.span("llm.request", model=self.backend.model, estimated_tokens=estimated_tokens):
+            for attempt in range(self.max_retries + 1):
+                self._record_wait(await self.limiter.async_acquire(estimated_tokens))
+                start = time.monotonic()
+                try:
+                    response = await self.backend.acomplete(messages)
+                except Exception as e:
+                    await asyncio.sleep(self._record_error(e, attempt))
+                    continue
+                self._record_success(response, time.monotonic() - start, estimated_tokens)
+                return response
+
+    def _record_stream(self, chunks: list, stopped: bool, latency: float, estimated_tokens: int) -> LLMResponse:
+        # Streams don't report usage, it is estimated like the reservation
+        content = "".join(chunks)
+        response = LLMResponse(
+            content=content,
+            prompt_tokens=max(0, estimated_tokens - self.backend.max_tokens),
+            completion_tokens=len(content) // 4,
+        )
+        self._record_success(response, latency, estimated_tokens)
+        if stopped:
+            with self._lock:
+                self._stats.cancelled_streams += 1
+        tracing.current_span().set(cancelled=stopped)
+        return response
+
+    def stream(self, messages: list, new_stop_condition: Callable[[], Callable[[str], bool]]) -> LLMResponse:
+        """
+        Streams the response, and stops the generation as soon as the stop condition returns True.
+        `new_stop_condition` is called once per attempt, it returns a function fed with each chunk.
+        """
+        estimated_tokens = estimate_tokens(messages, self.backend.max_tokens)
+        with tracing.span("llm.request", model=self.backend.model, estimated_tokens=estimated_tokens, streamed=True):
+            for attempt in range(self.max_retries + 1):
+                self._record_wait(self.limiter.acquire(estimated_tokens))
+                start = time.monotonic()
+                is_complete = new_stop_condition()
+                chunks, stopped = [], False
+                stream = self.backend.stream(messages)
+                try:
+                    for chunk in stream:
+                        chunks.append(chunk)
+                        if is_complete(chunk):
+                            stopped = True
+                            break
+                except Exception as e:
+                    time.sleep(self._record_error(e, attempt))
+                    continue
+                finally:
+                    stream.close()
+                return self._record_stream(chunks, stopped, time.monotonic() - start, estimated_tokens)
+
+    async def astream(self, messages: list, new_stop_condition: Callable[[], Callable[[str], bool]]) -> LLMResponse:
+        """Async version of `stream`."""
+        estimated_tokens = estimate_tokens(messages, self.backend.max_tokens)
+        with tracing.span("llm.request", model=self.backend.model, estimated_tokens=estimated_tokens, streamed=True):
+            for attempt in range(self.max_retries + 1):
+                self._record_wait(await self.limiter.async_acquire(estimated_tokens))
+                start = time.monotonic()
+                is_complete = new_stop_condition()
+                chunks, stopped = [], False
+                stream = self.backend.astream(messages)
+                try:
+                    async for chunk in stream:
+                        chunks.append(chunk)
+                        if is_complete(chunk):
+                            stopped = True
+                            break
+                except Exception as e:
+                    await asyncio.sleep(self._record_error(e, attempt))
+                    continue
+                finally:
+                    await stream.aclose()
+                return self._record_stream(chunks, stopped, time.monotonic() - start, estimated_tokens)
+
+    def close(self):
+        self.backend.close()
+
+
+_rate_limiter = RateLimiter()
+_clients: Dict[str, LLMClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    return _rate_limiter
+
+
+def configure_rate_limits(rpm: Optional[int] = None, tpm: Optional[int] = None):
+    """Sets the process-wide limits, use your OpenAI account's limits for the model."""
+    global _rate_limiter
+    _rate_limiter = RateLimiter(rpm=rpm, tpm=tpm)
+    with _clients_lock:
+        for client in _clients.values():
+            client.limiter = _rate_limiter
+
+
+def get_client(model: str = DEFAULT_MODEL) -> LLMClient:
+    """The process-wide client of `model`, created on first use with the LangChain backend."""
+    with _clients_lock:
+        if model not in _clients:
+            _clients[model] = LLMClient(LangChainBackend(model=model), limiter=_rate_limiter)
+        return _clients[model]
+
+
+def set_client(client: LLMClient, model: str = DEFAULT_MODEL):
+    """Replaces the client of `model`, e.g. with an `OpenAIHTTPBackend` or a scripted backend in tests."""
+    with _clients_lock:
+        _clients[model] = client
@@ -0,0 +1,129 @@
+"""
+Detects agent runs that stopped making progress, so they are steered or stopped early instead of using all their steps.
+
+After each step the monitor keeps a fingerprint of the code run and of the page it led to (URL, perceptual hash of
+the screenshot and marked elements), so a blinking cursor or a carousel doesn't make a page look new. Over a small
+window it detects:
+- the same execution error several steps in a row,
+- cycles, the same actions leading to the same pages again and again (A, B, A, B),
+- stalls, several steps that left the page exactly as it was.
+
+Each detection gets the next response of `ProgressConfig.responses`: a hint in the next prompt, a forced scroll or
+a reset of the page (both with the hint), or failing the run with the diagnostic as its reason. By default only hints
+are given, the run itself is never changed.
+"""
+import hashlib
+import json
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import NamedTuple, Optional, Tuple
+from pywebagent.env.delta import screenshot_hash
+
+logger = logging.getLogger(__name__)
+
+RESPONSES = ("hint", "scroll", "reset", "fail")
+SCROLL_CODE = "actions.scroll('down', 'Scrolled down, the last actions made no progress')"
+HINT_TEMPLATE = ("{diagnostic} Your last actions are not moving the task forward. Try something different: another "
+                 "element, scrolling, or another way to reach the goal. If the task can't be done, call actions.finish "
+                 "with did_succeed=False and the reason.")
+
+
+@dataclass
+class ProgressConfig:
+    enabled: bool = True
+    error_repeats: int = 3  # the same execution error this many steps in a row
+    cycle_repeats: int = 2  # the same actions and pages this many times in a row
+    max_cycle_length: int = 3  # longest sequence of steps considered as a cycle
+    stall_steps: int = 4  # steps in a row that left the page unchanged
+    responses: Tuple[str, ...] = ("hint",)  # to the 1st, 2nd, ... detection, the last one repeats
+
+    def __post_init__(self):
+        unknown = set(self.responses) - set(RESPONSES)
+        if unknown or not self.responses:
+            raise ValueError(f"Progress responses must be some of {RESPONSES}, got {self.responses}")
+
+    @property
+    def window(self) -> int:
+        return max(self.error_repeats, self.cycle_repeats * self.max_cycle_length, self.stall_steps + 1)
+
+
+class Detection(NamedTuple):
+    kind: str  # "repeated_error", "cycle" or "stall"
+    diagnostic: str
+    response: str
+
+    @property
+    def hint(self) -> str:
+        return HINT_TEMPLATE.format(diagnostic=self.diagnostic)
+
+
+def _digest(value) -> str:
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=8).hexdigest()
+
+
+def elements_signature(marked_elements: dict) -> str:
+    return _digest([[element_id, element["tag"], element.get("bbox"), element.get("label")]
+                    for element_id, element in sorted(marked_elements.items())])
+
+
+class ProgressMonitor:
+    """Keeps the recent steps of one run, `observe` returns a `Detection` when the run looks stuck."""
+
+    def __init__(self, config: ProgressConfig = None):
+        self.config = config or ProgressConfig()
+        self.detections = 0
+        self._steps = deque(maxlen=self.config.window)  # (code, page state, error) after each step
+        self._state = None  # the page state before the first step in the window
+
+    def start(self, observation) -> None:
+        """Sets the page the run starts from, and after an intervention the page it continues from."""
+        self._state = self._page_state(observation)
+        self._steps.clear()
+
+    def observe(self, code: str, observation) -> Optional[Detection]:
+        if not self.config.enabled:
+            return None
+        state = self._page_state(observation)
+        self._steps.append((" ".join(code.split()), state, observation.error_message or None))
+        detection = self._detect()
+        if detection is None:
+            return None
+        kind, diagnostic = detection
+        response = self.config.responses[min(self.detections, len(self.config.responses) - 1)]
+        self.detections += 1
+        logger.warning(f"The run is stuck, {diagnostic} Responding with: {response}")
+        self.start(observation)
+        return Detection(kind, diagnostic, response)
+
+    def _page_state(self, observation) -> tuple:
+        delta = getattr(observation, "delta", None)
+        previous = self._steps[-1][1] if self._steps else self._state
+        if delta is not None and delta.image_mode == "none" and previous is not None:
+            screenshot = previous[1]  # not visibly changed
+        elif delta is not None:
+            screenshot = delta.phash  # of the thumbnail, already computed
+        else:
+            screenshot = screenshot_hash(observation.screenshot) if observation.screenshot else None
+        return observation.url, screenshot, elements_signature(observation.marked_elements)
+
+    def _detect(self) -> Optional[Tuple[str, str]]:
+        config, steps = self.config, list(self._steps)
+        errors = [error for _, _, error in steps[-config.error_repeats:]]
+        if len(errors) == config.error_repeats and errors[0] and errors.count(errors[0]) == len(errors):
+            return "repeated_error", f"The same error happened {len(errors)} times in a row: {errors[0]}"
+
+        for length in range(1, config.max_cycle_length + 1):
+            size = length * config.cycle_repeats
+            if len(steps) < size:
+                break
+            window = [(code, state) for code, state, _ in steps[-size:]]
+            if all(window[i] == window[i - length] for i in range(length, size)):
+                actions = "the same action" if length == 1 else f"the same {length} actions"
+                return "cycle", f"The run repeated {actions} {config.cycle_repeats} times, ending on the same pages."
+
+        states = [self._state] + [state for _, state, _ in steps]
+        states = states[-config.stall_steps - 1:]
+        if len(states) > config.stall_steps and states.count(states[0]) == len(states):
+            return "stall", f"The page has not changed in the last {config.stall_steps} steps ({states[0][0]})."
+        return None
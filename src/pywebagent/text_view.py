@@ -0,0 +1,104 @@
+"""
+A text view of the page, a cheaper alternative to sending the screenshot to a vision model.
+
+The marking pass describes each marked element with its role, accessible name, value, state and the region of the
+viewport it is in. The view lists them by region, within a token budget:
+
+    top:
+      [3] searchbox "Search Amazon" value="plush bunny" (focused)
+      [4] button "Go"
+    center:
+      [12] link "Jellycat Bashful Bunny, Medium"
+
+Pages the list can't describe well enough, such as unlabeled icon buttons or many identical buttons next to each
+other, make the view ambiguous, and the step falls back to the screenshot and the vision model.
+"""
+import json
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+DEFAULT_TEXT_MODEL = "gpt-3.5-turbo"
+REGIONS = ["top left", "top", "top right", "left", "center", "right", "bottom left", "bottom", "bottom right"]
+CHARS_PER_TOKEN = 4  # as estimated by the LLM client
+
+
+@dataclass
+class TextViewConfig:
+    model: str = DEFAULT_TEXT_MODEL  # answers the steps that get the text view
+    max_tokens: int = 1500  # budget of the elements list
+    min_elements: int = 1  # fewer marked elements, e.g. a canvas app, need the screenshot
+    max_unnamed_fraction: float = 0.2  # of the elements without an accessible name
+    max_duplicate_fraction: float = 0.5  # of the elements sharing role and name with another one in their region
+
+
+@dataclass
+class TextView:
+    text: str
+    ambiguous: Optional[str] = None  # why the screenshot is needed, None when the text is enough
+    omitted: int = 0  # elements left out of the budget
+
+
+def format_element(element_id: int, element: Dict) -> str:
+    parts = [f"[{element_id}] {element.get('role') or element['tag'].lower()}"]
+    if element.get("name"):
+        parts.append(json.dumps(element["name"], ensure_ascii=False))
+    if element.get("value"):
+        parts.append(f"value={json.dumps(element['value'], ensure_ascii=False)}")
+    if element.get("states"):
+        parts.append(f"({', '.join(element['states'])})")
+    return " ".join(parts)
+
+
+def group_by_region(marked_elements: Dict[int, Dict]) -> Dict[str, list]:
+    """(id, element) pairs per region in reading order, regions from the top left to the bottom right."""
+    groups = defaultdict(list)
+    for element_id, element in marked_elements.items():
+        groups[element.get("region") or "center"].append((element_id, element))
+    order = {region: index for index, region in enumerate(REGIONS)}
+    return {
+        region: sorted(groups[region], key=lambda item: (item[1]["bbox"]["y"], item[1]["bbox"]["x"]))
+        for region in sorted(groups, key=lambda region: order.get(region, len(REGIONS)))
+    }
+
+
+def find_ambiguity(marked_elements: Dict[int, Dict], groups: Dict[str, list], config: TextViewConfig) -> Optional[str]:
+    count = len(marked_elements)
+    if count < config.min_elements:
+        return f"only {count} interactive elements were found"
+    unnamed = sum(1 for element in marked_elements.values() if not element.get("name"))
+    if unnamed > config.max_unnamed_fraction * count:
+        return f"{unnamed} of {count} elements have no name"
+    duplicates = 0
+    for elements in groups.values():
+        names = Counter((element.get("role"), element.get("name")) for _, element in elements)
+        duplicates += sum(repeats for repeats in names.values() if repeats > 1)
+    if duplicates > config.max_duplicate_fraction * count:
+        return f"{duplicates} of {count} elements share their name with another one nearby"
+    return None
+
+
+def build_text_view(marked_elements: Dict[int, Dict], config: TextViewConfig = None) -> TextView:
+    config = config or TextViewConfig()
+    groups = group_by_region(marked_elements)
+    budget = config.max_tokens * CHARS_PER_TOKEN
+    lines, used, omitted = [], 0, 0
+    for region, elements in groups.items():
+        header = f"{region}:"
+        for element_id, element in elements:
+            line = f"  {format_element(element_id, element)}"
+            cost = len(line) + 1 + (len(header) + 1 if header else 0)
+            if used + cost > budget:
+                omitted += 1
+                continue
+            if header:
+                lines.append(header)
+                header = None
+            lines.append(line)
+            used += cost
+    if omitted:
+        lines.append(f"... and {omitted} more elements, left out for brevity")
+    ambiguous = find_ambiguity(marked_elements, groups, config)
+    if ambiguous is None and omitted:
+        ambiguous = f"{omitted} elements did not fit in {config.max_tokens} tokens"
+    return TextView("\n".join(lines), ambiguous, omitted)
@@ -0,0 +1,345 @@
+"""
+Spans and metrics of agent runs, to see where the time of a step goes.
+
+A span times one phase (an LLM request, marking a frame, a screenshot, executing the generated code...) and
+carries attributes such as payload sizes and retry counts. Spans nest, the current span is kept in a context
+variable so it follows threads started with `bind` and asyncio tasks. Finished spans are passed to the tracer's
+hooks, `JSONLExporter` writes them one per line with OpenTelemetry's span fields. Without hooks, spans cost
+next to nothing.
+
+Set PYWEBAGENT_TRACE to a file path to trace every run of the process to it, and get a per-phase breakdown with:
+    python -m pywebagent.tracing trace.jsonl [--baseline baseline.jsonl]
+"""
+import argparse
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import secrets
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TRACE_PATH_ENV = "PYWEBAGENT_TRACE"
+REGRESSION_THRESHOLD = 0.2  # relative p50 increase reported as a regression
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str  # shared by all the spans of a run
+    span_id: str
+    parent_id: Optional[str] = None
+    start_time: float = 0.0  # unix seconds
+    duration: float = 0.0  # seconds
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, name: str, value=1):
+        """Increments a counter attribute, e.g. retries."""
+        self.attributes[name] = self.attributes.get(name, 0) + value
+
+    def record_error(self, message: str):
+        """Marks the span as failed, for errors that are handled inside it."""
+        self.error = message
+
+    def to_dict(self) -> dict:
+        """OpenTelemetry's span fields."""
+        start = int(self.start_time * 1e9)
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "start_time_unix_nano": start,
+            "end_time_unix_nano": start + int(self.duration * 1e9),
+            "attributes": self.attributes,
+            "status": {"code": "ERROR", "message": self.error} if self.error else {"code": "OK"},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Span":
+        start = data["start_time_unix_nano"]
+        return cls(
+            name=data["name"],
+            trace_id=data["trace_id"],
+            span_id=data["span_id"],
+            parent_id=data.get("parent_span_id"),
+            start_time=start / 1e9,
+            duration=(data["end_time_unix_nano"] - start) / 1e9,
+            attributes=data.get("attributes", {}),
+            error=data.get("status", {}).get("message"),
+        )
+
+
+class _NoopSpan:
+    """Stands in for spans while tracing is off."""
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, name: str, value=1):
+        pass
+
+    def record_error(self, message: str):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+_current_span = contextvars.ContextVar("pywebagent_current_span", default=None)
+
+
+class TraceHook:
+    """Receives the spans of a tracer, subclass it to forward spans to another system."""
+
+    def on_span_start(self, span: Span):
+        pass
+
+    def on_span_end(self, span: Span):
+        pass
+
+    def close(self):
+        pass
+
+
+class JSONLExporter(TraceHook):
+    """Appends each finished span to a file as a JSON line."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", buffering=1)  # line buffered, a crashed run keeps its spans
+
+    def on_span_end(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Tracer:
+    def __init__(self, hooks: List[TraceHook] = None):
+        self.hooks = list(hooks or [])
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.hooks)
+
+    def add_hook(self, hook: TraceHook):
+        self.hooks = self.hooks + [hook]  # copied, spans being ended iterate the previous list
+
+    def remove_hook(self, hook: TraceHook):
+        self.hooks = [h for h in self.hooks if h is not hook]
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Times the block as a child of the current span. Exceptions leaving the block mark the span as failed."""
+        hooks = self.hooks
+        if not hooks:
+            yield NOOP_SPAN
+            return
+        parent = _current_span.get()
+        span = Span(
+            name=name,
+            trace_id=parent.trace_id if parent else secrets.token_hex(16),
+            span_id=secrets.token_hex(8),
+            parent_id=parent.span_id if parent else None,
+            start_time=time.time(),
+            attributes=attributes,
+        )
+        _notify(hooks, "on_span_start", span)
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            _current_span.reset(token)
+            _notify(hooks, "on_span_end", span)
+
+    def close(self):
+        for hook in self.hooks:
+            hook.close()
+
+
+def _notify(hooks, method, span):
+    for hook in hooks:
+        try:
+            getattr(hook, method)(span)
+        except Exception as e:
+            logger.warning(f"Trace hook {type(hook).__name__} failed: {e}")
+
+
+def _default_tracer() -> Tracer:
+    path = os.environ.get(TRACE_PATH_ENV)
+    return Tracer([JSONLExporter(path)] if path else [])
+
+
+_tracer = _default_tracer()
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def set_tracer(tracer: Tracer):
+    """Replaces the process-wide tracer, e.g. with one exporting to a file or to your own hook."""
+    global _tracer
+    _tracer = tracer
+
+
+def span(name: str, **attributes):
+    """A span of the process-wide tracer."""
+    return _tracer.span(name, **attributes)
+
+
+def traced(name: str, **attributes):
+    """Decorator running each call of a function, or coroutine function, in a span."""
+    def decorate(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def run_async(*args, **kwargs):
+                with _tracer.span(name, **attributes):
+                    return await function(*args, **kwargs)
+            return run_async
+
+        @functools.wraps(function)
+        def run(*args, **kwargs):
+            with _tracer.span(name, **attributes):
+                return function(*args, **kwargs)
+        return run
+
+    return decorate
+
+
+def current_span():
+    return _current_span.get() or NOOP_SPAN
+
+
+def bind(function):
+    """Runs `function` under the current span when called from another thread."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)  # a context can't be entered by two threads at once
+
+    return run
+
+
+# --- report ---
+
+@dataclass
+class PhaseStats:
+    count: int = 0
+    errors: int = 0
+    total: float = 0.0
+    self_total: float = 0.0  # without the time of child spans
+    durations: List[float] = field(default_factory=list)
+    attribute_totals: Dict[str, float] = field(default_factory=dict)  # numeric attributes
+
+    def percentile(self, fraction: float) -> float:
+        durations = sorted(self.durations)
+        return durations[min(len(durations) - 1, int(fraction * len(durations)))] if durations else 0.0
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+def load_spans(path) -> List[Span]:
+    with open(path) as file:
+        return [Span.from_dict(json.loads(line)) for line in file if line.strip()]
+
+
+def summarize(spans: List[Span]) -> Dict[str, PhaseStats]:
+    children_time = {}
+    for span in spans:
+        if span.parent_id is not None:
+            children_time[span.parent_id] = children_time.get(span.parent_id, 0.0) + span.duration
+    phases = {}
+    for span in spans:
+        stats = phases.setdefault(span.name, PhaseStats())
+        stats.count += 1
+        stats.errors += span.error is not None
+        stats.total += span.duration
+        # children of a span can overlap, e.g. concurrent sub-agents
+        stats.self_total += max(0.0, span.duration - children_time.get(span.span_id, 0.0))
+        stats.durations.append(span.duration)
+        for name, value in span.attributes.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                stats.attribute_totals[name] = stats.attribute_totals.get(name, 0) + value
+    return phases
+
+
+def find_regressions(phases: Dict[str, PhaseStats], baseline: Dict[str, PhaseStats],
+                     threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """Phases whose median got slower than the baseline's by more than `threshold`."""
+    return [
+        name for name, stats in phases.items()
+        if name in baseline and stats.percentile(0.5) > baseline[name].percentile(0.5) * (1 + threshold)
+    ]
+
+
+def format_report(phases: Dict[str, PhaseStats], baseline: Dict[str, PhaseStats] = None,
+                  threshold: float = REGRESSION_THRESHOLD) -> str:
+    wall_time = sum(stats.self_total for stats in phases.values()) or 1.0
+    header = f"{'phase':<24} {'count':>6} {'total s':>9} {'self %':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}"
+    if baseline is not None:
+        header += f" {'p50 vs base':>12}"
+    lines = [header + "  mean attributes"]
+    regressions = set(find_regressions(phases, baseline, threshold)) if baseline is not None else set()
+    for name, stats in sorted(phases.items(), key=lambda item: -item[1].self_total):
+        line = (f"{name:<24} {stats.count:>6} {stats.total:>9.2f} {stats.self_total / wall_time:>7.1%} "
+                f"{stats.percentile(0.5) * 1000:>9.1f} {stats.percentile(0.95) * 1000:>9.1f} "
+                f"{max(stats.durations) * 1000:>9.1f}")
+        if baseline is not None:
+            if name in baseline and baseline[name].percentile(0.5) > 0:
+                change = stats.percentile(0.5) / baseline[name].percentile(0.5) - 1
+                line += f" {change:>+11.0%}{'!' if name in regressions else ' '}"
+            else:
+                line += f" {'new':>12}"
+        attributes = " ".join(f"{key}={value / stats.count:.4g}" for key, value in sorted(stats.attribute_totals.items()))
+        if stats.errors:
+            attributes = f"errors={stats.errors} " + attributes
+        lines.append(f"{line}  {attributes}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m pywebagent.tracing",
+                                     description="Per-phase latency breakdown of a JSONL trace.")
+    parser.add_argument("trace", help="trace file written by JSONLExporter")
+    parser.add_argument("--baseline", help="trace to compare with, exits with 1 if a phase regressed")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="relative p50 increase counted as a regression (default %(default)s)")
+    args = parser.parse_args(argv)
+
+    phases = summarize(load_spans(args.trace))
+    baseline = summarize(load_spans(args.baseline)) if args.baseline else None
+    print(format_report(phases, baseline, args.threshold))
+    if baseline is not None:
+        regressions = find_regressions(phases, baseline, args.threshold)
+        if regressions:
+            print(f"\nRegressed phases: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
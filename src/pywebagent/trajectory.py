@@ -0,0 +1,230 @@
+"""
+Records the steps of agent runs and replays them without calling the LLM.
+
+A step is stored with the fingerprint of the page it acted on. On replay, the recorded code of a successful run
+is reused as long as the live page has the same fingerprint at the same step, the LLM is only called once the
+run diverges. Task arguments are templated out of the recorded code, so a run recorded with some arguments
+replays with others.
+"""
+import ast
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE_PATH = Path(os.environ.get("PYWEBAGENT_CACHE_DIR", Path.home() / ".cache" / "pywebagent")) / "trajectories.sqlite"
+ARG_TOKEN = "__pywebagent_arg_{}__"
+ARG_TOKEN_PATTERN = re.compile(r"__pywebagent_arg_(\w+?)__")
+MIN_TEMPLATED_ARG_LENGTH = 3  # shorter values appear in code by chance
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trajectories (
+    id INTEGER PRIMARY KEY,
+    task_key TEXT NOT NULL,
+    url TEXT NOT NULL,
+    task TEXT NOT NULL,
+    created REAL NOT NULL,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS trajectories_task_key ON trajectories (task_key, status);
+CREATE TABLE IF NOT EXISTS steps (
+    trajectory_id INTEGER NOT NULL REFERENCES trajectories (id) ON DELETE CASCADE,
+    step INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    elements TEXT NOT NULL,
+    code TEXT NOT NULL,
+    error TEXT,
+    replayed INTEGER NOT NULL,
+    PRIMARY KEY (trajectory_id, step)
+);
+CREATE INDEX IF NOT EXISTS steps_fingerprint ON steps (step, fingerprint);
+"""
+
+
+def normalize_url(url: str) -> str:
+    """Scheme, host and path, query strings usually hold session or tracking values."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path.rstrip('/')}"
+
+
+def get_task_key(url: str, task: str) -> str:
+    return hashlib.sha1(json.dumps([normalize_url(url), task.strip()]).encode()).hexdigest()
+
+
+def summarize_elements(marked_elements: Dict[int, dict]) -> list:
+    """(id, tag, label) of the marked elements, digits are masked since counters and prices change between runs."""
+    return [
+        [element_id, element["tag"].lower(), re.sub(r"\d+", "#", element.get("label") or "")]
+        for element_id, element in sorted(marked_elements.items())
+    ]
+
+
+def page_fingerprint(url: str, marked_elements: Dict[int, dict]) -> str:
+    """Recorded code is only valid on a page with the same marked elements under the same ids."""
+    summary = [normalize_url(url), summarize_elements(marked_elements)]
+    return hashlib.sha1(json.dumps(summary).encode()).hexdigest()
+
+
+class _ReplaceStrings(ast.NodeTransformer):
+    def __init__(self, replace):
+        self.replace = replace
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, str):
+            return ast.copy_location(ast.Constant(value=self.replace(node.value)), node)
+        return node
+
+
+def _transform_strings(code: str, replace) -> str:
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code  # recorded as is, it failed when executed anyway
+    return ast.unparse(ast.fix_missing_locations(_ReplaceStrings(replace).visit(tree)))
+
+
+def template_code(code: str, args: dict) -> str:
+    """Replaces the task arguments' values in the code's string literals with placeholders."""
+    values = sorted(
+        ((name, value) for name, value in args.items() if isinstance(value, str) and len(value) >= MIN_TEMPLATED_ARG_LENGTH),
+        key=lambda item: len(item[1]),
+        reverse=True,  # longest first, so a value containing another one is replaced whole
+    )
+    if not values:
+        return code
+
+    def replace(text):
+        for name, value in values:
+            text = text.replace(value, ARG_TOKEN.format(name))
+        return text
+
+    return _transform_strings(code, replace)
+
+
+def render_code(code: str, args: dict) -> Optional[str]:
+    """Fills the placeholders with the arguments of this run, None if an argument is missing."""
+    names = set(ARG_TOKEN_PATTERN.findall(code))
+    if not names:
+        return code
+    if any(not isinstance(args.get(name), str) for name in names):
+        return None
+    return _transform_strings(code, lambda text: ARG_TOKEN_PATTERN.sub(lambda match: args[match.group(1)], text))
+
+
+class TrajectoryStore:
+    """On-disk SQLite store of recorded runs, safe to share between the agents of a process."""
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA foreign_keys=ON")
+        self._connection.executescript(SCHEMA)
+
+    def start(self, url: str, task: str) -> int:
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                "INSERT INTO trajectories (task_key, url, task, created) VALUES (?, ?, ?, ?)",
+                (get_task_key(url, task), url, task, time.time()),
+            )
+            return cursor.lastrowid
+
+    def add_step(self, trajectory_id: int, step: int, url: str, fingerprint: str, elements: list,
+                 code: str, error: Optional[str], replayed: bool):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (trajectory_id, step, url, fingerprint, json.dumps(elements), code, error, int(replayed)),
+            )
+
+    def finish(self, trajectory_id: int, status: str):
+        with self._lock, self._connection:
+            self._connection.execute("UPDATE trajectories SET status = ? WHERE id = ?", (status, trajectory_id))
+
+    def find_code(self, task_key: str, step: int, fingerprint: str) -> Optional[str]:
+        """The code the latest successful run of the task executed at this step on the same page."""
+        with self._lock:
+            row = self._connection.execute(
+                """SELECT steps.code FROM steps JOIN trajectories ON trajectories.id = steps.trajectory_id
+                   WHERE trajectories.task_key = ? AND trajectories.status = 'SUCCESS'
+                   AND steps.step = ? AND steps.fingerprint = ? AND steps.error IS NULL
+                   ORDER BY trajectories.id DESC LIMIT 1""",
+                (task_key, step, fingerprint),
+            ).fetchone()
+        return row[0] if row else None
+
+    def delete_task(self, url: str, task: str) -> int:
+        """Forgets the recorded runs of a task, e.g. after the site changed."""
+        with self._lock, self._connection:
+            return self._connection.execute(
+                "DELETE FROM trajectories WHERE task_key = ?", (get_task_key(url, task),)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class TrajectoryRecorder:
+    """
+    Records one run of the agent. In "replay" mode it also provides the recorded code for the steps
+    that match a successful run, until the first divergence. "record" mode always asks the LLM.
+    """
+
+    MODES = ("record", "replay")
+
+    def __init__(self, store: TrajectoryStore, url: str, task, mode: str = "replay"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown trajectory mode {mode}, expected one of {self.MODES}")
+        self.store = store
+        self.task = task
+        self.task_key = get_task_key(url, task.task)
+        self.replaying = mode == "replay"
+        self.trajectory_id = store.start(url, task.task)
+        self.step = 0
+        self.replayed_steps = 0
+
+    def recorded_code(self, observation) -> Optional[str]:
+        """The code to run on this observation without the LLM, None to ask the LLM."""
+        if not self.replaying:
+            return None
+        code = self.store.find_code(self.task_key, self.step, page_fingerprint(observation.url, observation.marked_elements))
+        code = render_code(code, self.task.args) if code is not None else None
+        if code is None:
+            logger.info(f"Trajectory diverged at step {self.step}, using the LLM from now on")
+            self.replaying = False
+        return code
+
+    def record(self, observation, code: str, error: Optional[str], replayed: bool):
+        """Saves the code executed on `observation` and its outcome."""
+        self.store.add_step(
+            self.trajectory_id,
+            self.step,
+            observation.url,
+            page_fingerprint(observation.url, observation.marked_elements),
+            summarize_elements(observation.marked_elements),
+            template_code(code, self.task.args),
+            error,
+            replayed,
+        )
+        if replayed:
+            self.replayed_steps += 1
+            if error is not None:
+                logger.info(f"Replayed step {self.step} failed, using the LLM from now on")
+                self.replaying = False
+        self.step += 1
+
+    def finish(self, status):
+        self.store.finish(self.trajectory_id, status.name)
+        logger.info(f"Trajectory finished with {status.name}, {self.replayed_steps}/{self.step} steps replayed")
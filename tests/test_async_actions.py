@@ -0,0 +1,45 @@
+import asyncio
+import pytest
+
+pytest.importorskip("playwright")  # the async actions import playwright
+from pywebagent.async_agent import AsyncAgentRunner  # noqa: E402
+from pywebagent.env.async_actions import STEP_FUNCTION_NAME, compile_async_step  # noqa: E402
+
+
+class FakeActions:
+    def __init__(self):
+        self.calls = []
+
+    async def click(self, item_id, log_message):
+        self.calls.append(item_id)
+
+
+def run_step(code):
+    actions = FakeActions()
+    context = {"actions": actions}
+    exec(compile_async_step(code), context, context)
+    asyncio.run(context[STEP_FUNCTION_NAME]())
+    return actions.calls, context
+
+
+def test_action_calls_are_awaited_at_top_level_and_in_async_functions():
+    code = "for i in range(2):\n    actions.click(i, '')\nasync def more():\n    actions.click(9, '')\n"
+    calls, context = run_step(code + "total = len([1, 2])")
+    assert calls == [0, 1] and context["total"] == 2
+
+    calls, _ = run_step("def ids():\n    return [3, 4]\nfor i in ids():\n    actions.click(i, '')")
+    assert calls == [3, 4]
+
+
+@pytest.mark.parametrize("code,kind", [
+    ("def go():\n    actions.click(1, '')\ngo()", "function"),
+    ("go = lambda: actions.click(1, '')", "lambda"),
+])
+def test_action_calls_in_nested_scopes_are_rejected(code, kind):
+    with pytest.raises(SyntaxError, match=f"actions.click can't be called inside a nested {kind}"):
+        compile_async_step(code)
+
+
+def test_sync_only_options_are_rejected():
+    with pytest.raises(TypeError, match="does not support `pool`"):
+        asyncio.run(AsyncAgentRunner().act("https://example.com", "task", pool=object()))
@@ -0,0 +1,98 @@
+import inspect
+import time
+import pytest
+from pywebagent.batch import (
+    ACT_OPTIONS, CANCELLED, FAILED, PENDING, RUNNING, SUCCEEDED, AgentTaskRunner, BatchRunner, TaskQueue, load_tasks,
+    main,
+)
+
+
+class ScriptedTaskRunner:
+    """Behaves as told by the task's kwargs, in place of a browser and the agent."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def run(self, task):
+        time.sleep(task.kwargs.get("sleep", 0))
+        if task.attempts <= task.kwargs.get("raise_attempts", 0):
+            raise ValueError(f"attempt {task.attempts}")
+        return True, {"echo": task.kwargs.get("echo")}
+
+
+def test_queue_retries_cancels_and_recovers(tmp_path):
+    queue = TaskQueue(tmp_path / "batch.sqlite")
+    first = queue.add("https://example.com", "a", {"x": 1}, max_attempts=2)
+    second = queue.add("https://example.com", "b")
+
+    task = queue.claim(runner=1)
+    assert (task.id, task.status, task.attempts, task.kwargs) == (first, RUNNING, 1, {"x": 1})
+    assert queue.finish(first, False, error="boom") == PENDING
+    assert queue.claim(runner=1).id == first
+    assert queue.finish(first, False, error="boom again") == FAILED
+    assert queue.get(first).error == "boom again"
+
+    queue.claim(runner=2**22 + 1)  # a pid that isn't running, as if the runner crashed
+    assert queue.recover() == 1
+    assert queue.get(second).status == PENDING
+    assert queue.claim(runner=1).attempts == 2
+    queue.requeue([second])
+    assert queue.get(second).attempts == 1
+
+    assert queue.cancel() == 1
+    assert queue.finish(second, True) is None  # a cancelled task stays cancelled
+    assert queue.counts() == {PENDING: 0, RUNNING: 0, SUCCEEDED: 0, FAILED: 1, CANCELLED: 1}
+
+
+def test_runner_retries_times_out_and_persists_outputs(tmp_path):
+    queue = TaskQueue(tmp_path / "batch.sqlite")
+    ok = queue.add("https://example.com", "ok", {"echo": "done"})
+    flaky = queue.add("https://example.com", "flaky", {"raise_attempts": 1})
+    broken = queue.add("https://example.com", "broken", {"raise_attempts": 2})
+    hung = queue.add("https://example.com", "hung", {"sleep": 60}, timeout=1, max_attempts=1)
+
+    stats = BatchRunner(queue, workers=2, task_runner=ScriptedTaskRunner(), poll_interval=0.1).run()
+
+    assert (stats.succeeded, stats.failed, stats.retried, stats.timed_out) == (2, 2, 2, 1)
+    assert stats.worker_restarts == 1
+    assert queue.get(ok).output == {"echo": "done"}
+    assert queue.get(flaky).status == SUCCEEDED and queue.get(flaky).attempts == 2
+    assert queue.get(broken).error == "ValueError: attempt 2"
+    assert queue.get(hung).error == "Timed out after 1s"
+
+
+def test_cli_queues_task_files(tmp_path, capsys):
+    tasks = tmp_path / "tasks.jsonl"
+    tasks.write_text('{"url": "https://example.com", "task": "a", "kwargs": {"x": 1}}\n\n'
+                     '{"url": "https://example.com", "task": "b", "max_attempts": 5}\n')
+    assert len(load_tasks(tasks)) == 2
+    db = str(tmp_path / "batch.sqlite")
+    assert main(["--db", db, "add", str(tasks), "--timeout", "30"]) == 0
+    assert main(["--db", db, "cancel", "2"]) == 0
+    assert main(["--db", db, "status"]) == 0
+    assert "pending=1 running=0 succeeded=0 failed=0 cancelled=1" in capsys.readouterr().out
+
+    queue = TaskQueue(db)
+    first, second = queue.tasks()
+    assert (first.timeout, first.max_attempts, second.max_attempts) == (30, 2, 5)
+
+
+def test_task_arguments_named_like_act_options_are_rejected(tmp_path):
+    queue = TaskQueue(tmp_path / "batch.sqlite")
+    with pytest.raises(ValueError, match="delta_config"):
+        queue.add_many([{"url": "https://example.com", "task": "a"},
+                        {"url": "https://example.com", "task": "b", "kwargs": {"delta_config": None, "size": 2}}])
+    assert queue.counts()[PENDING] == 0  # none of the file was queued
+    with pytest.raises(ValueError, match="pool"):
+        AgentTaskRunner(pool=None)
+
+
+def test_act_options_match_act():
+    pytest.importorskip("playwright")  # importing the agent imports the browser environment
+    from pywebagent.agent import act
+
+    parameters = inspect.signature(act).parameters
+    assert ACT_OPTIONS == tuple(name for name, parameter in parameters.items() if parameter.kind != parameter.VAR_KEYWORD)
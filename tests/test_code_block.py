@@ -0,0 +1,19 @@
+import pytest
+
+pytest.importorskip("playwright")  # importing the agent imports the browser environment
+from pywebagent.agent import CodeBlockParser, extract_code  # noqa: E402
+
+RESPONSE = ["Plan: click the button\nCode:\n", "```python\nactions.click(1, ", '"Sign in")\n`', "``", "\nThe button submits the form"]
+
+
+def test_code_block_parser_across_chunks():
+    parser = CodeBlockParser()
+    text = "".join(RESPONSE)
+    assert not any(parser.feed(character) for character in text[:text.index('")') + 5])
+    assert parser.feed("`") and parser.code == 'actions.click(1, "Sign in")\n'
+    assert extract_code(text) == parser.code
+    assert extract_code("Code:\n```py\nactions.finish()") == "actions.finish()"
+    assert extract_code("Code:\n```python\nx = 1\n    ```\nDone") == "x = 1\n"
+    assert extract_code("Code:\n```\nprint('```')\n\t```") == "print('```')\n"
+    with pytest.raises(Exception, match="Code not found"):
+        extract_code("actions.finish()")
@@ -0,0 +1,96 @@
+import struct
+import zlib
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+from pywebagent.env.delta import DeltaConfig, Thumbnail, compare, decode_thumbnail, get_keyframe_config  # noqa: E402
+from pywebagent.env.screenshot import ScreenshotConfig  # noqa: E402
+
+VIEWPORT = {"x": 0, "y": 0, "width": 1600, "height": 900}
+
+
+def _paeth(left, up, up_left):
+    estimate = left + up - up_left
+    distances = [abs(estimate - left), abs(estimate - up), abs(estimate - up_left)]
+    return (left, up, up_left)[distances.index(min(distances))]
+
+
+def encode_png(pixels, filter_types=(0, 1, 2, 3, 4)):
+    """Minimal PNG encoder, cycling through the filter types row by row."""
+    height, width, channels = pixels.shape
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+    raw = bytearray()
+    previous = [0] * (width * channels)
+    for y in range(height):
+        line = [int(v) for v in pixels[y].reshape(-1)]
+        kind = filter_types[y % len(filter_types)]
+        encoded = []
+        for x, value in enumerate(line):
+            left = line[x - channels] if x >= channels else 0
+            up_left = previous[x - channels] if x >= channels else 0
+            predictor = [0, left, previous[x], (left + previous[x]) // 2, _paeth(left, previous[x], up_left)][kind]
+            encoded.append((value - predictor) % 256)
+        raw += bytes([kind] + encoded)
+        previous = line
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(bytes(raw))) + chunk(b"IEND", b"")
+
+
+@pytest.mark.parametrize("channels", [1, 3, 4])
+def test_decode_thumbnail_all_filters(channels):
+    pixels = np.random.default_rng(channels).integers(0, 256, size=(10, 7, channels), dtype=np.uint8)
+    expected = pixels[:, :, 0] if channels == 1 else pixels[:, :, :3] @ np.array([0.299, 0.587, 0.114])
+    gray = decode_thumbnail(encode_png(pixels))
+    assert gray.shape == (10, 7) and np.abs(gray - expected).max() <= 1
+
+
+def thumbnail(pixels, url="https://example.com"):
+    return Thumbnail(pixels=pixels.astype(np.float32), viewport=VIEWPORT, url=url)
+
+
+def test_compare_modes():
+    config = DeltaConfig()
+    page = np.tile(np.linspace(0, 255, 160, dtype=np.float32), (90, 1))
+    assert compare(None, thumbnail(page), config).image_mode == "full"
+    assert compare(thumbnail(page), thumbnail(page), config).image_mode == "none"
+    assert compare(thumbnail(page), thumbnail(page, url="https://example.com/next"), config).image_mode == "full"
+
+    typed = page.copy()
+    typed[10:14, 20:40] = 0  # text typed into a field
+    delta = compare(thumbnail(page), thumbnail(typed), config)
+    assert delta.image_mode == "crop"
+    region = delta.changed_region
+    assert region["x"] == pytest.approx(20 * 10 - config.crop_margin)
+    assert region["y"] == pytest.approx(10 * 10 - config.crop_margin)
+    assert region["width"] == pytest.approx(20 * 10 + 2 * config.crop_margin)
+
+    new_page = 255 - page
+    assert compare(thumbnail(page), thumbnail(new_page), config).image_mode == "full"
+
+
+
+def test_keyframe_stays_readable():
+    keyframe = get_keyframe_config(ScreenshotConfig(max_width=1280, max_bytes=150_000), DeltaConfig())
+    assert keyframe.max_width == 1024 and keyframe.detail == "high" and keyframe.max_bytes is None
+    with pytest.raises(ValueError):
+        DeltaConfig(keyframe_width=None)
+    with pytest.raises(ValueError):
+        DeltaConfig(keyframe_width=256)
+
+def test_prompt_without_full_screenshot_lists_every_element():
+    pytest.importorskip("playwright")  # importing the agent imports the browser environment
+    from types import SimpleNamespace
+    from pywebagent.agent import format_marked_elements
+    from pywebagent.env.delta import ObservationDelta
+
+    elements = {1: {"tag": "A"}, 2: {"tag": "BUTTON"}, 5: {"tag": "INPUT"}}
+    observation = SimpleNamespace(marked_elements=elements, delta=ObservationDelta(image_mode="none", phash=0),
+                                  added_element_ids=[5], removed_element_ids=[3])
+    text = format_marked_elements(observation)
+    assert "(1) - <a>, (2) - <button>, (5) - <input>" in text
+    assert "added since the last action:\n(5) - <input>" in text and "removed since the last action: [3]" in text
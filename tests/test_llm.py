@@ -0,0 +1,215 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+import pytest
+
+from pywebagent.llm import (
+    BackoffPolicy,
+    LLMClient,
+    LLMError,
+    OpenAIHTTPBackend,
+    RateLimiter,
+    RateLimitError,
+    ScriptedBackend,
+    TokenBucket,
+    estimate_tokens,
+)
+
+MESSAGES = [
+    SimpleNamespace(type="system", content="You are an agent"),
+    SimpleNamespace(type="human", content=[{"type": "text", "text": "Task"}]),
+]
+NO_BACKOFF = BackoffPolicy(base_delay=0, rate_limit_base_delay=0)
+
+
+class StubServer:
+    """Chat completions server answering with queued (status, body, headers) responses."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.client_ports = set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                stub.requests.append(json.loads(body))
+                stub.client_ports.add(self.client_address[1])
+                status, payload, headers = stub.responses.pop(0)
+                if isinstance(payload, list):  # streamed chunks
+                    events = [{"choices": [{"delta": {"content": chunk}}]} for chunk in payload]
+                    data = b"".join(f"data: {json.dumps(event)}\n\n".encode() for event in events) + b"data: [DONE]\n\n"
+                else:
+                    data = json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def streamed(*chunks):
+    return (200, list(chunks), {"Content-Type": "text/event-stream"})
+
+
+def completion(content, prompt_tokens=10, completion_tokens=5):
+    return (200, {
+        "choices": [{"message": {"role": "assistant", "content": content}}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens},
+    }, {})
+
+
+@pytest.fixture
+def make_client():
+    servers, clients = [], []
+
+    def make(responses, **kwargs):
+        server = StubServer(responses)
+        client = LLMClient(OpenAIHTTPBackend(base_url=server.url, api_key="test"),
+                           limiter=RateLimiter(), backoff=NO_BACKOFF, **kwargs)
+        servers.append(server)
+        clients.append(client)
+        return server, client
+
+    yield make
+    for client in clients:
+        client.close()
+    for server in servers:
+        server.close()
+
+
+def test_reuses_connection(make_client):
+    server, client = make_client([completion("one"), completion("two")])
+    assert client.complete(MESSAGES).content == "one"
+    assert client.complete(MESSAGES).content == "two"
+    assert len(server.client_ports) == 1
+    assert client.backend.connections_opened == 1
+    assert server.requests[0]["messages"][1] == {"role": "user", "content": [{"type": "text", "text": "Task"}]}
+
+
+def test_retries_rate_limit_and_counts(make_client):
+    server, client = make_client([
+        (429, {"error": "slow down"}, {"Retry-After": "0"}),
+        (503, {"error": "overloaded"}, {}),
+        completion("done", prompt_tokens=100, completion_tokens=20),
+    ])
+    assert client.complete(MESSAGES).content == "done"
+    stats = client.stats
+    assert stats.requests == 1
+    assert stats.retries == 2
+    assert stats.errors == {"RateLimitError": 1, "TransientLLMError": 1}
+    assert stats.total_tokens == 120
+
+
+def test_does_not_retry_client_errors(make_client):
+    server, client = make_client([(400, {"error": "bad request"}, {}), completion("unused")])
+    with pytest.raises(LLMError):
+        client.complete(MESSAGES)
+    assert client.stats.failures == 1
+    assert len(server.requests) == 1
+
+
+def test_gives_up_after_max_retries(make_client):
+    server, client = make_client([(429, {"error": "slow down"}, {})] * 3, max_retries=2)
+    with pytest.raises(RateLimitError):
+        client.complete(MESSAGES)
+    assert client.stats.retries == 2
+
+
+def test_async_complete(make_client):
+    server, client = make_client([completion("a"), completion("b")])
+
+    async def complete_both():
+        return await asyncio.gather(client.acomplete(MESSAGES), client.acomplete(MESSAGES))
+
+    results = asyncio.run(asyncio.wait_for(complete_both(), timeout=10))
+    assert sorted(result.content for result in results) == ["a", "b"]
+
+
+def test_token_bucket_waits_for_refill():
+    now = [0.0]
+    bucket = TokenBucket(60, clock=lambda: now[0])  # one token per second
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(2) == pytest.approx(2)
+    now[0] = 2
+    assert bucket.reserve(1) == pytest.approx(1)
+
+
+def test_rate_limiter_reconciles_tokens():
+    now = [0.0]
+    limiter = RateLimiter(rpm=100, tpm=1000, clock=lambda: now[0])
+    assert limiter.reserve(1000) == 0
+    limiter.reconcile(estimated_tokens=1000, used_tokens=400)
+    assert limiter.reserve(600) == 0
+    assert limiter.reserve(60) == pytest.approx(3.6)
+
+
+def test_estimate_tokens_counts_images():
+    messages = MESSAGES + [SimpleNamespace(type="human", content=[
+        {"type": "image_url", "image_url": {"url": "data:", "detail": "low"}}])]
+    assert estimate_tokens(messages, max_tokens=100) == 100 + len("You are an agent") // 4 + 1 + 85
+
+
+RESPONSE = ["Plan: click the button\nCode:\n", "```python\nactions.click(1, ", '"Sign in")\n`', "``", "\nThe button submits the form"]
+
+
+def code_block_closed():
+    """Stops a stream once its code block is closed, a simpler stand-in for the agent's CodeBlockParser."""
+    text = []
+
+    def feed(chunk):
+        text.append(chunk)
+        return "".join(text).count("```") >= 2
+
+    return feed
+
+
+def test_stream_stops_after_code_block(make_client):
+    server, client = make_client([streamed(*RESPONSE), streamed("Code:\n```\n", "actions.finish()\n```")])
+    response = client.stream(MESSAGES, code_block_closed)
+    assert response.content == "".join(RESPONSE[:4])
+    assert server.requests[0]["stream"] is True
+    assert client.stats.cancelled_streams == 1
+    # The cancelled stream's connection was closed, a fully read stream's connection is reused
+    assert client.stream(MESSAGES, code_block_closed).content == "Code:\n```\nactions.finish()\n```"
+    assert client.backend.connections_opened == 2
+
+
+def test_stream_retries_errors(make_client):
+    server, client = make_client([(503, {"error": "overloaded"}, {}), streamed("Code:\n```\n", "actions.finish()\n```")])
+
+    async def stream():
+        return await client.astream(MESSAGES, code_block_closed)
+
+    response = asyncio.run(asyncio.wait_for(stream(), timeout=10))
+    assert response.content == "Code:\n```\nactions.finish()\n```"
+    assert client.stats.retries == 1
+
+
+def test_scripted_backend_replays_responses():
+    backend = ScriptedBackend(["Code:\n```\nactions.scroll('down', '')\n```", "Code:\n```\nactions.finish()\n```"])
+    client = LLMClient(backend, limiter=RateLimiter(), backoff=NO_BACKOFF)
+    assert client.stream(MESSAGES, code_block_closed).content == "Code:\n```\nactions.scroll('down', '')\n```"
+    assert client.complete(MESSAGES).content.endswith("finish()\n```")
+    assert backend.remaining == 0 and len(backend.requests) == 2
+    with pytest.raises(LLMError, match="ran out of responses"):
+        client.complete(MESSAGES)
+    assert client.stats.retries == 0
@@ -0,0 +1,151 @@
+import asyncio
+import pytest
+from pywebagent.env.marking import (
+    DRAW_JS, FRAMES_JS, MARK_JS, MEASURE_JS, MarkingResult, async_mark_frames, child_frames_visibility, mark_frames,
+    merge_frame_elements)
+
+INSTALL_SCRIPT = "install the marker"
+
+
+class FakeFrame:
+    """A frame with `buttons` new elements to mark, answering after `delay` seconds."""
+
+    def __init__(self, name, buttons, parent=None, visible=True, delay=0.0, installed=True, error=None):
+        self.name, self.url = name, f"https://{name}.example.com/"
+        self.buttons, self.parent_frame, self.visible = buttons, parent, visible
+        self.delay, self.installed, self.error = delay, installed, error
+        self.child_frames = []
+        self.calls = []
+        if parent is not None:
+            parent.child_frames.append(self)
+
+    def is_detached(self):
+        return False
+
+    async def evaluate(self, expression, arg=None):
+        self.calls.append(expression)
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise RuntimeError(self.error)
+        if expression == INSTALL_SCRIPT:
+            self.installed = True
+            return None
+        if not self.installed:
+            return None
+        if expression == FRAMES_JS:
+            return self.embeds()
+        if expression == MARK_JS:
+            return {"elements": self.elements(arg["nextId"]), "nextId": arg["nextId"] + self.buttons, "incremental": False,
+                    "frames": self.embeds() if arg["frames"] else None}
+        if expression == MEASURE_JS:
+            return {"newElements": self.buttons, "incremental": arg["incremental"]}
+        assert expression == DRAW_JS
+        return {"elements": self.elements(arg), "nextId": arg + self.buttons}
+
+    def elements(self, start_id):
+        return [{"id": start_id + index, "tag": "BUTTON"} for index in range(self.buttons)]
+
+    def embeds(self):
+        return [{"name": child.name, "src": child.url, "visible": child.visible} for child in self.child_frames]
+
+
+def test_frames_are_marked_with_consecutive_id_ranges():
+    main = FakeFrame("main", 3, delay=0.02)
+    ad = FakeFrame("ad", 5, parent=main, visible=False)
+    embed = FakeFrame("embed", 2, parent=main, installed=False)
+    broken = FakeFrame("broken", 4, parent=main, error="Execution context was destroyed")
+    form = FakeFrame("form", 1, parent=main)
+    frames = [main, ad, embed, broken, form]
+
+    result = asyncio.run(async_mark_frames(frames, 10, True, INSTALL_SCRIPT))
+
+    ids = {index: [element["id"] for element in elements] for index, elements in result.elements.items()}
+    assert ids == {0: [10, 11, 12], 2: [13, 14], 4: [15]}
+    assert result.next_id == 16 and result.skipped_frames == 1 and result.incremental_frames == 3
+    assert ad.calls == [] and main.calls == [FRAMES_JS, MEASURE_JS, DRAW_JS]
+    assert embed.calls == [MEASURE_JS, INSTALL_SCRIPT, MEASURE_JS, DRAW_JS]
+    assert len(result.errors) == 1 and "broken" in result.errors[0]
+
+
+def test_single_visible_frame_is_marked_in_one_call():
+    main = FakeFrame("main", 2)
+    frames = [main, FakeFrame("pixel", 1, parent=main, visible=False)]
+    result = asyncio.run(async_mark_frames(frames, 0, False, INSTALL_SCRIPT))
+    assert main.calls == [FRAMES_JS, MARK_JS]
+    assert [element["id"] for element in result.elements[0]] == [0, 1] and result.next_id == 2
+
+
+class SyncFakeFrame:
+    """A frame of the sync API, see `FakeFrame`."""
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.name, self.url, self.parent_frame = frame.name, frame.url, frame.parent_frame
+        self.child_frames = []
+
+    def is_detached(self):
+        return False
+
+    def evaluate(self, expression, arg=None):
+        return asyncio.run(self.frame.evaluate(expression, arg))
+
+
+def sync_frames(frames):
+    wrappers = {frame: SyncFakeFrame(frame) for frame in frames}
+    for wrapper in wrappers.values():
+        wrapper.parent_frame = wrappers.get(wrapper.parent_frame)
+        if wrapper.parent_frame is not None:
+            wrapper.parent_frame.child_frames.append(wrapper)
+    return list(wrappers.values())
+
+
+def test_sync_frames_are_marked_one_after_another():
+    main = FakeFrame("main", 3)
+    ad = FakeFrame("ad", 5, parent=main, visible=False)
+    frames = [main, ad, FakeFrame("embed", 2, parent=main, installed=False),
+              FakeFrame("broken", 4, parent=main, error="Execution context was destroyed"),
+              FakeFrame("tracker", 1, parent=ad)]
+    result = mark_frames(sync_frames(frames), 10, True, INSTALL_SCRIPT)
+
+    ids = {index: [element["id"] for element in elements] for index, elements in result.elements.items()}
+    assert ids == {0: [10, 11, 12], 2: [13, 14]} and result.next_id == 15 and result.skipped_frames == 2
+    assert main.calls == [MARK_JS] and ad.calls == [] and frames[4].calls == []
+    assert frames[2].calls == [MARK_JS, INSTALL_SCRIPT, MARK_JS]
+    assert len(result.errors) == 1 and "broken" in result.errors[0]
+
+
+def test_child_frames_are_matched_to_their_elements():
+    main = FakeFrame("main", 0)
+    named = FakeFrame("checkout", 0, parent=main)
+    first, second = FakeFrame("", 0, parent=main), FakeFrame("", 0, parent=main)
+    first.url = second.url = "about:srcdoc"
+    embeds = [{"name": "", "src": "", "visible": False}, {"name": "", "src": "", "visible": True},
+              {"name": "checkout", "src": "https://shop.example.com/pay", "visible": False}]
+    assert child_frames_visibility(main.child_frames, embeds) == {named: False, first: False, second: True}
+    assert child_frames_visibility(main.child_frames, embeds[2:]) == {named: False}
+
+
+def test_merged_elements_read_like_the_marker_output():
+    main = FakeFrame("main", 2)
+    metadata = [{"id": 4, "tag": "INPUT", "bbox": {"x": 0, "y": 0, "width": 80, "height": 20}, "label": "Search",
+                 "role": "searchbox", "name": "Search", "region": "top", "value": "bunny"},
+                {"id": 5, "tag": "BUTTON", "bbox": {"x": 90, "y": 0, "width": 40, "height": 20}, "label": "Go",
+                 "role": "button", "name": "Go", "region": "top"}]
+    elements = merge_frame_elements([main], MarkingResult(elements={0: metadata}))
+    search, go = elements[4], elements[5]
+    assert search["tag"] == "INPUT" and search.get("value") == "bunny" and search["iframe"] is main
+    assert search.iframe_name == "main" and "value" not in go and go.get("states", []) == []
+    with pytest.raises(KeyError):
+        go["value"]
+    assert not hasattr(search, "__dict__")
+
+
+def test_added_and_removed_ids_between_observations():
+    pytest.importorskip("playwright")  # importing the browser environment imports playwright
+    from pywebagent.env.browser import diff_element_ids
+
+    previous = {1: "link", 2: "search", 3: "button"}
+    current = {8: "suggestion", 2: "search", 3: "button", 7: "suggestion"}  # ids are stable across steps
+    assert diff_element_ids(previous, current) == ([7, 8], [1])
+    assert diff_element_ids({}, current) == ([2, 3, 7, 8], [])
+    assert diff_element_ids(previous, previous) == ([], [])
@@ -0,0 +1,122 @@
+import json
+from types import SimpleNamespace
+import pytest
+from pywebagent.env.network import AssetCache, NetworkPolicy, NetworkRouter, get_expiry
+
+NOW = 1_700_000_000.0
+
+
+def test_policy_blocks_types_and_domains(tmp_path):
+    policy = NetworkPolicy()
+    assert policy.blocks("https://www.google-analytics.com/collect", "xhr")
+    assert policy.blocks("https://shop.example.com/intro.mp4", "media")
+    assert not policy.blocks("https://shop.example.com/app.js", "script")
+    assert not policy.blocks("https://notdoubleclick.net/a.js", "script")
+
+    path = tmp_path / "policy.json"
+    path.write_text(json.dumps({"extends_default": True, "blocked_resource_types": ["font"],
+                                "allowed_domains": ["hotjar.com"]}))
+    policy = NetworkPolicy.load(path)
+    assert policy.blocks("https://shop.example.com/a.woff2", "font")
+    assert not policy.blocks("https://static.hotjar.com/c.js", "script")
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"cache-control": "public, max-age=600"}, NOW + 600),
+    ({"cache-control": "max-age=600", "age": "100"}, NOW + 500),
+    ({"cache-control": "no-store, max-age=600"}, None),
+    ({"cache-control": "no-cache", "etag": '"v1"'}, NOW),
+    ({"cache-control": "no-cache"}, None),
+    ({"expires": "Tue, 14 Nov 2023 22:23:20 GMT", "date": "Tue, 14 Nov 2023 22:13:20 GMT"}, NOW + 600),
+    ({"last-modified": "Tue, 14 Nov 2023 12:13:20 GMT"}, NOW + 3600),
+    ({"etag": '"v1"'}, NOW),
+    ({}, None),
+    ({"cache-control": "max-age=600", "vary": "Cookie"}, None),
+    ({"cache-control": "private, max-age=600"}, None),
+])
+def test_expiry_follows_cache_headers(headers, expected):
+    assert get_expiry(headers, NOW) == expected
+
+
+class FakeRoute:
+    def __init__(self, url, responses, resource_type="script"):
+        self.request = SimpleNamespace(url=url, method="GET", resource_type=resource_type, headers={"accept": "*/*"})
+        self.responses = responses
+        self.fetched_headers = []
+        self.outcome = None
+
+    def fetch(self, headers=None):
+        self.fetched_headers.append(headers)
+        status, headers, body = self.responses.pop(0)
+        return SimpleNamespace(status=status, headers=headers, body=lambda: body)
+
+    def fulfill(self, status, headers, body):
+        self.outcome = ("fulfill", status, body)
+
+    def fallback(self):
+        self.outcome = ("fallback",)
+
+    def abort(self, error_code):
+        self.outcome = ("abort", error_code)
+
+
+def test_router_caches_and_revalidates(tmp_path):
+    now = [NOW]
+    cache = AssetCache(tmp_path, clock=lambda: now[0])
+    router = NetworkRouter(NetworkPolicy(), cache)
+    url = "https://shop.example.com/app.js"
+    headers = {"cache-control": "max-age=60", "etag": '"v1"', "content-encoding": "gzip"}
+
+    route = FakeRoute(url, [(200, headers, b"console.log(1)")])
+    router.handle(route)
+    assert route.outcome == ("fulfill", 200, b"console.log(1)")
+
+    route = FakeRoute(url, [])  # fresh, no request
+    router.handle(route)
+    assert route.outcome == ("fulfill", 200, b"console.log(1)")
+
+    now[0] += 120
+    route = FakeRoute(url, [(304, {"cache-control": "max-age=60"}, b"")])
+    router.handle(route)
+    assert route.fetched_headers[0]["if-none-match"] == '"v1"'
+    assert route.outcome == ("fulfill", 200, b"console.log(1)")
+    assert "content-encoding" not in cache.lookup(url).headers
+
+    route = FakeRoute("https://www.doubleclick.net/ad.js", [])
+    router.handle(route)
+    assert route.outcome == ("abort", "blockedbyclient")
+    route = FakeRoute("https://shop.example.com/api", [], resource_type="fetch")
+    router.handle(route)
+    assert route.outcome == ("fallback",)
+
+    route = FakeRoute("https://shop.example.com/vendor.js", [])  # the browser's conditional request
+    route.request.headers["if-none-match"] = '"v7"'
+    router.handle(route)
+    assert route.outcome == ("fallback",) and route.fetched_headers == []
+
+    route = FakeRoute("https://shop.example.com/account.js", [])  # could be personalized
+    route.request.headers["cookie"] = "session=1"
+    router.handle(route)
+    assert route.outcome == ("fallback",) and route.fetched_headers == []
+
+    stats = router.stats
+    assert (stats.cache_misses, stats.cache_hits, stats.revalidated, stats.blocked) == (1, 1, 1, 1)
+
+
+def test_cache_shares_bodies_and_evicts_least_recently_used(tmp_path):
+    now = [NOW]
+    cache = AssetCache(tmp_path, max_bytes=25, clock=lambda: now[0])
+    headers = {"cache-control": "max-age=600"}
+    cache.store("https://a.example.com/lib.js", 200, headers, b"x" * 10)
+    cache.store("https://b.example.com/lib.js", 200, headers, b"x" * 10)  # same content, stored once
+    assert cache.total_bytes() == 10
+    now[0] += 1
+    cache.store("https://a.example.com/logo.png", 200, headers, b"y" * 10)
+    now[0] += 1
+    cache.read(cache.lookup("https://a.example.com/lib.js"))
+    now[0] += 1
+    cache.store("https://a.example.com/big.png", 200, headers, b"z" * 10)
+    assert cache.lookup("https://a.example.com/logo.png") is None
+    assert cache.lookup("https://a.example.com/lib.js") is not None
+    assert cache.total_bytes() == 20
+    assert cache.store("https://a.example.com/private.js", 200, {**headers, "set-cookie": "a=1"}, b"p") is None
@@ -0,0 +1,80 @@
+import pytest
+
+pytest.importorskip("playwright")  # importing the agent imports the browser environment
+pytest.importorskip("langchain")  # builds the prompts
+import playwright._impl._api_types  # noqa: E402
+from pywebagent.agent import generate_system_message  # noqa: E402
+from pywebagent.env.actions import Actions, EnvState  # noqa: E402
+from pywebagent.env.browser import format_execution_error  # noqa: E402
+
+
+class FakeLocator:
+    def __init__(self, page, text):
+        self.page = page
+        self.text = text
+
+    def or_(self, other):
+        return self
+
+    @property
+    def first(self):
+        return self
+
+    def click(self, timeout):
+        if self.text not in self.page.links:
+            raise playwright._impl._api_types.TimeoutError(f"no element showing {self.text}")
+        self.page.url, self.page.texts = self.page.links[self.text]
+
+    def wait_for(self, state, timeout):
+        if self.text not in self.page.texts:
+            raise playwright._impl._api_types.TimeoutError(f"no element showing {self.text}")
+
+
+class FakePage:
+    """A shop where each link leads to a page with other texts."""
+
+    def __init__(self):
+        self.url = "https://shop.example.com/"
+        self.texts = ["Bunny"]
+        self.links = {
+            "Bunny": ("https://shop.example.com/item/bunny", ["Add to cart"]),
+            "Add to cart": ("https://shop.example.com/cart", ["Out of stock"]),
+        }
+
+    def get_by_role(self, role, name):
+        return FakeLocator(self, name.pattern.replace("\\", ""))
+
+    def get_by_text(self, text):
+        return FakeLocator(self, text)
+
+    def wait_for_url(self, predicate, wait_until, timeout):
+        if not predicate(self.url):
+            raise playwright._impl._api_types.TimeoutError("timed out")
+
+
+def test_plan_runs_until_an_expectation_fails():
+    page, env_state = FakePage(), EnvState(log_history=[])
+    plan = "\n".join([
+        "actions.click_text('Bunny', 'Open the bunny')",
+        "actions.expect_url('/item/', 'On the item page')",
+        "actions.click_text('Add to cart', 'Add it to the cart')",
+        "actions.expect_text('Added to cart', 'The cart has the bunny')",
+        "actions.finish(True, {}, 'Done')",
+    ])
+    context = {"actions": Actions(page, {}, env_state)}
+    with pytest.raises(Exception) as error:
+        exec(plan, context, context)
+
+    assert page.url == "https://shop.example.com/cart"
+    assert env_state.log_history == ["Open the bunny", "On the item page", "Add it to the cart"]
+    assert not env_state.has_successfully_completed
+    message = format_execution_error(plan, error.value)
+    assert "actions.expect_text('Added to cart'" in message
+    assert "Expected 'Added to cart' to be visible on the page" in message
+
+
+def test_plan_mode_prompt():
+    single, plan = generate_system_message().content, generate_system_message(plan_mode=True).content
+    assert "ONLY ONE WEBPAGE FUNCTION CALL IS ALLOWED" in single and "expect_url" not in single
+    assert "ONLY ONE WEBPAGE FUNCTION CALL IS ALLOWED" not in plan
+    assert "actions.expect_url(substring, log_message)" in plan and "actions.click_text(text, log_message)" in plan
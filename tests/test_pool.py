@@ -0,0 +1,159 @@
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("playwright")  # the pool imports the browser environment
+from pywebagent.env.pool import BrowserPool  # noqa: E402
+
+
+class FakePage:
+    def __init__(self, context):
+        self.context = context
+        self.closed = False
+        self.frames = [SimpleNamespace(url="about:blank")]
+        self.listeners = {}
+
+    def is_closed(self):
+        return self.closed
+
+    def evaluate(self, expression):
+        return 1
+
+    def on(self, event, listener):
+        self.listeners[event] = listener
+
+    def goto(self, url):
+        """Like a navigation, tells the listeners of the page."""
+        self.frames[0].url = url
+        self.listeners["framenavigated"](self.frames[0])
+
+    def close(self):
+        self.closed = True
+        self.context.pages.remove(self)
+
+
+class FakeCDPSession:
+    def __init__(self, context):
+        self.context = context
+
+    def send(self, method, params):
+        self.context.cleared_origins.append(params["origin"])
+
+    def detach(self):
+        pass
+
+
+class FakeContext:
+    def __init__(self, browser):
+        self.browser = browser
+        self.pages = []
+        self.closed = False
+        self.cookies_cleared = 0
+        self.cleared_origins = []
+
+    def new_page(self):
+        page = FakePage(self)
+        self.pages.append(page)
+        return page
+
+    def on(self, event, listener):
+        pass
+
+    def remove_listener(self, event, listener):
+        pass
+
+    def unroute(self, pattern):
+        pass
+
+    def new_cdp_session(self, page):
+        return FakeCDPSession(self)
+
+    def clear_cookies(self):
+        self.cookies_cleared += 1
+
+    def clear_permissions(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBrowser:
+    def __init__(self):
+        self.connected = True
+        self.contexts = []
+
+    def is_connected(self):
+        return self.connected
+
+    def new_context(self, **options):
+        context = FakeContext(self)
+        self.contexts.append(context)
+        return context
+
+    def close(self):
+        self.connected = False
+
+
+class FakePlaywright:
+    def __init__(self):
+        self.browsers = []
+        self.chromium = SimpleNamespace(launch=self.launch)
+
+    def launch(self, **options):
+        self.browsers.append(FakeBrowser())
+        return self.browsers[-1]
+
+
+def make_pool(**options):
+    pool = BrowserPool(**options)
+    pool._playwright = FakePlaywright()  # as if started, without a browser
+    return pool.start()
+
+
+def test_released_contexts_are_cleaned_and_handed_out_again():
+    pool = make_pool(size=1, contexts_per_browser=2)
+    browser = pool._playwright.browsers[0]
+    assert len(browser.contexts) == 2
+
+    lease = pool.acquire()
+    old_page = lease.page
+    old_page.goto("https://shop.example.com/cart")
+    pool.release(lease)
+    context = lease.context
+    assert context.cleared_origins == ["https://shop.example.com"] and context.cookies_cleared == 1
+    assert old_page.closed and context.pages != [old_page] and not context.closed
+
+    leases = [pool.acquire(), pool.acquire()]
+    assert {lease.context for lease in leases} == set(browser.contexts)  # no new context
+    pool.release(leases[0], reusable=False)
+    assert leases[0].context.closed
+
+    stats = pool.stats
+    assert (stats.hits, stats.misses, stats.contexts_recycled, stats.contexts_discarded) == (3, 0, 1, 1)
+    assert stats.hit_rate == 1.0 and stats.browsers_launched == 1
+
+
+def test_browser_is_retired_after_its_uses():
+    pool = make_pool(size=1, contexts_per_browser=2, max_uses_per_browser=2)
+    first = pool._playwright.browsers[0]
+    leases = [pool.acquire(), pool.acquire()]
+    pool.release(leases[0])
+    assert first.connected  # still leased
+    pool.release(leases[1])
+
+    assert not first.connected and len(pool._playwright.browsers) == 2
+    assert pool.acquire().browser is pool._playwright.browsers[1]
+    stats = pool.stats
+    assert (stats.browsers_launched, stats.browsers_retired, stats.contexts_recycled) == (2, 1, 0)
+
+
+def test_disconnected_browser_is_replaced():
+    pool = make_pool(size=1, contexts_per_browser=2)
+    crashed = pool._playwright.browsers[0]
+    crashed.connected = False
+
+    lease = pool.acquire()
+    assert lease.browser is pool._playwright.browsers[1] and lease.browser.connected
+    assert all(context.closed for context in crashed.contexts)
+    stats = pool.stats
+    assert (stats.hits, stats.misses, stats.browsers_retired, stats.contexts_discarded) == (0, 1, 1, 2)
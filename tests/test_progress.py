@@ -0,0 +1,78 @@
+import io
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from PIL import Image
+from pywebagent.progress import ProgressConfig, ProgressMonitor
+
+BUTTONS = {1: {"tag": "BUTTON", "bbox": {"x": 0, "y": 0, "width": 80, "height": 20}, "label": "Next"}}
+
+
+def screenshot(seed=0, cursor=False):
+    """A JPEG of random blocks, the same for a seed, `cursor` draws a blinking text cursor on it."""
+    blocks = np.random.default_rng(seed).integers(0, 256, (9, 16), dtype=np.uint8)
+    pixels = np.kron(blocks, np.ones((100, 100), dtype=np.uint8))
+    if cursor:
+        pixels[420:440, 800:802] = 255 - pixels[420:440, 800:802]
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="JPEG", quality=80)
+    return output.getvalue()
+
+
+PAGE, PAGE_2 = screenshot(0), screenshot(1)
+
+
+def page(url="https://shop.example.com/", screenshot=PAGE, error=None, elements=BUTTONS):
+    return SimpleNamespace(url=url, screenshot=screenshot, marked_elements=elements, error_message=error, delta=None)
+
+
+def test_detects_stalls_cycles_and_repeated_errors():
+    monitor = ProgressMonitor(ProgressConfig(responses=("hint", "fail")))
+    monitor.start(page())
+    assert monitor.observe("actions.click(1, 'Next')", page(screenshot=PAGE_2)) is None
+    for step, code in enumerate(["actions.scroll('down', 'a')", "actions.click(1, 'b')", "actions.scroll('up', 'c')"]):
+        assert monitor.observe(code, page(screenshot=screenshot(1, cursor=step % 2 == 0))) is None
+    stall = monitor.observe("actions.click(2, 'd')", page(screenshot=PAGE_2))
+    assert stall.kind == "stall" and stall.response == "hint" and "not changed in the last 4 steps" in stall.hint
+
+    monitor.start(page(screenshot=PAGE_2))
+    for _ in range(2):
+        assert monitor.observe("actions.click(1, 'Next')", page(url="https://shop.example.com/b")) is None
+        cycle = monitor.observe("actions.click(1, 'Back')", page(url="https://shop.example.com/a"))
+    assert cycle.kind == "cycle" and cycle.response == "fail" and "the same 2 actions" in cycle.diagnostic
+
+    monitor = ProgressMonitor()
+    monitor.start(page())
+    for step in range(3):
+        detection = monitor.observe(f"actions.click({step}, 'x')", page(screenshot=screenshot(step), error="Timeout"))
+    assert detection.kind == "repeated_error" and "Timeout" in detection.diagnostic and detection.response == "hint"
+
+
+def test_stuck_run_fails_early(monkeypatch):
+    pytest.importorskip("playwright")  # importing the agent imports the browser environment
+    from pywebagent import agent
+    from pywebagent.env.actions import EnvState
+
+    class StuckEnv:
+        def __init__(self):
+            self.steps = []
+
+        def reset(self, url):
+            return SimpleNamespace(**vars(page()), env_state=EnvState())
+
+        def step(self, code, marked_elements):
+            self.steps.append(code)
+            return SimpleNamespace(**vars(page()), env_state=EnvState())
+
+    hints = []
+    monkeypatch.setattr(agent, "calcualte_next_action",
+                        lambda task, observation, hint, **options: hints.append(hint) or "actions.click(1, 'Next')")
+    env = StuckEnv()
+    result = agent.run_agent(env, "https://shop.example.com/", agent.Task("buy", {}), max_actions=40,
+                             progress_config=ProgressConfig(responses=("hint", "scroll", "fail")))
+
+    assert not result.succeeded and result.reason.startswith("Stopped early: The run repeated the same action")
+    status, output = result
+    assert status == agent.TASK_STATUS.FAILED and output == {}
+    assert env.steps == ["actions.click(1, 'Next')"] * 4 + [agent.SCROLL_CODE] + ["actions.click(1, 'Next')"] * 2
+    assert [hint is not None for hint in hints] == [False, False, True, False, True, False]
@@ -0,0 +1,71 @@
+import base64
+from types import SimpleNamespace
+from pywebagent.env.screenshot import (
+    CROP_MARGIN, MAX_ENCODING_ATTEMPTS, ScreenshotConfig, capture_screenshot, get_clip, next_encoding)
+
+VIEWPORT = {"x": 0, "y": 300, "width": 1600, "height": 900}  # scrolled down by 300 px
+MAIN_FRAME, CHILD_FRAME = object(), object()
+
+
+def element(x, y, width=100, height=30, frame=MAIN_FRAME):
+    return {"tag": "BUTTON", "bbox": {"x": x, "y": y, "width": width, "height": height}, "iframe": frame}
+
+
+class FakeCDPSession:
+    """Encodes to `bytes_at_full_size` bytes at quality 100 and scale 1, fewer at a lower quality or scale."""
+
+    def __init__(self, bytes_at_full_size):
+        self.bytes_at_full_size = bytes_at_full_size
+        self.params = []
+
+    def send(self, method, params):
+        self.params.append(params)
+        size = self.bytes_at_full_size * params.get("quality", 100) / 100 * params["clip"]["scale"] ** 2
+        return {"data": base64.b64encode(b"x" * int(size)).decode()}
+
+
+def capture(config, bytes_at_full_size):
+    page = SimpleNamespace(evaluate=lambda expression: VIEWPORT, main_frame=MAIN_FRAME)
+    cdp_session = FakeCDPSession(bytes_at_full_size)
+    return capture_screenshot(page, cdp_session, {}, config), cdp_session.params
+
+
+def test_budget_lowers_quality_then_scale():
+    config = ScreenshotConfig()
+    assert (config.format, config.quality) == ("jpeg", 80)
+    assert next_encoding(80, 1.0, config) == (65, 1.0)
+    assert next_encoding(50, 1.0, config) == (50, 0.75)  # 35 would be under the minimum quality
+    assert next_encoding(50, 0.12, config) is None
+    assert next_encoding(80, 1.0, ScreenshotConfig(format="png")) == (80, 0.75)
+
+    screenshot, params = capture(ScreenshotConfig(max_bytes=200_000), 500_000)
+    assert [(p["quality"], p["clip"]["scale"]) for p in params] == [(80, 1.0), (65, 1.0), (50, 1.0), (50, 0.75)]
+    assert screenshot.size <= 200_000 and (screenshot.width, screenshot.height) == (1200, 675)
+
+    screenshot, params = capture(ScreenshotConfig(max_bytes=100), 500_000)  # can't fit, the last attempt is kept
+    assert len(params) == MAX_ENCODING_ATTEMPTS and screenshot.size > 100
+
+    screenshot, params = capture(ScreenshotConfig(max_width=800), 500_000)
+    assert len(params) == 1 and params[0]["clip"]["scale"] == 0.5 and screenshot.width == 800
+
+
+def test_crop_stays_inside_the_viewport():
+    config = ScreenshotConfig(crop_to_marked_elements=True)
+    elements = {1: element(5, 310), 2: element(1550, 1180, width=40, height=15)}  # at the top left and bottom right
+    assert get_clip(VIEWPORT, elements, config, MAIN_FRAME) == VIEWPORT
+
+    elements = {1: element(200, 500), 2: element(600, 700)}
+    assert get_clip(VIEWPORT, elements, config, MAIN_FRAME) == {
+        "x": 200 - CROP_MARGIN, "y": 500 - CROP_MARGIN, "width": 500 + 2 * CROP_MARGIN, "height": 230 + 2 * CROP_MARGIN}
+
+    elements = {1: element(5, 310)}
+    clip = get_clip(VIEWPORT, elements, config, MAIN_FRAME)
+    assert (clip["x"], clip["y"]) == (0, 300)
+
+
+def test_crop_keeps_the_viewport_without_elements_or_with_frames():
+    config = ScreenshotConfig(crop_to_marked_elements=True)
+    assert get_clip(VIEWPORT, {}, config, MAIN_FRAME) == VIEWPORT
+    elements = {1: element(200, 500), 2: element(10, 10, frame=CHILD_FRAME)}  # relative to its frame
+    assert get_clip(VIEWPORT, elements, config, MAIN_FRAME) == VIEWPORT
+    assert get_clip(VIEWPORT, {1: element(200, 500)}, ScreenshotConfig(), MAIN_FRAME) == VIEWPORT
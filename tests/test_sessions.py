@@ -0,0 +1,64 @@
+import pytest
+from pywebagent.env.sessions import SessionStore, drop_expired_cookies, is_login_url, local_storage_script
+
+NOW = 1_700_000_000.0
+STATE = {
+    "cookies": [
+        {"name": "sid", "value": "a", "domain": ".example.com", "path": "/", "expires": NOW + 3600},
+        {"name": "old", "value": "b", "domain": ".example.com", "path": "/", "expires": NOW - 1},
+        {"name": "tab", "value": "c", "domain": ".example.com", "path": "/", "expires": -1},
+    ],
+    "origins": [{"origin": "https://www.example.com", "localStorage": [{"name": "token", "value": "t"}]}],
+}
+
+
+def test_login_urls():
+    assert is_login_url("https://example.com/login?next=/orders")
+    assert is_login_url("https://example.com/account/sign-in/")
+    assert is_login_url("https://github.com/session/new")
+    assert not is_login_url("https://example.com/authors")
+    assert not is_login_url("https://login.example.com/orders")
+
+
+def test_expired_cookies_are_dropped_and_storage_is_scripted():
+    assert [cookie["name"] for cookie in drop_expired_cookies(STATE, NOW)["cookies"]] == ["sid", "tab"]
+    assert '"https://www.example.com": {"token": "t"}' in local_storage_script(STATE)
+    assert local_storage_script({"cookies": [], "origins": []}) is None
+
+
+def test_store_round_trip_expiry_and_accounts(tmp_path):
+    fernet = pytest.importorskip("cryptography.fernet")
+    now = [NOW]
+    store = SessionStore(tmp_path, max_age=3600, clock=lambda: now[0])
+    store.save("https://www.example.com/orders", STATE, account="alice")
+
+    assert store.load("https://example.com/", account="alice")["cookies"][0]["name"] == "sid"
+    assert store.load("https://example.com/", account="bob") is None
+    assert b"sid" not in next(tmp_path.glob("*.session")).read_bytes()
+    assert SessionStore(tmp_path, clock=store.clock).load("https://example.com/", account="alice") is not None  # same key file
+
+    now[0] += 3601
+    assert store.load("https://example.com/", account="alice") is None
+    assert not list(tmp_path.glob("*.session"))
+
+    store.save("https://example.com/", STATE)
+    store.invalidate("https://www.example.com/login")
+    assert store.load("https://example.com/") is None
+
+    store.save("https://example.com/", STATE)
+    assert SessionStore(tmp_path, key=fernet.Fernet.generate_key(), clock=store.clock).load("https://example.com/") is None
+
+
+def test_sub_agents_work_as_the_same_account(tmp_path):
+    pytest.importorskip("cryptography.fernet")
+    pytest.importorskip("playwright")
+    from pywebagent.env.async_browser import AsyncBrowserEnv
+    from pywebagent.env.browser import BrowserEnv
+
+    store = SessionStore(tmp_path)
+    for env in (BrowserEnv(browser=object(), session_store=store, session_account="alice"),
+                AsyncBrowserEnv(browser=object(), session_store=store, session_account="alice")):
+        sub_env = env.spawn()
+        assert type(sub_env) is type(env) and sub_env.browser is env.browser
+        assert sub_env.session_store is store and sub_env.session_account == "alice"
+        assert not sub_env._owns_browser
@@ -0,0 +1,98 @@
+from types import SimpleNamespace
+import pytest
+from pywebagent.env import settle
+from pywebagent.env.settle import RequestTracker, SettleConfig, wait_for_settle
+
+
+class FakePage:
+    """
+    A page on a fake clock, `events` are the (ms, event, request) of its request stream.
+    Evaluating the settle script takes `quietMs`, as the script waits for the DOM to be quiet that long.
+    """
+
+    def __init__(self, events=(), navigations=0):
+        self.now = 0.0  # seconds
+        self.events = sorted(events, key=lambda event: event[0])
+        self.navigations = navigations  # evaluations that fail, the document was replaced
+        self.handlers = {}
+        self.load_waits = 0
+
+    def on(self, event, handler):
+        self.handlers[event] = handler
+
+    def advance(self, ms):
+        end = self.now + ms / 1000
+        while self.events and self.events[0][0] / 1000 <= end:
+            at, event, request = self.events.pop(0)
+            self.now = max(self.now, at / 1000)
+            self.handlers[event](request)
+        self.now = end
+
+    def is_closed(self):
+        return False
+
+    def evaluate(self, script, options):
+        if self.navigations:
+            self.navigations -= 1
+            raise RuntimeError("Execution context was destroyed, most likely because of a navigation")
+        self.advance(min(options["quietMs"], options["timeoutMs"]))
+        return {"timedOut": False}
+
+    def wait_for_timeout(self, ms):
+        self.advance(ms)
+
+    def wait_for_load_state(self, state, timeout):
+        self.load_waits += 1
+        self.advance(10)
+
+
+class FakeRequest:
+    def __init__(self, resource_type):
+        self.resource_type = resource_type
+
+
+def fetch(start_ms, end_ms, resource_type="xhr"):
+    """The events of a request that runs from `start_ms` to `end_ms`, or never finishes if `end_ms` is None."""
+    sent = FakeRequest(resource_type)
+    return [(start_ms, "request", sent)] + ([(end_ms, "requestfinished", sent)] if end_ms is not None else [])
+
+
+@pytest.fixture
+def page_on_clock(monkeypatch):
+    def make(events=(), navigations=0):
+        page = FakePage(events, navigations)
+        monkeypatch.setattr(settle, "time", SimpleNamespace(monotonic=lambda: page.now, sleep=page.advance))
+        tracker = RequestTracker(page)
+        page.advance(0)  # the requests sent with the document
+        return page, tracker
+    return make
+
+
+def test_settles_once_requests_finished_and_the_quiet_window_passed(page_on_clock):
+    page, tracker = page_on_clock(fetch(0, 200) + fetch(100, 450, "image"))
+    result = wait_for_settle(page, tracker, SettleConfig())
+    assert not result.timed_out and 0.45 + 0.3 <= result.waited < 1.0
+
+
+def test_streams_and_long_polling_do_not_keep_the_page_busy(page_on_clock):
+    page, tracker = page_on_clock(fetch(0, None, "websocket") + fetch(0, None, "eventsource"))
+    result = wait_for_settle(page, tracker, SettleConfig())
+    assert not result.timed_out and result.waited == pytest.approx(0.3)
+
+    page, tracker = page_on_clock(fetch(0, None))  # a long poll, pending until the server has news
+    assert tracker.quiet_for(3000) == 0.0
+    result = wait_for_settle(page, tracker, SettleConfig(long_request_ms=3000))
+    assert not result.timed_out and 3.0 <= result.waited < 3.0 + 2 * 0.3
+
+
+def test_busy_page_times_out(page_on_clock):
+    events = [event for start in range(0, 10_000, 100) for event in fetch(start, start + 50)]
+    page, tracker = page_on_clock(events)
+    result = wait_for_settle(page, tracker, SettleConfig(timeout_ms=2000))
+    assert result.timed_out and result.waited == pytest.approx(2.0)
+
+
+def test_waits_for_the_new_document_after_a_navigation(page_on_clock):
+    page, tracker = page_on_clock(navigations=2)
+    result = wait_for_settle(page, tracker, SettleConfig())
+    assert page.load_waits == 2 and not result.timed_out
@@ -0,0 +1,42 @@
+import pytest
+from pywebagent.env.screenshot import Screenshot
+from pywebagent.env.spill import SpilledBytes, SpillExpiredError, SpillStore
+
+
+def test_payloads_are_read_back_until_evicted(tmp_path):
+    store = SpillStore(tmp_path, segment_size=2048, max_bytes=5000)
+    first = store.put(b"a" * 600)
+    second = store.put(b"b" * 600)
+    large = store.put(b"c" * 3000)  # gets its own segment
+    assert bytes(second) == b"b" * 600 and len(large) == 3000 and large.tobytes() == b"c" * 3000
+    assert first.segment == second.segment != large.segment
+
+    store.put(b"d" * 1000)  # over max_bytes, the oldest segments are deleted
+    with pytest.raises(SpillExpiredError):
+        first.tobytes()
+    assert bytes(large) == b"c" * 3000
+    store.close()
+    assert not list(tmp_path.iterdir())
+
+
+def test_spilled_screenshot_is_encoded_again_when_needed():
+    store = SpillStore()
+    screenshot = Screenshot(b"\xff\xd8jpeg", "jpeg", 10, 10, encoded="/9hqcGVn")
+    screenshot.spill(store)
+    assert isinstance(screenshot.data, SpilledBytes) and "base64" not in vars(screenshot)
+    assert screenshot.size == 6 and screenshot.data_url == "data:image/jpeg;base64,/9hqcGVn"
+    directory = store.directory
+    store.close()
+    assert not directory.exists()
+
+
+def test_runs_do_not_share_state():
+    pytest.importorskip("playwright")  # the actions import playwright
+    from pywebagent.env.actions import MAX_LOG_HISTORY, EnvState
+
+    first, second = EnvState(), EnvState()
+    first.output["total"] = 3
+    for i in range(MAX_LOG_HISTORY + 5):
+        first.log_history.append(f"step {i}")
+    assert second.output == {} and not second.log_history
+    assert len(first.log_history) == MAX_LOG_HISTORY and first.log_history[0] == "step 5"
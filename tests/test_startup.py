@@ -0,0 +1,75 @@
+import signal
+import subprocess
+import sys
+from types import ModuleType
+from pywebagent.env.server import get_browser_endpoint, is_cdp_endpoint, serve
+
+
+def test_importing_the_package_does_not_import_the_agent():
+    code = "import sys, pywebagent; print(sorted({'pywebagent.agent', 'langchain', 'playwright'} & set(sys.modules)))"
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    assert output.strip() == "[]"
+
+
+def test_endpoint_kinds(monkeypatch):
+    assert is_cdp_endpoint("http://127.0.0.1:9222")
+    assert is_cdp_endpoint("ws://127.0.0.1:9222/devtools/browser/0b5e5a6c")
+    assert not is_cdp_endpoint("ws://127.0.0.1:3000/")
+
+    monkeypatch.delenv("PYWEBAGENT_BROWSER_ENDPOINT", raising=False)
+    assert get_browser_endpoint() is None
+    monkeypatch.setenv("PYWEBAGENT_BROWSER_ENDPOINT", "http://127.0.0.1:9222")
+    assert get_browser_endpoint() == "http://127.0.0.1:9222"
+    assert get_browser_endpoint("ws://127.0.0.1:3000/") == "ws://127.0.0.1:3000/"
+
+
+class FakeBrowser:
+    """Exits on its own after `lifetime` waits, the disconnected event is only sent while playwright waits."""
+
+    def __init__(self, lifetime):
+        self.lifetime, self.handlers, self.waits = lifetime, [], 0
+
+    def on(self, event, handler):
+        self.handlers.append(handler)
+
+    def new_page(self):
+        return self
+
+    def wait_for_timeout(self, timeout):
+        self.waits += 1
+        if self.waits == self.lifetime:
+            for handler in self.handlers:
+                handler(self)
+
+    def is_connected(self):
+        return self.waits < self.lifetime
+
+    def close(self):
+        pass
+
+
+def test_server_relaunches_a_crashed_browser(monkeypatch):
+    browsers = [FakeBrowser(lifetime=2)]
+
+    def launch(**options):
+        if len(browsers) == 3:
+            raise KeyboardInterrupt
+        browsers.append(FakeBrowser(lifetime=2))
+        return browsers[-2]
+
+    class FakePlaywright:
+        chromium = type("Chromium", (), {"launch": staticmethod(launch)})
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+    sync_api = ModuleType("playwright.sync_api")
+    sync_api.sync_playwright = FakePlaywright
+    monkeypatch.setitem(sys.modules, "playwright", ModuleType("playwright"))
+    monkeypatch.setitem(sys.modules, "playwright.sync_api", sync_api)
+    monkeypatch.setattr(signal, "signal", lambda *args: None)  # keeps the SIGTERM handler of the test process
+    serve(channel=None)
+    assert [browser.waits for browser in browsers] == [2, 2, 0]
@@ -0,0 +1,40 @@
+from pywebagent.text_view import TextViewConfig, build_text_view
+
+
+def element(role, name, region, y, x=0, **fields):
+    return {"tag": "DIV", "role": role, "name": name, "region": region, "bbox": {"x": x, "y": y, "width": 80, "height": 20},
+            **fields}
+
+
+def test_elements_are_listed_by_region_in_reading_order():
+    view = build_text_view({
+        7: element("link", "Jellycat Bashful Bunny", "center", 400),
+        3: element("searchbox", "Search", "top", 10, value="plush bunny", states=["focused"]),
+        4: element("button", "Go", "top", 10, x=500),
+        9: element("checkbox", "Prime", "left", 300, states=["checked"]),
+    })
+    assert view.text == "\n".join([
+        'top:',
+        '  [3] searchbox "Search" value="plush bunny" (focused)',
+        '  [4] button "Go"',
+        'left:',
+        '  [9] checkbox "Prime" (checked)',
+        'center:',
+        '  [7] link "Jellycat Bashful Bunny"',
+    ])
+    assert view.ambiguous is None and view.omitted == 0
+
+
+def test_ambiguous_pages_need_the_screenshot():
+    icons = {i: element("button", "", "top right", 10, x=i * 30) for i in range(3)}
+    assert "3 of 4 elements have no name" in build_text_view({**icons, 9: element("link", "Home", "top", 10)}).ambiguous
+
+    carts = {i: element("button", "Add to cart", "center", 100 * i) for i in range(4)}
+    assert "share their name" in build_text_view(carts).ambiguous
+    assert build_text_view({}).ambiguous == "only 0 interactive elements were found"
+
+    links = {i: element("link", f"Product number {i}", "center", i) for i in range(100)}
+    view = build_text_view(links, TextViewConfig(max_tokens=100))
+    assert 0 < view.omitted < 100 and len(view.text) <= 100 * 4 + 60
+    assert view.text.endswith(f"... and {view.omitted} more elements, left out for brevity")
+    assert "did not fit in 100 tokens" in view.ambiguous
@@ -0,0 +1,83 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from pywebagent import tracing
+from pywebagent.tracing import JSONLExporter, Tracer, load_spans, main, summarize
+
+
+@pytest.fixture
+def trace_path(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    previous = tracing.get_tracer()
+    tracer = Tracer([JSONLExporter(path)])
+    tracing.set_tracer(tracer)
+    yield path
+    tracer.close()
+    tracing.set_tracer(previous)
+
+
+def test_spans_nest_across_threads_and_tasks(trace_path):
+    @tracing.traced("child")
+    async def child():
+        tracing.current_span().add("calls")
+
+    with tracing.span("step", step=0) as step:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            list(executor.map(tracing.bind(lambda i: child_in_thread()), range(2)))
+        asyncio.run(child())
+        step.set(status="SUCCESS")
+    with pytest.raises(ValueError):
+        with tracing.span("failing"):
+            raise ValueError("bad")
+
+    spans = {span.name: span for span in load_spans(trace_path)}
+    root = spans["step"]
+    assert root.parent_id is None and root.attributes == {"step": 0, "status": "SUCCESS"}
+    assert spans["child"].parent_id == root.span_id and spans["child"].attributes == {"calls": 1}
+    assert spans["in thread"].parent_id == root.span_id
+    assert spans["child"].trace_id == root.trace_id
+    assert spans["failing"].error == "ValueError: bad" and spans["failing"].trace_id != root.trace_id
+
+
+def child_in_thread():
+    with tracing.span("in thread"):
+        pass
+
+
+def test_disabled_tracer_yields_noop_span():
+    tracing.set_tracer(Tracer())
+    try:
+        with tracing.span("ignored") as span:
+            span.set(bytes=1)
+            assert span is tracing.NOOP_SPAN and tracing.current_span() is tracing.NOOP_SPAN
+    finally:
+        tracing.set_tracer(tracing._default_tracer())
+
+
+def write_trace(path, step_durations):
+    with open(path, "w") as file:
+        for i, duration in enumerate(step_durations):
+            start = i * 10**10
+            file.write(json.dumps({"name": "agent.step", "trace_id": "t", "span_id": f"s{i}", "parent_span_id": None,
+                                   "start_time_unix_nano": start, "end_time_unix_nano": start + int(duration * 1e9),
+                                   "attributes": {}, "status": {"code": "OK"}}) + "\n")
+            file.write(json.dumps({"name": "env.screenshot", "trace_id": "t", "span_id": f"c{i}", "parent_span_id": f"s{i}",
+                                   "start_time_unix_nano": start, "end_time_unix_nano": start + int(duration * 1e8),
+                                   "attributes": {"bytes": 1000 * (i + 1)}, "status": {"code": "OK"}}) + "\n")
+
+
+def test_report_and_regressions(tmp_path, capsys):
+    baseline, current = tmp_path / "baseline.jsonl", tmp_path / "current.jsonl"
+    write_trace(baseline, [1.0, 1.0, 1.0])
+    write_trace(current, [2.0, 2.0, 2.0])
+
+    phases = summarize(load_spans(current))
+    assert phases["agent.step"].count == 3
+    assert phases["agent.step"].self_total == pytest.approx(3 * 1.8)
+    assert phases["env.screenshot"].attribute_totals == {"bytes": 6000}
+
+    assert main([str(current)]) == 0
+    assert main([str(baseline), "--baseline", str(baseline)]) == 0
+    assert main([str(current), "--baseline", str(baseline)]) == 1
+    assert "Regressed phases: agent.step, env.screenshot" in capsys.readouterr().out
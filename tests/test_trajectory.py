@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("playwright")  # importing the agent imports the browser environment
+from pywebagent.agent import TASK_STATUS, Task  # noqa: E402
+from pywebagent.trajectory import (  # noqa: E402
+    TrajectoryRecorder,
+    TrajectoryStore,
+    page_fingerprint,
+    render_code,
+    template_code,
+)
+
+URL = "https://shop.example.com/login?session=1"
+ELEMENTS = {0: {"tag": "INPUT", "label": "Email"}, 1: {"tag": "BUTTON", "label": "Sign in"}}
+
+
+def observation(url=URL, elements=ELEMENTS):
+    return SimpleNamespace(url=url, marked_elements=elements)
+
+
+def test_template_and_render_code():
+    code = 'actions.input_text(0, "bob@example.com", True, "Type the email of bob@example.com")'
+    templated = template_code(code, {"email": "bob@example.com", "n": "1"})
+    assert "bob@example.com" not in templated
+    rendered = render_code(templated, {"email": 'o"neil@example.com'})
+    assert rendered == """actions.input_text(0, 'o"neil@example.com', True, 'Type the email of o"neil@example.com')"""
+    assert render_code(templated, {}) is None
+
+
+def test_fingerprint_ignores_query_and_digits():
+    changed = {0: {"tag": "INPUT", "label": "Email"}, 1: {"tag": "BUTTON", "label": "Sign in"}}
+    assert page_fingerprint(URL, ELEMENTS) == page_fingerprint("https://shop.example.com/login?session=2", changed)
+    prices = page_fingerprint(URL, {0: {"tag": "A", "label": "Cart (3)"}})
+    assert prices == page_fingerprint(URL, {0: {"tag": "A", "label": "Cart (4)"}})
+    assert page_fingerprint(URL, ELEMENTS) != page_fingerprint(URL, {0: ELEMENTS[0]})
+
+
+def test_replays_successful_run_until_divergence(tmp_path):
+    store = TrajectoryStore(tmp_path / "trajectories.sqlite")
+    code = ['actions.input_text(0, "bob@example.com", True, "Type email")', 'actions.click(1, "Sign in")']
+
+    failed = TrajectoryRecorder(store, URL, Task("Sign in", {"email": "bob@example.com"}))
+    failed.record(observation(), code[0], None, replayed=False)
+    failed.finish(TASK_STATUS.FAILED)
+    replay = TrajectoryRecorder(store, URL, Task("Sign in", {"email": "eve@example.com"}))
+    assert replay.recorded_code(observation()) is None  # only successful runs are replayed
+
+    recorded = TrajectoryRecorder(store, URL, Task("Sign in", {"email": "bob@example.com"}))
+    for step_code in code:
+        recorded.record(observation(), step_code, None, replayed=False)
+    recorded.finish(TASK_STATUS.SUCCESS)
+
+    replay = TrajectoryRecorder(store, URL, Task("Sign in", {"email": "eve@example.com"}))
+    assert replay.recorded_code(observation()) == "actions.input_text(0, 'eve@example.com', True, 'Type email')"
+    replay.record(observation(), "actions.input_text(0, 'eve@example.com', True, 'Type email')", None, replayed=True)
+    assert replay.recorded_code(observation(elements={0: ELEMENTS[0]})) is None
+    assert not replay.replaying
+
+    record_only = TrajectoryRecorder(store, URL, Task("Sign in", {"email": "eve@example.com"}), mode="record")
+    assert record_only.recorded_code(observation()) is None
+    store.close()